@@ -1,11 +1,19 @@
 import os
 import glob
+import time
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 import pandas as pd
 
 from biometrics.sample import Sample
 from biometrics.extract import Extract
+from biometrics.regenotype import Regenotyper
+from biometrics.store import SampleStore, APPEND_CHUNK_SIZE
+from biometrics.index import FingerprintIndex, get_index_file
+from biometrics.manifest import DatabaseManifest
 from biometrics.genotype import Genotyper
+from biometrics.comparison_writer import ComparisonWriter
 from biometrics.cluster import Cluster
 from biometrics.minor_contamination import MinorContamination
 from biometrics.major_contamination import MajorContamination
@@ -14,6 +22,19 @@ from biometrics.utils import standardize_sex_nomenclature, get_logger
 
 logger = get_logger()
 
+# number of extraction files each thread reads at a time when loading the
+# database, and how often the progress is logged
+LOAD_CHUNK_SIZE = 16
+LOAD_LOG_INTERVAL = 1000
+
+# the sample store fields each tool needs
+STORE_FIELDS = {
+    'sexmismatch': ['region_counts'],
+    'minor': ['counts', 'minor_allele_freq', 'genotype'],
+    'major': ['genotype'],
+    'genotype': ['genotype'],
+}
+
 
 def write_to_file(args, data, basename):
     """
@@ -30,18 +51,195 @@ def write_to_file(args, data, basename):
         data.to_json(outpath)
 
 
+def check_database_panel(extractor, store, index):
+    """
+    Check that samples extracted with the given sites and regions can be
+    added to the sample store and fingerprint index of the database. This
+    is checked before anything is extracted, so a changed panel does not
+    leave the database half updated.
+    """
+
+    rebuild = 'Remove it to extract with the new panel, and build it again once all the samples are extracted.'
+
+    if store.exists():
+        assert store.panel_hash == extractor.panel_hash, \
+            'The sample store in {} was built with a different set of sites. {}'.format(
+                store.path, rebuild)
+
+        if store.regions is not None and extractor.regions is not None:
+            assert store.regions.astype(str).values.tolist() == \
+                extractor.regions[[0, 1, 2]].astype(str).values.tolist(), \
+                'The sample store in {} was built with a different set of regions. {}'.format(
+                    store.path, rebuild)
+
+    if index.exists():
+        assert index.panel_hash in (None, '', extractor.panel_hash), \
+            'The fingerprint index {} was built with a different set of sites. {}'.format(
+                index.index_file, rebuild)
+
+
 def run_extract(args, samples):
     """
     Extract the pileup and region information from the samples. Then
-    save to the database.
+    save to the database. Samples are saved (and added to the manifest)
+    as they finish. They are added to the sample store and fingerprint
+    index in chunks of APPEND_CHUNK_SIZE samples, and then dropped from
+    memory.
+
+    The manifest is created by the first extraction into an empty
+    database. A database that already has extraction files but no
+    manifest is not given one, since it would only list the new samples;
+    run the manifest tool to create it.
     """
 
     extractor = Extract(args=args)
-    samples = extractor.extract(samples)
+    store = SampleStore(args.database)
+    index = FingerprintIndex(get_index_file(args.database))
+    manifest = DatabaseManifest(args.database)
+
+    check_database_panel(extractor, store, index)
+
+    if not manifest.exists() and os.path.isdir(args.database) and \
+            len(list_database_files(args.database, use_manifest=False)) == 0:
+        manifest.add([])
+
+    def add_chunk(chunk):
+
+        if store.exists():
+            store.append(chunk)
+
+        if index.exists():
+            index.add([sample.get_fingerprint() for sample in chunk])
+
+        for sample in chunk:
+            sample.unload()
+
+    chunk = []
+
+    for sample in extractor.extract_iter(samples):
+
+        if manifest.exists():
+            manifest.add([sample])
+
+        chunk.append(sample)
+
+        if len(chunk) == APPEND_CHUNK_SIZE:
+            add_chunk(chunk)
+            chunk = []
+
+    add_chunk(chunk)
+
+    if index.exists():
+        index.save()
 
     return samples
 
 
+def run_store(args):
+    """
+    Import the extraction files in the database into the consolidated
+    sample store.
+    """
+
+    store = SampleStore(args.database)
+
+    extraction_files = list_database_files(args.database)
+
+    if store.exists() and not args.overwrite:
+        extraction_files = [
+            extraction_file for extraction_file in extraction_files
+            if get_sample_name(extraction_file) not in store.metadata.index]
+
+    store.import_pickles(extraction_files)
+
+
+def run_index(args):
+    """
+    Build the fingerprint index of all the samples in the database.
+    """
+
+    samples = load_database_samples(args.database, set(), STORE_FIELDS['genotype'])
+
+    index = FingerprintIndex(get_index_file(args.database))
+    index.add([sample.get_fingerprint() for sample in samples.values()])
+    index.save()
+
+
+def run_manifest(args):
+    """
+    Build the manifest of the extraction files in the database, or check
+    it for stale entries.
+    """
+
+    manifest = DatabaseManifest(args.database)
+
+    if args.check:
+        assert manifest.exists(), 'The database does not have a manifest.'
+
+        stale = manifest.get_stale_entries()
+        for entry in stale.to_dict('records'):
+            logger.warning('Stale manifest entry for {}: {}.'.format(
+                entry['sample_name'], entry['reason']))
+
+        logger.info('Found {} stale entries out of {} samples in the manifest.'.format(
+            len(stale), len(manifest.entries)))
+
+        return stale
+
+    extraction_files = list_database_files(args.database, use_manifest=False)
+    samples = load_extraction_files(extraction_files, args.database, args.threads)
+
+    manifest.build(samples)
+
+
+def run_regenotype(args):
+    """
+    Re-genotype samples in the database from their stored allele counts.
+    """
+
+    if args.input:
+        extraction_files = []
+
+        for input in args.input:
+            if input.endswith('.pickle') or input.endswith('.pk'):
+                extraction_files.append(input)
+            elif input.endswith('.csv') or input.endswith('.txt'):
+                sample_names = pd.read_csv(input, sep=',')['sample_name']
+                extraction_files += [
+                    find_extraction_file(sample_name, args.database)
+                    for sample_name in sample_names]
+            else:
+                extraction_files.append(
+                    find_extraction_file(input, args.database))
+    else:
+        extraction_files = list_database_files(args.database)
+
+    regenotyper = Regenotyper(
+        min_coverage=args.min_coverage,
+        min_homozygous_thresh=args.min_homozygous_thresh,
+        default_genotype=args.default_genotype,
+        threads=args.threads)
+    regenotyper.regenotype(
+        extraction_files, os.path.join(args.database, 'ALL_FPsummary.txt'))
+
+    store = SampleStore(args.database)
+    if store.exists():
+        store.import_pickles(extraction_files)
+
+    index = FingerprintIndex(get_index_file(args.database))
+    manifest = DatabaseManifest(args.database)
+
+    if index.exists() or manifest.exists():
+        samples = load_extraction_files(extraction_files, args.database, args.threads)
+
+        if index.exists():
+            index.add([sample.get_fingerprint() for sample in samples.values()])
+            index.save()
+
+        if manifest.exists():
+            manifest.add(samples)
+
+
 def run_sexmismatch(args, samples):
     """
     Find and sex mismatches and save the output
@@ -119,7 +317,44 @@ def run_genotyping(args, samples):
         threads=args.threads,
         zmin=args.zmin,
         zmax=args.zmax,
-        het=args.het)
+        het=args.het,
+        comparison_cache=args.comparison_cache)
+
+    # only find the closest database matches of each input sample
+
+    if args.top_k is not None:
+        index = None
+        if args.use_index:
+            index = FingerprintIndex(get_index_file(args.database))
+            assert index.exists(), \
+                'The database does not have a fingerprint index. Please run \'biometrics index\' first.'
+
+        comparisons = genotyper.find_top_matches(samples, args.top_k, index=index)
+
+        basename = 'genotype_top_matches'
+        if args.prefix:
+            basename = args.prefix + '_' + basename
+
+        write_to_file(args, comparisons, basename)
+
+        return samples
+
+    # write the comparisons in blocks
+
+    if args.output_format == 'npz':
+        basename = 'genotype_comparison'
+        if args.prefix:
+            basename = args.prefix + '_' + basename
+
+        writer = ComparisonWriter(
+            os.path.join(os.path.abspath(args.outdir), basename), samples,
+            max_discordance=args.max_discordance,
+            unexpected_only=args.unexpected_only)
+        max_memory = args.max_memory * 1e9 if args.max_memory is not None else None
+        genotyper.write_comparisons(samples, writer, max_memory=max_memory)
+
+        return samples
+
     cluster_handler = Cluster(args.discordance_threshold)
     comparisons = genotyper.compare_samples(samples)
 
@@ -201,9 +436,9 @@ def run_cluster(args):
         clusters.to_csv(args.output, index=False)
 
 
-def load_input_sample_from_db(sample_name, database):
+def find_extraction_file(sample_name, database):
     """
-    Loads any the given (that the user specified via the CLI) from the
+    Get the path to the extraction file of the given sample in the
     database.
     """
 
@@ -215,33 +450,132 @@ def load_input_sample_from_db(sample_name, database):
     assert os.path.exists(extraction_file), 'Could not find: {}. Please rerun the extraction step.'.format(
         extraction_file)
 
+    return extraction_file
+
+
+def list_database_files(database, use_manifest=True):
+    """
+    List the extraction files that are present in the database, sorted
+    by sample name. If the database has a manifest, it is used instead of
+    scanning the directory.
+    """
+
+    manifest = DatabaseManifest(database)
+
+    if use_manifest and manifest.exists():
+        return manifest.list_extraction_files()
+
+    extraction_files = []
+
+    for pattern in ['*.pickle', '*.pk']:
+        extraction_files += glob.glob(os.path.join(database, pattern))
+
+    return sorted(extraction_files, key=get_sample_name)
+
+
+def get_sample_name(extraction_file):
+    """
+    Get the sample name from the path to an extraction file.
+    """
+
+    return os.path.basename(extraction_file).replace('.pickle', '').replace('.pk', '')
+
+
+def load_input_sample_from_db(sample_name, database):
+    """
+    Loads any the given (that the user specified via the CLI) from the
+    database.
+    """
+
+    extraction_file = find_extraction_file(sample_name, database)
+
     sample = Sample(query_group=False)
     sample.load_from_file(extraction_file)
 
     return sample
 
 
-def load_database_samples(database, existing_samples):
+def load_database_file(extraction_file, database):
     """
-    Loads any samples that are already present in the database AND
-    which were not specified as input via the CLI.
+    Lazily load a database sample from its extraction file.
     """
 
-    samples = {}
+    sample = Sample(db=database, query_group=True)
+    sample.load_from_file(extraction_file=extraction_file, lazy=True)
 
-    for pattern in ['*.pickle', '*.pk']:
-        for pickle_file in glob.glob(os.path.join(database, pattern)):
+    return sample
 
-            sample_name = os.path.basename(pickle_file).replace('.pickle', '').replace('.pk', '')
 
-            if sample_name in existing_samples:
-                continue
+def load_extraction_files(extraction_files, database, threads=1):
+    """
+    Lazily load the samples of the given extraction files, in the same
+    order. Loading is mostly waiting on the filesystem, so the files are
+    read by a pool of threads, in chunks of LOAD_CHUNK_SIZE files.
+    """
+
+    samples = {}
+    start_time = time.time()
 
-            sample = Sample(db=database, query_group=True)
-            sample.load_from_file(extraction_file=pickle_file)
+    with ThreadPool(threads) as pool:
+        loaded = pool.imap(
+            partial(load_database_file, database=database), extraction_files,
+            chunksize=LOAD_CHUNK_SIZE)
 
+        for i, sample in enumerate(loaded):
             samples[sample.sample_name] = sample
 
+            if (i + 1) % LOAD_LOG_INTERVAL == 0 or i + 1 == len(extraction_files):
+                elapsed = max(time.time() - start_time, 1e-6)
+                logger.info(
+                    'Loaded {}/{} database samples. Elapsed: {:.1f}s, throughput: {:.1f} samples/s.'.format(
+                        i + 1, len(extraction_files), elapsed, (i + 1) / elapsed))
+
+    return samples
+
+
+def load_database_samples(database, existing_samples, fields=None, threads=1, sample_types=None):
+    """
+    Loads any samples that are already present in the database AND
+    which were not specified as input via the CLI, optionally only the
+    samples of the given sample types. If the database has a sample
+    store, only the given fields are read from it. Otherwise, the
+    extraction files are read with the given number of threads (if the
+    database has a manifest, only the files of the given sample types
+    are read).
+    """
+
+    store = SampleStore(database)
+
+    if store.exists():
+        metadata = store.metadata
+        if sample_types is not None:
+            metadata = metadata[metadata['sample_type'].isin(sample_types)]
+
+        sample_names = [
+            sample_name for sample_name in metadata.index
+            if sample_name not in existing_samples]
+
+        return store.load_samples(
+            fields=fields, sample_names=sample_names, query_group=True)
+
+    manifest = DatabaseManifest(database)
+
+    if manifest.exists():
+        extraction_files = manifest.list_extraction_files(sample_types)
+    else:
+        extraction_files = list_database_files(database)
+
+    extraction_files = [
+        extraction_file for extraction_file in extraction_files
+        if get_sample_name(extraction_file) not in existing_samples]
+
+    samples = load_extraction_files(extraction_files, database, threads)
+
+    if sample_types is not None:
+        samples = {
+            sample_name: sample for sample_name, sample in samples.items()
+            if sample.sample_type in sample_types}
+
     return samples
 
 
@@ -369,7 +703,9 @@ def get_samples(args, extraction_mode=False):
 
         if not args.no_db_compare:
             samples.update(load_database_samples(
-                args.database, existing_samples))
+                args.database, existing_samples,
+                STORE_FIELDS.get(args.subparser_name), args.threads,
+                args.database_sample_type))
 
     return samples
 
@@ -390,6 +726,22 @@ def run_biometrics(args):
         run_cluster(args)
         return
 
+    if args.subparser_name == 'regenotype':
+        run_regenotype(args)
+        return
+
+    if args.subparser_name == 'store':
+        run_store(args)
+        return
+
+    if args.subparser_name == 'index':
+        run_index(args)
+        return
+
+    if args.subparser_name == 'manifest':
+        run_manifest(args)
+        return
+
     extraction_mode = args.subparser_name == 'extract'
 
     samples = get_samples(args, extraction_mode=extraction_mode)
@@ -50,7 +50,15 @@ def add_extraction_args(parser):
         running the extraction step.''')
     parser.add_argument(
         '-ov', '--overwrite', action='store_true',
-        help='''Overwrite any existing extraction results.''')
+        help='''Overwrite any existing extraction results. Otherwise, samples
+        that were already extracted are only extracted again if their BAM
+        file, the sites, the regions or the parameters changed.''')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='''Only extract the samples whose extraction results are
+        missing, incomplete or corrupt, as checked against the completion
+        marker that is saved with each sample. Results without a completion
+        marker (e.g. from older versions) are extracted again.''')
     parser.add_argument(
         '-f', '--fafile', required=True,
         help='''Path to reference fasta file.''')
@@ -60,18 +68,12 @@ def add_extraction_args(parser):
     parser.add_argument(
         '-Q', '--min-base-quality', default=1, type=int,
         help='''Minimum base quality of reads to be used for pileup.''')
-    parser.add_argument(
-        '-mc', '--min-coverage', default=10, type=int,
-        help='''Minimum coverage to count a site.''')
-    parser.add_argument(
-        '-mht', '--min-homozygous-thresh', default=0.1, type=float,
-        help='''Minimum threshold to define homozygous.''')
-    parser.add_argument(
-        '--default-genotype', default=None,
-        help='''Default genotype if coverage is too low (options are Het or Hom).''')
+    parser = add_genotype_calling_args(parser)
     parser.add_argument(
         '-t', '--threads', default=1, type=int,
-        help='''Number of threads to use to extract the samples.''')
+        help='''Number of threads to use to extract the samples. If there
+        are fewer samples than threads, each sample is split by genomic
+        position and extracted in parallel.''')
 
     return parser
 
@@ -97,6 +99,24 @@ def add_common_tool_args(parser):
         '-nc', '--no-db-compare', action='store_true',
         help='''Do not compare the sample(s) you provided to all samples
         in the database, only compare them with each other.''')
+    parser.add_argument(
+        '--database-sample-type', action="append",
+        help='''Only use the database samples of this sample type (e.g.
+        Normal). Can be specified more than once.''')
+
+    return parser
+
+
+def add_genotype_calling_args(parser):
+    parser.add_argument(
+        '-mc', '--min-coverage', default=10, type=int,
+        help='''Minimum coverage to count a site.''')
+    parser.add_argument(
+        '-mht', '--min-homozygous-thresh', default=0.1, type=float,
+        help='''Minimum threshold to define homozygous.''')
+    parser.add_argument(
+        '--default-genotype', default=None,
+        help='''Default genotype if coverage is too low (options are Het or Hom).''')
 
     return parser
 
@@ -111,9 +131,19 @@ def check_arg_equal_len(vals1, vals2, name):
 
 def check_args(args):
 
-    if args.subparser_name == 'cluster':
+    if args.subparser_name in ['cluster', 'regenotype', 'store', 'index', 'manifest']:
         return
 
+    if args.subparser_name == 'genotype' and args.use_index and args.top_k is None:
+        logger.error('--use-index can only be used with --top-k')
+        sys.exit(1)
+
+    if args.subparser_name == 'genotype' and args.output_format != 'npz' and \
+            (args.max_discordance is not None or args.unexpected_only or args.max_memory is not None):
+        logger.error(
+            '--max-discordance, --unexpected-only and --max-memory can only be used with --output-format npz')
+        sys.exit(1)
+
     if args.subparser_name != 'extract' and \
             not args.input and not args.sample_name:
         logger.error('You must specify either --input or --sample-name')
@@ -158,6 +188,80 @@ def get_args():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser_extract = add_extraction_args(parser_extract)
 
+    # regenotype parser
+
+    parser_regenotype = subparsers.add_parser(
+        'regenotype',
+        help='''Recompute the genotypes of samples in the database from
+        their stored allele counts, e.g. after changing --min-coverage or
+        --min-homozygous-thresh. Does not need the BAM files.''',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_regenotype.add_argument(
+        '-i', '--input', action="append", required=False,
+        help='''Sample(s) to re-genotype. Can be a sample name, the path to
+        a \'*.pk\' file, or a CSV file with a \'sample_name\' column. Can be
+        specified more than once. By default all samples in the database
+        are re-genotyped.''')
+    parser_regenotype.add_argument(
+        '-db', '--database', default=os.curdir,
+        help='''Directory where the extraction output is stored.''')
+    parser_regenotype = add_genotype_calling_args(parser_regenotype)
+    parser_regenotype.add_argument(
+        '-t', '--threads', default=1, type=int,
+        help='''Number of threads to use to re-genotype the samples.''')
+
+    # store parser
+
+    parser_store = subparsers.add_parser(
+        'store',
+        help='''Import the extraction files in the database into a single
+        consolidated sample store, which is faster to load for large
+        databases. Once created, the store is updated by the extract and
+        regenotype tools.''',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_store.add_argument(
+        '-db', '--database', default=os.curdir,
+        help='''Directory where the extraction output is stored.''')
+    parser_store.add_argument(
+        '--overwrite', action='store_true',
+        help='''Re-import samples that are already in the store.''')
+
+    # index parser
+
+    parser_index = subparsers.add_parser(
+        'index',
+        help='''Build an index of the fingerprints in the database, which
+        is used by \'genotype --top-k --use-index\' to find the candidate
+        matches of a sample without scanning the whole database. Once
+        created, the index is updated by the extract and regenotype
+        tools.''',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_index.add_argument(
+        '-db', '--database', default=os.curdir,
+        help='''Directory where the extraction output is stored.''')
+
+    # manifest parser
+
+    parser_manifest = subparsers.add_parser(
+        'manifest',
+        help='''Build a manifest of the extraction files in the database,
+        which is used to list the database samples instead of scanning the
+        directory. Once created, the manifest is updated by the extract
+        tool.''',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_manifest.add_argument(
+        '-db', '--database', default=os.curdir,
+        help='''Directory where the extraction output is stored.''')
+    parser_manifest.add_argument(
+        '-t', '--threads', default=1, type=int,
+        help='''Number of threads to use to read the extraction files.''')
+    parser_manifest.add_argument(
+        '--check', action='store_true',
+        help='''Do not update the manifest, only report the stale entries:
+        samples whose extraction file is missing or was changed since it
+        was recorded, or whose BAM file was changed since it was
+        extracted.''')
+
     # sex mismatch parser
 
     parser_sexmismatch = subparsers.add_parser(
@@ -167,6 +271,9 @@ def get_args():
     parser_sexmismatch.add_argument(
         '--coverage-threshold', default=50, type=int,
         help='''Samples with Y chromosome above this value will be considered male.''')
+    parser_sexmismatch.add_argument(
+        '-t', '--threads', default=1, type=int,
+        help='''Number of threads to use to load the database samples.''')
 
     # minor contamination parser
 
@@ -180,6 +287,9 @@ def get_args():
     parser_minor.add_argument(
         '--minor-threshold', default=0.002, type=float,
         help='''Minor contamination threshold for bad sample.''')
+    parser_minor.add_argument(
+        '-t', '--threads', default=1, type=int,
+        help='''Number of threads to use to load the database samples.''')
 
     # major contamination parser
 
@@ -193,6 +303,9 @@ def get_args():
     parser_major.add_argument(
         '--major-threshold', default=0.6, type=float,
         help='''Major contamination threshold for bad sample.''')
+    parser_major.add_argument(
+        '-t', '--threads', default=1, type=int,
+        help='''Number of threads to use to load the database samples.''')
 
     # genotyping parser
 
@@ -209,7 +322,8 @@ def get_args():
         as matching samples.''')
     parser_genotype.add_argument(
         '-t', '--threads', default=1, type=int,
-        help='''Number of threads to use to extract the samples.''')
+        help='''Number of threads to use to load the database samples and
+        to compare them (with --output-format npz).''')
     parser_genotype.add_argument(
         '--zmin', type=float,
         help='''Minimum z value for the colorscale on the heatmap.''')
@@ -219,6 +333,48 @@ def get_args():
     parser_genotype.add_argument(
         '--het', type=bool,
         help='''Include Hetrozygous sites along with homozygous sites when calculating discordant rate, helps specifically in cases where there are less than 100 total number of sites''')
+    parser_genotype.add_argument(
+        '--top-k', type=int,
+        help='''Only search for the closest database matches of each input
+        sample: output the K database samples with the lowest discordance
+        rate, plus any sample below --discordance-threshold. Database
+        samples are prefiltered on a subset of the sites before they are
+        compared on all sites. Clustering and plots are skipped in this
+        mode.''')
+    parser_genotype.add_argument(
+        '--comparison-cache',
+        help='''Path to a file to cache the sample comparisons in. Pairs of
+        samples that were already compared (and whose genotypes have not
+        changed) are read from the cache instead of being compared again,
+        and new comparisons are added to it.''')
+    parser_genotype.add_argument(
+        '--use-index', action='store_true',
+        help='''With --top-k, get the candidate database matches from the
+        fingerprint index of the database (see \'biometrics index\')
+        instead of prefiltering all the database samples.''')
+    parser_genotype.add_argument(
+        '--output-format', default='csv', choices=['csv', 'npz'],
+        help='''Format of the comparison output. \'npz\' writes the
+        comparisons in blocks to a folder of compressed NPZ files (with a
+        samples.csv index of the sample names), which is much smaller and
+        does not need to keep all the comparisons in memory. Clustering and
+        plots are skipped with \'npz\'.''')
+    parser_genotype.add_argument(
+        '--max-discordance', type=float,
+        help='''With --output-format npz, only write the comparisons with a
+        discordance rate below this value (and any unexpected ones, with
+        --unexpected-only).''')
+    parser_genotype.add_argument(
+        '--unexpected-only', action='store_true',
+        help='''With --output-format npz, only write the comparisons with an
+        unexpected match or mismatch (and any below --max-discordance).''')
+    parser_genotype.add_argument(
+        '--max-memory', type=float,
+        help='''With --output-format npz, approximate memory budget (in GB)
+        for comparing the samples. The comparisons are split into blocks of
+        samples that fit in it (shared by the --threads, which compare
+        blocks in parallel), and only the genotypes of the database samples
+        in the current blocks are loaded.''')
 
     # cluster parser
 
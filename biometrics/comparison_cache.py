@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from biometrics.fingerprint import COMPARISON_COUNTS
+from biometrics.utils import atomic_write, get_logger
+
+logger = get_logger()
+
+
+class ComparisonCache:
+    """
+    Persistent cache of the comparison counts between pairs of samples.
+    Each pair is keyed by the digests of the reference and query
+    fingerprints, which change whenever the site panel or any genotype
+    call changes, so cached counts are never stale. Only the counts are
+    cached: the discordance rate (and --het) is computed from them.
+
+    Each digest is stored once, in a table of digests, and a pair is keyed
+    by the positions of its two digests in that table, packed into a
+    single int64. The keys are kept sorted, so they are looked up with a
+    binary search, and a pair takes 36 bytes (its key and int32 counts).
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.digests = pd.Index([], dtype=object)
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros((0, len(COMPARISON_COUNTS)), dtype=np.int32)
+        self.new_keys = []
+        self.new_counts = []
+
+        if os.path.exists(cache_file):
+            with np.load(cache_file, allow_pickle=False) as data:
+                if 'digests' in data:
+                    self.digests = pd.Index(data['digests'].astype(str), dtype=object)
+                    self.keys = data['keys']
+                    self.counts = data['counts']
+                else:
+                    logger.warning(
+                        'The comparison cache {} was written by an older version, and will be '
+                        'replaced.'.format(cache_file))
+
+    def _get_digest_ids(self, digests, add=False):
+        """
+        Positions of the given digests in the digest table, or -1 if they
+        are not in it. If add, the missing digests are added to the table.
+        """
+
+        digests = pd.Index(np.asarray(digests, dtype=str), dtype=object)
+        ids = self.digests.get_indexer(digests)
+
+        if add and (ids < 0).any():
+            self.digests = self.digests.append(digests[ids < 0].unique())
+            ids = self.digests.get_indexer(digests)
+
+        return ids.astype(np.int64)
+
+    def _get_keys(self, ids1, ids2):
+
+        return ((ids1[:, None] << 32) | ids2[None, :]).ravel()
+
+    def lookup(self, digests1, digests2):
+        """
+        Look up the counts of every pair of reference and query digests.
+        Returns a dict of (n_ref x n_query) count matrices, keyed by
+        COMPARISON_COUNTS, and a matrix of which pairs were found.
+        """
+
+        shape = (len(digests1), len(digests2))
+        ids1 = self._get_digest_ids(digests1)
+        ids2 = self._get_digest_ids(digests2)
+
+        keys = self._get_keys(ids1, ids2)
+        idx = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+
+        found = ((ids1[:, None] >= 0) & (ids2[None, :] >= 0)).ravel()
+        if len(self.keys) > 0:
+            found &= self.keys[idx] == keys
+        else:
+            found[:] = False
+
+        counts = np.zeros((len(keys), len(COMPARISON_COUNTS)), dtype=np.int64)
+        counts[found] = self.counts[idx[found]]
+
+        counts = {
+            col: counts[:, j].reshape(shape)
+            for j, col in enumerate(COMPARISON_COUNTS)}
+
+        return counts, found.reshape(shape)
+
+    def add(self, digests1, digests2, counts):
+        """
+        Add the count matrices of the given reference and query digests.
+        """
+
+        self.new_keys.append(self._get_keys(
+            self._get_digest_ids(digests1, add=True), self._get_digest_ids(digests2, add=True)))
+        self.new_counts.append(np.stack(
+            [counts[col].ravel() for col in COMPARISON_COUNTS], axis=1).astype(np.int32))
+
+    def save(self):
+        """
+        Merge the new pairs into the cache file.
+        """
+
+        if len(self.new_keys) == 0:
+            return
+
+        keys = np.concatenate([self.keys] + self.new_keys)
+        counts = np.concatenate([self.counts] + self.new_counts)
+
+        # sort the keys, and keep the latest counts of each pair
+
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        keep = np.append(keys[1:] != keys[:-1], True)
+
+        self.keys = keys[keep]
+        self.counts = counts[order][keep]
+        self.new_keys = []
+        self.new_counts = []
+
+        with atomic_write(self.cache_file) as fh:
+            np.savez(
+                fh, digests=self.digests.to_numpy(dtype=str), keys=self.keys,
+                counts=self.counts)
+
+        logger.info('Saved {} comparisons to the comparison cache.'.format(
+            len(self.keys)))
@@ -0,0 +1,185 @@
+import os
+import glob
+import threading
+
+import numpy as np
+import pandas as pd
+
+from biometrics.fingerprint import COMPARISON_COUNTS
+from biometrics.utils import atomic_write, get_logger
+
+logger = get_logger()
+
+# the Status column is stored as an index into this list
+STATUS_VALUES = [
+    '', 'Expected Match', 'Unexpected Match', 'Unexpected Mismatch', 'Expected Mismatch']
+
+COMPARISON_COLUMNS = [
+    'ReferenceSample', 'ReferenceSampleGroup', 'QuerySample', 'QuerySampleGroup',
+    'IsInputToDatabaseComparison', 'CountOfCommonSites', 'HomozygousInRef', 'TotalMatch',
+    'HomozygousMatch', 'HeterozygousMatch', 'HomozygousMismatch', 'HeterozygousMismatch',
+    'DiscordanceRate', 'Matched', 'ExpectedMatch', 'Status']
+
+
+def list_comparison_parts(output_dir):
+    return sorted(glob.glob(os.path.join(output_dir, 'part-*.npz')))
+
+
+class ComparisonWriter:
+    """
+    Writes genotype comparisons to a folder of compressed NPZ chunks, one
+    per block of comparisons, instead of a single CSV file. Each chunk
+    has one typed array per column:
+
+    * ReferenceSample, QuerySample: int32 rows of samples.csv, which
+      holds the sample names and groups
+    * the comparison counts: int32 (all NA if CountOfCommonSites is 0)
+    * DiscordanceRate: float64
+    * IsInputToDatabaseComparison, Matched: bool
+    * ExpectedMatch: int8 (1 True, 0 False, -1 NA)
+    * Status: int8 index into STATUS_VALUES
+
+    Optionally only the comparisons with a discordance rate below
+    max_discordance and/or with an unexpected status are kept.
+    """
+
+    def __init__(self, output_dir, samples, max_discordance=None, unexpected_only=False):
+        self.output_dir = output_dir
+        self.max_discordance = max_discordance
+        self.unexpected_only = unexpected_only
+        self.n_parts = 0
+        self.n_rows = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(output_dir, exist_ok=True)
+
+        # remove the chunks of any previous run
+
+        for part_file in list_comparison_parts(output_dir):
+            os.remove(part_file)
+
+        self.sample_index = pd.Index(list(samples), dtype=object)
+
+        pd.DataFrame({
+            'sample_name': self.sample_index,
+            'sample_group': [samples[name].sample_group for name in self.sample_index]
+        }).to_csv(os.path.join(output_dir, 'samples.csv'), index=False)
+
+    def _filter(self, comparisons):
+
+        if self.max_discordance is None and not self.unexpected_only:
+            return comparisons
+
+        keep = np.zeros(len(comparisons), dtype=bool)
+
+        if self.max_discordance is not None:
+            keep |= (comparisons['DiscordanceRate'] < self.max_discordance).to_numpy()
+
+        if self.unexpected_only:
+            keep |= comparisons['Status'].isin(
+                ['Unexpected Match', 'Unexpected Mismatch']).to_numpy()
+
+        return comparisons[keep]
+
+    def write(self, comparisons, block=None):
+        """
+        Write a block of comparisons (as returned by the genotyper) to a
+        new chunk. The chunks are read back in the order of their block
+        number, which defaults to the order they are written in. Blocks
+        can be written from several threads.
+        """
+
+        comparisons = self._filter(comparisons)
+
+        with self.lock:
+            if block is None:
+                block = self.n_parts
+
+            if len(comparisons) > 0:
+                self.n_parts += 1
+                self.n_rows += len(comparisons)
+
+        if len(comparisons) == 0:
+            return
+
+        expected_match = comparisons['ExpectedMatch'].to_numpy(dtype=object)
+        unknown = pd.isna(expected_match)
+        expected_match[unknown] = False
+
+        data = {
+            'ReferenceSample': self.sample_index.get_indexer(comparisons['ReferenceSample']).astype(np.int32),
+            'QuerySample': self.sample_index.get_indexer(comparisons['QuerySample']).astype(np.int32),
+            'IsInputToDatabaseComparison': comparisons['IsInputToDatabaseComparison'].to_numpy(dtype=bool),
+            'DiscordanceRate': comparisons['DiscordanceRate'].to_numpy(dtype=np.float64),
+            'Matched': comparisons['Matched'].to_numpy(dtype=bool),
+            'ExpectedMatch': np.where(unknown, -1, expected_match.astype(bool)).astype(np.int8),
+            'Status': pd.Categorical(
+                comparisons['Status'], categories=STATUS_VALUES).codes.astype(np.int8)}
+
+        for col in COMPARISON_COUNTS:
+            data[col] = comparisons[col].fillna(0).to_numpy().astype(np.int32)
+
+        part_file = os.path.join(self.output_dir, 'part-{:05d}.npz'.format(block))
+
+        with atomic_write(part_file) as fh:
+            np.savez_compressed(fh, **data)
+
+    def close(self):
+        logger.info('Wrote {} comparisons in {} chunks to {}'.format(
+            self.n_rows, self.n_parts, self.output_dir))
+
+
+def read_comparisons(output_dir):
+    """
+    Read the comparisons written by a ComparisonWriter back into a
+    DataFrame, with the same columns as the CSV output.
+    """
+
+    sample_table = pd.read_csv(
+        os.path.join(output_dir, 'samples.csv'), dtype=str, keep_default_na=False)
+    sample_names = sample_table['sample_name'].to_numpy(dtype=object)
+    sample_groups = sample_table['sample_group'].replace('', None).to_numpy(dtype=object)
+
+    parts = []
+
+    for part_file in list_comparison_parts(output_dir):
+        with np.load(part_file, allow_pickle=False) as data:
+            parts.append({col: data[col] for col in data.files})
+
+    columns = set(COMPARISON_COUNTS) | {
+        'ReferenceSample', 'QuerySample', 'IsInputToDatabaseComparison',
+        'DiscordanceRate', 'Matched', 'ExpectedMatch', 'Status'}
+    data = {
+        col: np.concatenate([part[col] for part in parts]) if parts else np.zeros(0)
+        for col in columns}
+
+    ref_idx = data['ReferenceSample'].astype(int)
+    query_idx = data['QuerySample'].astype(int)
+
+    comparisons = pd.DataFrame({
+        'ReferenceSample': sample_names[ref_idx],
+        'ReferenceSampleGroup': sample_groups[ref_idx],
+        'QuerySample': sample_names[query_idx],
+        'QuerySampleGroup': sample_groups[query_idx],
+        'IsInputToDatabaseComparison': data['IsInputToDatabaseComparison'].astype(bool)})
+
+    no_common_sites = data['CountOfCommonSites'] == 0
+
+    for col in COMPARISON_COUNTS:
+        val = data[col].astype(np.int64)
+        if col != 'CountOfCommonSites' and no_common_sites.any():
+            val = val.astype(float)
+            val[no_common_sites] = np.nan
+        comparisons[col] = val
+
+    expected_match = data['ExpectedMatch'] == 1
+    if (data['ExpectedMatch'] == -1).any():
+        expected_match = expected_match.astype(object)
+        expected_match[data['ExpectedMatch'] == -1] = np.nan
+
+    comparisons['DiscordanceRate'] = data['DiscordanceRate'].astype(np.float64)
+    comparisons['Matched'] = data['Matched'].astype(bool)
+    comparisons['ExpectedMatch'] = expected_match
+    comparisons['Status'] = np.array(STATUS_VALUES, dtype=object)[data['Status'].astype(int)]
+
+    return comparisons[COMPARISON_COLUMNS]
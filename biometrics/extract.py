@@ -3,9 +3,152 @@ from multiprocessing import Pool
 
 import pandas as pd
 import numpy as np
-import vcf
 from pysam import AlignmentFile
 import math
+import time
+
+from biometrics.fingerprint import get_site_keys
+from biometrics.sample import Sample, consolidate_fp_summary
+from biometrics.site_panel import SitePanel
+from biometrics.utils import get_file_hash, get_logger
+
+logger = get_logger()
+
+# sites that are at most this many bases apart share a pileup iterator
+SITE_WINDOW_GAP = 1000
+
+# column order of the pileup table
+PILEUP_COLUMNS = [
+    'chrom', 'pos', 'ref', 'alt', 'reads_all', 'matches', 'mismatches',
+    'A', 'C', 'T', 'G', 'N', 'minor_allele_freq', 'genotype_class',
+    'genotype']
+
+# per-site counts computed from the pileup
+COUNT_COLUMNS = [
+    'reads_all', 'matches', 'mismatches', 'A', 'C', 'T', 'G', 'N']
+
+ALLELES = ['A', 'C', 'G', 'T', 'N']
+
+# extraction information that may differ for a sample to be extracted
+# partially, i.e. only at the sites and regions it is missing
+PARTIAL_EXTRACTION_KEYS = ['panel_hash', 'regions_hash']
+
+# highest base quality that still encodes to a printable ASCII character
+MAX_PRINTABLE_QUAL = ord('~') - 33
+
+
+def get_bam_index_file(sample_bam):
+    """
+    Path to the index of a BAM file (sample.bam.bai, sample.bai or
+    sample.bam.csi), or None if there is none.
+    """
+
+    for index_file in [
+            sample_bam + '.bai', os.path.splitext(sample_bam)[0] + '.bai',
+            sample_bam + '.csi']:
+        if os.path.exists(index_file):
+            return index_file
+
+    return None
+
+
+def get_region_keys(chroms, starts, ends):
+    """
+    Key of every region (chrom:start:end).
+    """
+
+    return pd.Index(
+        chroms.astype(str) + ':' + starts.astype(np.int64).astype(str) + ':' +
+        ends.astype(np.int64).astype(str))
+
+
+def call_genotypes(pileup, min_coverage, min_homozygous_thresh,
+                   default_genotype=None):
+    """
+    Compute the minor allele frequency, genotype class (Hom, Het or NA)
+    and genotype (e.g. A, T, AT, GC) for every site of a pileup table.
+
+    Only the allele count columns are used, so this can also be used to
+    re-genotype stored pileups with different thresholds. Returns a copy
+    of the pileup with the 'minor_allele_freq', 'genotype_class' and
+    'genotype' columns (re)computed.
+    """
+
+    n_sites = len(pileup)
+    ref_alleles = pileup['ref'].to_numpy(dtype=object)
+    alt_alleles = pileup['alt'].to_numpy(dtype=object)
+
+    # look up the ref and alt allele counts for every site
+
+    alleles = pd.Index(ALLELES)
+    ref_idx = alleles.get_indexer(ref_alleles)
+    alt_idx = alleles.get_indexer(alt_alleles)
+
+    if (ref_idx < 0).any() or (alt_idx < 0).any():
+        raise KeyError('Sites must have single-base ref and alt alleles: {}'.format(
+            set(ref_alleles[ref_idx < 0]) | set(alt_alleles[alt_idx < 0])))
+
+    allele_counts = pileup[ALLELES].to_numpy(dtype=np.int64)
+    rows = np.arange(n_sites)
+    ref_counts = allele_counts[rows, ref_idx]
+    alt_counts = allele_counts[rows, alt_idx]
+
+    # minor allele frequency, NA if coverage is too low
+
+    coverage = ref_counts + alt_counts
+    covered = (coverage >= min_coverage) & (coverage > 0)
+
+    minor_allele_freq = np.full(n_sites, np.nan)
+    np.divide(
+        np.minimum(ref_counts, alt_counts), coverage,
+        out=minor_allele_freq, where=covered)
+
+    # genotype class as codes: -1 is NA, otherwise an index into classes
+
+    classes = ['Hom', 'Het']
+    class_codes = np.where(
+        minor_allele_freq <= min_homozygous_thresh, 0, 1).astype(np.int8)
+
+    if default_genotype is None:
+        class_codes[~covered] = -1
+    else:
+        if default_genotype not in classes:
+            classes.append(default_genotype)
+        class_codes[~covered] = classes.index(default_genotype)
+
+    genotype_class = np.full(n_sites, np.nan, dtype=object)
+    called = class_codes >= 0
+    genotype_class[called] = np.array(classes, dtype=object)[class_codes[called]]
+
+    # genotype in terms of the alleles
+
+    is_het = class_codes == classes.index('Het')
+    is_hom = called & ~is_het
+
+    genotype = np.full(n_sites, np.nan, dtype=object)
+    genotype[is_het] = ref_alleles[is_het] + alt_alleles[is_het]
+    genotype[is_hom] = np.where(
+        ref_counts > alt_counts, ref_alleles, alt_alleles)[is_hom]
+
+    return pileup.assign(
+        minor_allele_freq=minor_allele_freq,
+        genotype_class=genotype_class,
+        genotype=genotype)
+
+
+# the Extract instance of a worker process. It is set once per worker by
+# init_extraction_worker, so that the sites and regions are not sent to
+# the worker with every job.
+worker_extractor = None
+
+
+def init_extraction_worker(extractor):
+    global worker_extractor
+    worker_extractor = extractor
+
+
+def run_shard_job(job):
+    return worker_extractor._shard_job(job)
 
 
 class Extract:
@@ -24,27 +167,24 @@ class Extract:
         self.bed = args.bed
         self.fafile = args.fafile
         self.overwrite = args.overwrite
+        self.resume = args.resume
         self.min_coverage = args.min_coverage
         self.min_homozygous_thresh = args.min_homozygous_thresh
-        self.sites = []
+        self.sites = SitePanel()
         self.regions = None
 
         self._parse_vcf()
         self._parse_bed_file()
 
+        self.panel_hash = self.sites.panel_hash
+        self.regions_hash = get_file_hash(self.bed) if self.bed is not None else None
+
     def _parse_vcf(self):
 
         if self.vcf is None:
             return
 
-        for record in vcf.Reader(open(self.vcf, 'r')):
-            self.sites.append({
-                'chrom': record.CHROM,
-                'start': record.POS-1,
-                'end': record.POS,
-                'ref_allele': str(record.REF),
-                'alt_allele': str(record.ALT[0])
-            })
+        self.sites = SitePanel.load(self.vcf)
 
     def _parse_bed_file(self):
 
@@ -60,99 +200,40 @@ class Extract:
 
         self.regions.columns = range(self.regions.shape[1])
 
-    def _extract_regions(self, sample):
+    def _count_regions(self, bam, regions):
         """
-        Code to extract the coverage information for the regions listed
-        in the BED file.
+        Count the reads in the given regions (indices into the regions
+        listed in the BED file).
         """
 
-        if self.regions is None:
-            return sample
+        counts = np.zeros(len(regions), dtype=np.int64)
 
-        # get the pileup
-
-        bam = AlignmentFile(sample.sample_bam)
-        region_counts = []
-
-        for i in self.regions.index:
+        for j, i in enumerate(regions):
 
             chrom = self.regions.at[i, 0]
             start = int(self.regions.at[i, 1])
             end = int(self.regions.at[i, 2])
 
-            count = bam.count(chrom, start, end)
-
-            region_counts.append({
-                'chrom': chrom,
-                'start': start,
-                'end': end,
-                'count': count})
-
-        if len(region_counts) > 0:
-            region_counts = pd.DataFrame(region_counts)
-            sample.region_counts = region_counts
-
-        return sample
-
-    def _get_minor_allele_freq(self, allele_counts):
-
-        coverage = sum(allele_counts)
-
-        if coverage < self.min_coverage or coverage == 0:
-            return np.nan
-        else:
-            return min(allele_counts) / coverage
-
-    def _get_genotype_class(self, minor_allele_freq):
-        """
-        Determine if Het, Hom, or unknown/NA.
-        """
+            counts[j] = bam.count(chrom, start, end)
 
-        if pd.isna(minor_allele_freq):
+        return counts
 
-            if self.default_genotype is not None:
-                return self.default_genotype
-
-            return np.nan
-        else:
-            if minor_allele_freq <= self.min_homozygous_thresh:
-                return 'Hom'
-            else:
-                return 'Het'
-
-    def _get_genotype(self, genotype, allele_counts, alleles):
+    def _build_region_counts(self, counts):
         """
-        Get the genotype in terms of the allele(s) (e.g. A, T, AT, GC, etc.)
+        Build the region counts table from the per-region read counts.
         """
 
-        if pd.isna(genotype):
-            return np.nan
-        elif genotype == 'Het':
-            return ''.join(alleles)
-        else:
-            if allele_counts[0] > allele_counts[1]:
-                return alleles[0]
-            else:
-                return alleles[1]
-
-    def _get_genotype_info(self, pileup_site, ref_allele, alt_allele):
-        """
-        Plot minor contamination data.
-        """
-
-        allele_counts = [pileup_site[ref_allele], pileup_site[alt_allele]]
-
-        pileup_site['minor_allele_freq'] = self._get_minor_allele_freq(
-            allele_counts)
-
-        pileup_site['genotype_class'] = self._get_genotype_class(
-            pileup_site['minor_allele_freq'])
+        region_counts = []
 
-        pileup_site['genotype'] = self._get_genotype(
-            pileup_site['genotype_class'], allele_counts,
-            [ref_allele, alt_allele])
+        for j, i in enumerate(self.regions.index):
+            region_counts.append({
+                'chrom': self.regions.at[i, 0],
+                'start': int(self.regions.at[i, 1]),
+                'end': int(self.regions.at[i, 2]),
+                'count': int(counts[j])})
 
-        return pileup_site
+        if len(region_counts) > 0:
+            return pd.DataFrame(region_counts)
 
     def _add_base(self, site, old_base, old_base_qual, new_base,
                   new_base_qual):
@@ -186,140 +267,542 @@ class Extract:
         else:
             return ['N', '&']
 
-    def _pileup(self, bam, site):
+    def _group_sites(self, bam, sites=None):
+        """
+        Sort the sites (all sites, or the given site indices) by contig and
+        position, and group neighbouring sites into windows that can be
+        walked with a single pileup iterator.
+        """
+
+        if sites is None:
+            sites = range(len(self.sites))
+
+        sites = np.asarray(sites, dtype=np.int64)
+        contig_tids = np.array(
+            [bam.get_tid(contig) for contig in self.sites.contigs], dtype=np.int64)
+        starts = self.sites.positions.astype(np.int64) - 1
+        chrom_codes = self.sites.chrom_codes
+
+        order = sites[np.lexsort((starts[sites], contig_tids[chrom_codes[sites]]))]
+
+        windows = []
+
+        for i in order.tolist():
+            chrom = self.sites.contigs[chrom_codes[i]]
+            start = int(starts[i])
+
+            if windows and windows[-1]['chrom'] == chrom and \
+                    start - windows[-1]['end'] <= SITE_WINDOW_GAP:
+                windows[-1]['end'] = max(windows[-1]['end'], start + 1)
+                windows[-1]['sites'].append(i)
+            else:
+                windows.append({
+                    'chrom': chrom,
+                    'start': start,
+                    'end': start + 1,
+                    'sites': [i]})
+
+        return windows
+
+    def _read_avg_qual(self, alignment, qualities, qual_cache):
+        """
+        Get the average quality of a read as an ASCII code (phred + 33).
+        Only needed when the quality at the queried position is unusable,
+        so it is computed on demand and cached for the other sites the
+        read overlaps.
+        """
+
+        key = (alignment.query_name, alignment.is_read1)
+
+        if key not in qual_cache:
+            qualities = np.frombuffer(qualities, dtype=np.uint8)
+            total = int(qualities.sum(dtype=np.int64)) + 33 * len(qualities)
+            qual_cache[key] = math.ceil(total / len(qualities))
+
+        return qual_cache[key]
+
+    def _pileup_column(self, pileupcolumn, site, qual_cache):
         """
-        Get the per-site pileup information.
+        Get the per-read base information for a single pileup column.
         """
 
         read_data = {}
-        allele_counts = {'A': 0, 'C': 0, 'G': 0, 'T': 0, 'N': 0}
 
-        for pileupcolumn in bam.pileup(
-                contig=site['chrom'], start=site['start'], end=site['end'],
-                truncate=True, max_depth=30000, stepper='nofilter',
-                min_base_quality=self.min_base_quality):
-
-            for pileupread in pileupcolumn.pileups:
-
-                if pileupread.query_position is None:
-                    continue
-
-                mapq = pileupread.alignment.mapping_quality
-                read_name = pileupread.alignment.qname
-                base = pileupread.alignment.query_sequence[pileupread.query_position]
-
-                if (mapq < self.min_mapping_quality) or pileupread.is_refskip or pileupread.is_del:
-                    # skip the read if its mapping quality is too low
-                    # or if the site is part of an indel
-                    continue
-
-                ###########################
-                ### fix for when alignment qualities contain non-ascii characters, which
-                # happens sometimes from fgbio duplex sequening toolset
-                """"
-                Whenever we come across a bad character - or a non printable character at a particular position
-                the quality at that position is replaced with the average read quality.
-                There are some reads that are totally non-readable we skip the read
-
-                """
-                total_read_qual_avg = 0
-                try:
-                    for char in pileupread.alignment.qual:
-                        total_read_qual_avg += int(ord(char))
-                    read_avg=math.ceil(total_read_qual_avg/len(pileupread.alignment.qual))
-                except:
-                    continue
-
-                try:
-                    base_qual = pileupread.alignment.qual[pileupread.query_position]
-                except:
-                    base_qual=chr(read_avg)
-
-
-                if read_name in read_data and read_data[read_name][0] == 'N':
-                    continue
-                elif read_name in read_data:
-                    vals = self._add_base(
-                        site, read_data[read_name][0],
-                        read_data[read_name][1], base, base_qual)
-                    read_data[read_name] = vals[0:2]
-                else:
-                    read_data[read_name] = [base, base_qual]
-
-        total = 0
+        for pileupread in pileupcolumn.pileups:
+
+            query_position = pileupread.query_position
+
+            if query_position is None:
+                continue
+
+            alignment = pileupread.alignment
+            mapq = alignment.mapping_quality
+            read_name = alignment.query_name
+            base = alignment.query_sequence[query_position]
+
+            if (mapq < self.min_mapping_quality) or pileupread.is_refskip or pileupread.is_del:
+                # skip the read if its mapping quality is too low
+                # or if the site is part of an indel
+                continue
+
+            # fix for when alignment qualities contain non-ascii characters,
+            # which happens sometimes from fgbio duplex sequencing toolset.
+            # Whenever the quality at the site is missing or not a printable
+            # character, it is replaced with the average read quality.
+            # Reads without any qualities are skipped.
+
+            qualities = alignment.query_qualities
+
+            if not qualities:
+                continue
+
+            if query_position < len(qualities) and \
+                    qualities[query_position] <= MAX_PRINTABLE_QUAL:
+                base_qual = chr(qualities[query_position] + 33)
+            else:
+                base_qual = chr(self._read_avg_qual(
+                    alignment, qualities, qual_cache))
+
+            if read_name in read_data and read_data[read_name][0] == 'N':
+                continue
+            elif read_name in read_data:
+                vals = self._add_base(
+                    site, read_data[read_name][0],
+                    read_data[read_name][1], base, base_qual)
+                read_data[read_name] = vals[0:2]
+            else:
+                read_data[read_name] = [base, base_qual]
+
+        return read_data
+
+    def _site_counts(self, site, read_data):
+        """
+        Summarize the per-read base information into the counts for a
+        site, in the order of COUNT_COLUMNS.
+        """
+
+        allele_counts = {'A': 0, 'C': 0, 'G': 0, 'T': 0, 'N': 0}
         matches = 0
-        mismatches = 0
-        for read, base_data in read_data.items():
 
-            allele_counts[base_data[0]] += 1
-            total += 1
+        for base, base_qual in read_data.values():
+            allele_counts[base] += 1
 
-            if base_data[0] == site['ref_allele']:
+            if base == site['ref_allele']:
                 matches += 1
-            else:
-                mismatches += 1
+
+        total = len(read_data)
+
+        return [
+            total, matches, total - matches, allele_counts['A'],
+            allele_counts['C'], allele_counts['T'], allele_counts['G'],
+            allele_counts['N']]
+
+    def _pileup(self, bam, windows):
+        """
+        Get the per-site pileup counts for the sites in the given windows
+        (see _group_sites). Each window of neighbouring sites is walked
+        once with a single pileup iterator. Returns the site indices and
+        an array with one row per site and one column per entry in
+        COUNT_COLUMNS.
+        """
+
+        sites = [i for window in windows for i in window['sites']]
+        rows = {i: j for j, i in enumerate(sites)}
+        counts = np.zeros((len(sites), len(COUNT_COLUMNS)), dtype=np.int32)
+
+        for window in windows:
+
+            targets = {}
+            qual_cache = {}
+            for i in window['sites']:
+                targets.setdefault(self.sites[i]['start'], []).append(i)
+
+            for pileupcolumn in bam.pileup(
+                    contig=window['chrom'], start=window['start'],
+                    end=window['end'], truncate=True, max_depth=30000,
+                    stepper='nofilter', min_base_quality=self.min_base_quality):
+
+                for i in targets.get(pileupcolumn.reference_pos, []):
+                    read_data = self._pileup_column(
+                        pileupcolumn, self.sites[i], qual_cache)
+                    counts[rows[i]] = self._site_counts(self.sites[i], read_data)
+
+        return np.array(sites, dtype=np.int64), counts
+
+    def _get_site_table(self):
+        """
+        Table of the chrom, pos, ref and alt of every site, in order.
+        """
+
+        return self.sites.get_site_table()
+
+    def _build_pileup(self, counts):
+        """
+        Build the pileup table from the per-site counts. The columns are
+        accumulated in arrays indexed by site, the DataFrame is created
+        once, and the genotypes are called for all sites together.
+        """
+
+        pileup = self._get_site_table()
+
+        for j, col in enumerate(COUNT_COLUMNS):
+            pileup[col] = counts[:, j].astype(np.int64)
+
+        return call_genotypes(
+            pileup, self.min_coverage, self.min_homozygous_thresh,
+            self.default_genotype)
+
+    def _shard_sample(self, sample, n_shards, partial=None):
+        """
+        Split the extraction of a sample into n_shards jobs, which can be
+        extracted in parallel and merged back in site order. A job only
+        holds its shard number and, for a partial extraction, the indices
+        of the sites and regions it lists: each worker groups the sites
+        into windows and picks its own shard (see _get_shard_windows), so
+        the jobs stay small and the BAM files are only opened by the
+        workers.
+        """
+
+        if partial is not None:
+            sites = np.asarray(partial['sites'], dtype=np.int64)
+            regions = partial['regions']
+            n_sites = len(sites)
+        else:
+            sites = None
+            regions = None
+            n_sites = len(self.sites)
+
+        # the size of a job is estimated as the part of the BAM file
+        # size that corresponds to its sites
+
+        size = os.path.getsize(sample.sample_bam) * max(n_sites / n_shards, 1) / max(len(self.sites), 1)
+
+        return [
+            {
+                'sample_name': sample.sample_name,
+                'sample_bam': sample.sample_bam,
+                'shard': shard,
+                'n_shards': n_shards,
+                'sites': sites,
+                'regions': regions,
+                'size': size}
+            for shard in range(n_shards)]
+
+    def _get_shard_windows(self, windows, n_sites, shard, n_shards):
+        """
+        Get the windows of a shard of a sample. Each shard gets consecutive
+        site windows, with about the same number of sites.
+        """
+
+        shard_size = -(-n_sites // n_shards) if n_sites else 0
+        window_shards = [[]]
+        shard_sites = 0
+
+        for window in windows:
+            if shard_sites >= shard_size:
+                window_shards.append([])
+                shard_sites = 0
+            window_shards[-1].append(window)
+            shard_sites += len(window['sites'])
+
+        return window_shards[shard] if shard < len(window_shards) else []
+
+    def _shard_job(self, job):
+        """
+        Function to do the extraction steps for a single shard of a
+        sample. Supposed to be called by multiprocessing functions to
+        parallelize it. Each job opens its own alignment file.
+        """
+
+        bam = AlignmentFile(job['sample_bam'])
+
+        n_sites = len(self.sites) if job['sites'] is None else len(job['sites'])
+        windows = self._get_shard_windows(
+            self._group_sites(bam, job['sites']) if n_sites > 0 else [],
+            n_sites, job['shard'], job['n_shards'])
+
+        regions = job['regions']
+        if regions is None:
+            regions = self.regions.index if self.regions is not None else []
+        regions = list(np.array_split(np.asarray(regions), job['n_shards'])[job['shard']])
+
+        sites, counts = self._pileup(bam, windows)
+        region_counts = self._count_regions(bam, regions)
+
+        bam.close()
 
         return {
-            'chrom': site['chrom'],
-            'pos': site['end'],
-            'ref': site['ref_allele'],
-            'alt': site['alt_allele'],
-            'reads_all': total,
-            'matches': matches,
-            'mismatches': mismatches,
-            'A': allele_counts['A'],
-            'C': allele_counts['C'],
-            'T': allele_counts['T'],
-            'G': allele_counts['G'],
-            'N': allele_counts['N']
-        }
+            'sample_name': job['sample_name'],
+            'sites': sites,
+            'counts': counts,
+            'regions': regions,
+            'region_counts': region_counts}
 
-    def _extract_sites(self, sample):
+    def _load_stored_counts(self, extraction_file):
         """
-        Loop through all positions and get pileup information.
+        Read the counts of a previous extraction of a sample, aligned to
+        the current sites and regions. Returns the per-site and per-region
+        counts, and masks of the sites and regions that were found.
         """
 
-        if not self.sites:
-            return sample
+        stored = Sample()
+        stored.load_from_file(extraction_file)
+
+        site_counts = np.zeros((len(self.sites), len(COUNT_COLUMNS)), dtype=np.int32)
+        site_found = np.zeros(len(self.sites), dtype=bool)
+
+        if self.sites and stored.pileup is not None and len(stored.pileup) > 0:
+            stored_keys = pd.Index(get_site_keys(stored.pileup))
+            unique = ~stored_keys.duplicated()
+            positions = stored_keys[unique].get_indexer(get_site_keys(self._get_site_table()))
+            site_found = positions >= 0
+            site_counts[site_found] = \
+                stored.pileup[COUNT_COLUMNS].to_numpy(dtype=np.int32)[unique][positions[site_found]]
+
+        n_regions = len(self.regions) if self.regions is not None else 0
+        region_counts = np.zeros(n_regions, dtype=np.int64)
+        region_found = np.zeros(n_regions, dtype=bool)
+
+        if n_regions > 0 and stored.region_counts is not None and len(stored.region_counts) > 0:
+            stored_keys = get_region_keys(
+                stored.region_counts['chrom'], stored.region_counts['start'],
+                stored.region_counts['end'])
+            unique = ~stored_keys.duplicated()
+            positions = stored_keys[unique].get_indexer(get_region_keys(
+                self.regions[0], self.regions[1], self.regions[2]))
+            region_found = positions >= 0
+            region_counts[region_found] = \
+                stored.region_counts['count'].to_numpy(dtype=np.int64)[unique][positions[region_found]]
+
+        return site_counts, site_found, region_counts, region_found
+
+    def _get_partial_extraction(self, sample):
+        """
+        Check if a sample that needs to be extracted can be extracted
+        partially: it was completely extracted before from the same BAM
+        file and with the same parameters, and only the sites or regions
+        changed. Returns the indices of the sites and regions that are
+        missing from its previous extraction, or None if the sample needs
+        to be extracted completely. Only the indices are kept, and the
+        stored counts are read again when the sample is merged, so the
+        memory does not grow with the number of samples being extracted.
+
+        The extraction information is compared first, since it only needs
+        the completion marker, and the extraction file is only hashed when
+        the sample can be extracted partially.
+        """
 
-        # get the pileup
+        if self.overwrite:
+            return None
 
-        bam = AlignmentFile(sample.sample_bam)
-        pileup = pd.DataFrame()
+        extraction_info = sample.get_saved_extraction_info()
 
-        for site in self.sites:
+        if extraction_info is None:
+            return None
 
-            pileup_site = self._pileup(bam, site)
+        current_info = self.get_extraction_info(sample)
 
-            pileup_site = self._get_genotype_info(
-                pileup_site, site['ref_allele'], site['alt_allele'])
+        for key, value in current_info.items():
+            if key not in PARTIAL_EXTRACTION_KEYS and extraction_info.get(key) != value:
+                return None
 
-            pileup = pd.concat([pileup, pd.DataFrame([pileup_site])], ignore_index=True)
+        if not sample.is_extraction_complete():
+            return None
 
-        pileup = pileup[[
-            'chrom', 'pos', 'ref', 'alt', 'reads_all', 'matches', 'mismatches',
-            'A', 'C', 'T', 'G', 'N', 'minor_allele_freq', 'genotype_class',
-            'genotype']]
+        _, site_found, _, region_found = self._load_stored_counts(sample.extraction_file)
 
-        for col in ['pos', 'A', 'C', 'T', 'G', 'N', 'matches', 'mismatches', 'reads_all']:
-            pileup[col] = pileup[col].astype(int)
+        partial = {
+            'sites': np.flatnonzero(~site_found).tolist(),
+            'regions': list(self.regions.index[~region_found]) if self.regions is not None else []}
 
-        sample.pileup = pileup
+        logger.info('Extracting {} new sites and {} new regions of {}.'.format(
+            len(partial['sites']), len(partial['regions']), sample.sample_name))
 
-        return sample
+        return partial
 
-    def _extraction_job(self, sample):
+    def _merge_shards(self, sample, results, partial=None):
         """
-        Function to do the extraction steps for a single sample.
-        Supposed to be called by multiprocessing functions to parallelize it.
+        Merge the shard results of a sample back in site order, and build
+        its pileup and region counts. For a partial extraction, the counts
+        of the other sites and regions are taken from the previous
+        extraction of the sample.
         """
 
-        sample = self._extract_sites(sample)
-        sample = self._extract_regions(sample)
-        sample.save_to_file()
+        if partial is not None:
+            site_counts, _, region_counts, _ = self._load_stored_counts(sample.extraction_file)
+
+        if self.sites:
+            counts = site_counts if partial is not None else \
+                np.zeros((len(self.sites), len(COUNT_COLUMNS)), dtype=np.int32)
+            for result in results:
+                counts[result['sites']] = result['counts']
+
+            sample.pileup = self._build_pileup(counts)
+
+        if self.regions is not None:
+            if partial is None:
+                region_counts = np.zeros(len(self.regions), dtype=np.int64)
+            positions = {i: j for j, i in enumerate(self.regions.index)}
+            for result in results:
+                for i, count in zip(result['regions'], result['region_counts']):
+                    region_counts[positions[i]] = count
+
+            sample.region_counts = self._build_region_counts(region_counts)
 
         return sample
 
+    def get_extraction_info(self, sample):
+        """
+        Information about the inputs of the extraction of a sample: the
+        size and mtime of its BAM file (and of the BAM index), the hashes
+        of the site panel and of the BED file, and the parameters.
+        """
+
+        bam_stat = os.stat(sample.sample_bam)
+        bam_index_file = get_bam_index_file(sample.sample_bam)
+
+        return {
+            'bam_size': bam_stat.st_size,
+            'bam_mtime': bam_stat.st_mtime,
+            'bam_index_mtime': os.path.getmtime(bam_index_file) if bam_index_file is not None else None,
+            'panel_hash': self.panel_hash,
+            'regions_hash': self.regions_hash,
+            'min_mapping_quality': self.min_mapping_quality,
+            'min_base_quality': self.min_base_quality,
+            'min_coverage': self.min_coverage,
+            'min_homozygous_thresh': self.min_homozygous_thresh,
+            'default_genotype': self.default_genotype}
+
+    def _needs_extraction(self, sample):
+        """
+        Check if a sample needs to be extracted. When resuming, the output
+        of a sample is only reused if its completion marker shows that it
+        was completely saved.
+
+        A sample that was already extracted is extracted again if its BAM
+        file, the sites, the regions or the parameters changed since then
+        (as recorded in its completion marker). Samples extracted before
+        this information was recorded are not checked.
+        """
+
+        if self.overwrite:
+            return True
+        elif self.resume:
+            if not sample.is_extraction_complete():
+                return True
+        elif not os.path.exists(sample.extraction_file):
+            return True
+
+        extraction_info = sample.get_saved_extraction_info()
+
+        if extraction_info is None or extraction_info == self.get_extraction_info(sample):
+            return False
+
+        logger.info('The inputs of {} changed since it was extracted, extracting it again.'.format(
+            sample.sample_name))
+
+        return True
+
+    def extract_iter(self, samples):
+        """
+        Extract the pileup and region information for the given samples,
+        and yield each sample as soon as it is extracted and saved to the
+        database. Samples that were already extracted are skipped (unless
+        overwrite is set). Nothing is kept once a sample is yielded, so
+        the caller can drop it to keep memory flat.
+        """
+
+        if type(samples) == dict:
+            samples = list(samples.values())
+
+        samples_to_extract = [
+            sample for sample in samples if self._needs_extraction(sample)]
+
+        if self.resume:
+            logger.info(
+                'Resuming: {} samples are already extracted, {} samples are missing or incomplete.'.format(
+                    len(samples) - len(samples_to_extract), len(samples_to_extract)))
+
+        return self._extract_samples(samples_to_extract)
+
+    def _extract_samples(self, samples_to_extract):
+        """
+        Extract the given samples, which were already checked to need
+        extraction, and yield each sample once it is saved.
+        """
+
+        if len(samples_to_extract) == 0:
+            return
+
+        partial = {}
+
+        for sample in samples_to_extract:
+            partial[sample.sample_name] = self._get_partial_extraction(sample)
+            sample.extraction_info = self.get_extraction_info(sample)
+
+        # If there are fewer samples than threads, then each sample is
+        # split into several shards. The largest jobs are started first,
+        # and each sample is saved as soon as all its shards are done.
+
+        n_shards = -(-self.threads // len(samples_to_extract))
+
+        jobs = []
+        for sample in samples_to_extract:
+            jobs += self._shard_sample(sample, n_shards, partial[sample.sample_name])
+
+        jobs = sorted(jobs, key=lambda job: job['size'], reverse=True)
+
+        pending = {sample.sample_name: sample for sample in samples_to_extract}
+        n_pending_jobs = {sample.sample_name: 0 for sample in samples_to_extract}
+        sample_results = {sample.sample_name: [] for sample in samples_to_extract}
+        summary_file = samples_to_extract[0].summary_file
+
+        for job in jobs:
+            n_pending_jobs[job['sample_name']] += 1
+
+        start_time = time.time()
+        n_done = 0
+        bytes_done = 0
+
+        # the pool is terminated if extracting a sample fails or the caller
+        # stops iterating, and the FP summary shards of the samples that
+        # were saved are always merged
+
+        try:
+            with Pool(
+                    self.threads, initializer=init_extraction_worker,
+                    initargs=(self,)) as thread_pool:
+
+                for result in thread_pool.imap_unordered(run_shard_job, jobs, chunksize=1):
+
+                    sample_name = result['sample_name']
+                    sample_results[sample_name].append(result)
+                    n_pending_jobs[sample_name] -= 1
+
+                    if n_pending_jobs[sample_name] > 0:
+                        continue
+
+                    sample = self._merge_shards(
+                        pending.pop(sample_name), sample_results.pop(sample_name),
+                        partial.pop(sample_name))
+                    sample.save_to_file()
+
+                    n_done += 1
+                    bytes_done += os.path.getsize(sample.sample_bam)
+                    elapsed = max(time.time() - start_time, 1e-6)
+
+                    logger.info(
+                        'Extracted {} ({}/{}). Elapsed: {:.1f}s, throughput: {:.2f} samples/min, {:.1f} MB/s.'.format(
+                            sample_name, n_done, len(samples_to_extract), elapsed,
+                            60 * n_done / elapsed, bytes_done / 1e6 / elapsed))
+
+                    yield sample
+
+                thread_pool.close()
+                thread_pool.join()
+        finally:
+            consolidate_fp_summary(summary_file)
+
     def extract(self, samples):
         """
         Function to call to extract the pileup and region information
@@ -329,30 +812,17 @@ class Extract:
         if type(samples) != dict:
             samples = {samples.sample_name: samples}
 
-        # determine with samples need to be extracted, and put them in a list
+        # if extraction file exists then load it, otherwise extract it
 
         samples_to_extract = []
 
         for sample_name, sample in samples.items():
-
-            # if extraction file exists then load it
-
-            if os.path.exists(sample.extraction_file) and not self.overwrite:
+            if self._needs_extraction(sample):
+                samples_to_extract.append(sample)
+            else:
                 sample.load_from_file()
-                continue
-
-            samples_to_extract.append(sample)
-
-        # if any samples need to be extracted, then do so
-        # (using multiprocessing)
-
-        if len(samples_to_extract) > 0:
-
-            thread_pool = Pool(self.threads)
-            samples_processed = thread_pool.map(
-                self._extraction_job, samples_to_extract)
 
-            for sample in samples_processed:
-                samples[sample.sample_name] = sample
+        for sample in self._extract_samples(samples_to_extract):
+            samples[sample.sample_name] = sample
 
         return samples
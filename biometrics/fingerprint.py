@@ -0,0 +1,190 @@
+import hashlib
+
+import numpy as np
+
+from biometrics.utils import atomic_write
+
+
+# number of set bits in each possible byte value
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# comparison counts computed by compare_fingerprints
+COMPARISON_COUNTS = [
+    'CountOfCommonSites', 'HomozygousInRef', 'TotalMatch', 'HomozygousMatch',
+    'HeterozygousMatch', 'HomozygousMismatch', 'HeterozygousMismatch']
+
+
+def get_site_keys(pileup):
+    """
+    Key of every site of a pileup table (chrom:pos:ref:alt).
+    """
+
+    return pileup['chrom'].astype(str) + ':' + pileup['pos'].astype(str) + ':' + \
+        pileup['ref'].astype(str) + ':' + pileup['alt'].astype(str)
+
+
+def get_panel_hash(pileup):
+    """
+    Hash of the site panel (chrom, pos, ref and alt of every site, in
+    order). Fingerprints can only be compared if their panels match.
+    """
+
+    return hashlib.sha1('\n'.join(get_site_keys(pileup)).encode()).hexdigest()
+
+
+def popcount(x):
+    """
+    Count the set bits along the last axis of a uint64 array.
+    """
+
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).sum(axis=-1, dtype=np.int64)
+
+    x = x.view(np.uint8).reshape(x.shape[:-1] + (-1,))
+
+    return POPCOUNT_TABLE[x].sum(axis=-1, dtype=np.int64)
+
+
+class Fingerprint:
+    """
+    Compact genotype fingerprint of a sample. Each site is encoded with a
+    2-bit genotype code (homozygous ref, homozygous alt or heterozygous)
+    and a called/uncalled bit. The codes are stored as bit planes packed
+    8 sites per byte:
+
+    * called: the site has a genotype call
+    * het: the call is heterozygous
+    * alt: the call is homozygous for the alt allele
+    """
+
+    def __init__(self, sample_name=None, sample_group=None, panel_hash=None,
+                 n_sites=0, called=None, het=None, alt=None):
+        self.sample_name = sample_name
+        self.sample_group = sample_group
+        self.panel_hash = panel_hash
+        self.n_sites = n_sites
+        self.called = called
+        self.het = het
+        self.alt = alt
+
+    @classmethod
+    def from_pileup(cls, pileup, sample_name=None, sample_group=None):
+        """
+        Encode the genotype calls of a pileup table.
+        """
+
+        called = pileup['genotype_class'].notna().to_numpy()
+        het = called & (pileup['genotype_class'] == 'Het').to_numpy()
+        alt = called & ~het & (pileup['genotype'] == pileup['alt']).to_numpy()
+
+        return cls(
+            sample_name=sample_name,
+            sample_group=sample_group,
+            panel_hash=get_panel_hash(pileup),
+            n_sites=len(pileup),
+            called=np.packbits(called),
+            het=np.packbits(het),
+            alt=np.packbits(alt))
+
+    @property
+    def digest(self):
+        """
+        Hash of the fingerprint contents, which changes whenever the panel
+        or any genotype call changes.
+        """
+
+        sha1 = hashlib.sha1(self.panel_hash.encode())
+        for plane in [self.called, self.het, self.alt]:
+            sha1.update(plane.tobytes())
+
+        return sha1.hexdigest()
+
+    def save(self, fingerprint_file):
+
+        with atomic_write(fingerprint_file) as fh:
+            np.savez(
+                fh,
+                sample_name=np.array(self.sample_name, dtype=object),
+                sample_group=np.array(self.sample_group, dtype=object),
+                panel_hash=np.array(self.panel_hash),
+                n_sites=np.array(self.n_sites),
+                called=self.called,
+                het=self.het,
+                alt=self.alt)
+
+    def load(self, fingerprint_file):
+
+        with np.load(fingerprint_file, allow_pickle=True) as data:
+            self.sample_name = data['sample_name'].item()
+            self.sample_group = data['sample_group'].item()
+            self.panel_hash = str(data['panel_hash'])
+            self.n_sites = int(data['n_sites'])
+            self.called = data['called']
+            self.het = data['het']
+            self.alt = data['alt']
+
+        return self
+
+
+def stack_fingerprints(fingerprints):
+    """
+    Stack the bit planes of several fingerprints into (samples x words)
+    matrices of 64-bit words. The fingerprints must all use the same site
+    panel.
+    """
+
+    panel_hashes = set(fp.panel_hash for fp in fingerprints)
+
+    assert len(panel_hashes) <= 1, \
+        'Samples must be extracted with the same set of sites to be compared.'
+
+    n_bytes = len(fingerprints[0].called) if fingerprints else 0
+    n_words = -(-n_bytes // 8)
+
+    def stack(plane):
+        stacked = np.zeros((len(fingerprints), n_words * 8), dtype=np.uint8)
+        for i, fp in enumerate(fingerprints):
+            stacked[i, :n_bytes] = getattr(fp, plane)
+
+        return stacked.view(np.uint64)
+
+    called = stack('called')
+    het = stack('het')
+
+    return {
+        'called': called,
+        'het': het,
+        'hom': called & ~het,
+        'alt': stack('alt')}
+
+
+def compare_fingerprints(ref, query):
+    """
+    Compute the comparison counts between every reference and query
+    fingerprint with AND/XOR and popcount over the packed bit planes.
+    Takes the output of stack_fingerprints and returns a dict of
+    (n_ref x n_query) count matrices, keyed by COMPARISON_COUNTS.
+    """
+
+    counts = {
+        col: np.zeros((len(ref['called']), len(query['called'])), dtype=np.int64)
+        for col in COMPARISON_COUNTS}
+
+    for i in range(len(ref['called'])):
+
+        common = ref['called'][i] & query['called']
+        hom_in_ref = ref['hom'][i] & query['called']
+        hom_match = ref['hom'][i] & query['hom']
+
+        counts['CountOfCommonSites'][i] = popcount(common)
+        counts['HomozygousInRef'][i] = popcount(hom_in_ref)
+        counts['HomozygousMatch'][i] = popcount(hom_match)
+        counts['HeterozygousMatch'][i] = popcount(ref['het'][i] & query['het'])
+        counts['HomozygousMismatch'][i] = popcount(
+            hom_match & (ref['alt'][i] ^ query['alt']))
+        counts['HeterozygousMismatch'][i] = popcount(
+            common & (ref['het'][i] ^ query['het']))
+
+    counts['TotalMatch'] = counts['HomozygousMatch'] + counts['HeterozygousMatch']
+
+    return counts
@@ -1,19 +1,39 @@
 import os
-from multiprocessing import Pool
+from functools import partial
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
 
+from biometrics.fingerprint import stack_fingerprints, compare_fingerprints, COMPARISON_COUNTS
+from biometrics.comparison_cache import ComparisonCache
 from biometrics.utils import get_logger
 
 EPSILON = 1e-9
+
+# number of 64-site words of the fingerprints used by the top-k prefilter,
+# how many candidates per top-k match it keeps, and how far above the
+# discordance threshold an estimate can be and still be kept
+SKETCH_WORDS = 8
+SKETCH_CANDIDATE_FACTOR = 4
+SKETCH_MARGIN = 0.1
+
+# maximum number of sample pairs compared at once when writing the
+# comparisons in blocks
+COMPARISON_BLOCK_PAIRS = 1000000
+
+# approximate peak memory used per compared pair of samples, including the
+# comparison table, which is used to size the blocks to --max-memory
+COMPARISON_PAIR_BYTES = 300
 logger = get_logger()
 
 
 class Genotyper:
 
-    def __init__(self, no_db_compare, discordance_threshold=0.05, threads=1, zmin=None, zmax=None, het=False):
+    def __init__(self, no_db_compare, discordance_threshold=0.05, threads=1, zmin=None, zmax=None, het=False,
+                 comparison_cache=None):
         self.no_db_compare = no_db_compare
         self.discordance_threshold = discordance_threshold
         self.threads = threads
@@ -22,6 +42,10 @@ class Genotyper:
         self.sample_type_ratio = 1
         self.comparisons = None
         self.het = het
+        self.comparison_cache = None
+
+        if comparison_cache is not None:
+            self.comparison_cache = ComparisonCache(comparison_cache)
 
     def are_samples_same_group(self, sample1, sample2):
 
@@ -33,6 +57,28 @@ class Genotyper:
         else:
             return False
 
+    def _are_groups_same(self, groups1, groups2):
+        """
+        Vectorized version of are_samples_same_group for two columns of
+        sample groups.
+        """
+
+        groups1 = groups1.to_numpy(dtype=object)
+        groups2 = groups2.to_numpy(dtype=object)
+
+        same_group = groups1 == groups2
+        missing = np.array(
+            [group1 is None or group2 is None for group1, group2 in zip(groups1, groups2)],
+            dtype=bool)
+
+        if not missing.any():
+            return same_group
+
+        same_group = same_group.astype(object)
+        same_group[missing] = np.nan
+
+        return same_group
+
     def _plot_heatmap(self, data, outdir, name, title="Discordance calculations between samples", size_ratio=None):
 
         width = None
@@ -159,99 +205,310 @@ class Genotyper:
 
         return row
 
-    def _compute_discordance_batch_job(self, batch_sample_pairs):
+    def _compare_fingerprints(self, fingerprints1, fingerprints2):
+        """
+        Get the comparison counts between two lists of fingerprints. If
+        there is a comparison cache, only the pairs that are not cached
+        are computed, and they are then added to the cache.
+        """
+
+        if self.comparison_cache is None:
+            return compare_fingerprints(
+                stack_fingerprints(fingerprints1), stack_fingerprints(fingerprints2))
+
+        digests1 = [fp.digest for fp in fingerprints1]
+        digests2 = [fp.digest for fp in fingerprints2]
+
+        counts, found = self.comparison_cache.lookup(digests1, digests2)
+
+        # compare the references and queries that have any missing pair
+
+        rows = np.flatnonzero(~found.all(axis=1))
+        cols = np.flatnonzero(~found.all(axis=0))
+
+        if len(rows) > 0 and len(cols) > 0:
+            new_counts = compare_fingerprints(
+                stack_fingerprints([fingerprints1[i] for i in rows]),
+                stack_fingerprints([fingerprints2[j] for j in cols]))
+
+            for col in COMPARISON_COUNTS:
+                counts[col][np.ix_(rows, cols)] = new_counts[col]
+
+            self.comparison_cache.add(
+                [digests1[i] for i in rows], [digests2[j] for j in cols], new_counts)
+
+        logger.info('{} of {} comparisons were found in the comparison cache.'.format(
+            found.sum(), found.size))
+
+        return counts
+
+    def _build_comparisons(self, sample_names1, sample_names2, ref_idx, query_idx, counts, samples):
         """
-        batch job to take a batch of pairs of samples to compute discordance
+        Build the comparison table for the given pairs of reference
+        samples (indices into sample_names1) and query samples (indices
+        into sample_names2), from their comparison counts (one value per
+        pair).
         """
-        rows = []
 
-        for reference_sample, query_sample in batch_sample_pairs:
-            rows.append(self._compute_discordance(
-                reference_sample, query_sample))
+        groups1 = np.array([samples[name].sample_group for name in sample_names1], dtype=object)
+        groups2 = np.array([samples[name].sample_group for name in sample_names2], dtype=object)
+
+        comparisons = pd.DataFrame({
+            'ReferenceSample': np.asarray(sample_names1, dtype=object)[ref_idx],
+            'ReferenceSampleGroup': groups1[ref_idx],
+            'QuerySample': np.asarray(sample_names2, dtype=object)[query_idx],
+            'QuerySampleGroup': groups2[query_idx]})
+
+        # if there are no regions with enough coverage, the counts are NA
+
+        common = counts['CountOfCommonSites']
+        no_common_sites = common == 0
 
-        return rows
+        for col in COMPARISON_COUNTS:
+            if col == 'CountOfCommonSites':
+                continue
+
+            val = counts[col]
+            if no_common_sites.any():
+                val = val.astype(float)
+                val[no_common_sites] = np.nan
+            comparisons[col] = val
+
+        comparisons['CountOfCommonSites'] = common
+
+        return comparisons
 
     def _compare_sample_lists(self, sample_set1, sample_set2, samples):
         """
-        Compare two lists of samples. Does so by first grouping the sample
-        comparisons into batches for parallel processing
+        Compare two lists of samples. All pairs are compared at once using
+        the samples' packed genotype fingerprints.
+        """
+
+        sample_names1 = list(sample_set1)
+        sample_names2 = list(sample_set2)
+
+        fingerprints1 = [samples[name].get_fingerprint() for name in sample_names1]
+        fingerprints2 = [samples[name].get_fingerprint() for name in sample_names2]
+
+        assert len(set(fp.panel_hash for fp in fingerprints1 + fingerprints2)) <= 1, \
+            'Samples must be extracted with the same set of sites to be compared.'
+
+        counts = self._compare_fingerprints(fingerprints1, fingerprints2)
+
+        return self._build_comparisons(
+            sample_names1, sample_names2,
+            np.repeat(np.arange(len(sample_names1)), len(sample_names2)),
+            np.tile(np.arange(len(sample_names2)), len(sample_names1)),
+            {col: val.ravel() for col, val in counts.items()},
+            samples)
+
+    def _get_discordance(self, counts):
+        """
+        Discordance rate computed from comparison counts (arrays), in the
+        same way as _add_discordance. NaN if it can not be computed.
         """
 
-        jobs = []
-        thread_pool = Pool(self.threads)
-        total_comparisons = len(sample_set1) * len(sample_set2)
-        parallel_batch_size = max(int(total_comparisons / self.threads), 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.het:
+                discordance = (counts['HomozygousMismatch'] + counts['HeterozygousMismatch']) / \
+                    (counts['TotalMatch'] + EPSILON)
+            else:
+                discordance = counts['HomozygousMismatch'] / (counts['HomozygousInRef'] + EPSILON)
 
-        current_batch = []
+        return np.where(counts['HomozygousInRef'] < 10, np.nan, discordance)
 
-        for i, sample_name1 in enumerate(sample_set1):
-            for j, sample_name2 in enumerate(sample_set2):
-                current_batch.append([samples[sample_name1], samples[sample_name2]])
+    def _find_candidates(self, ref, query, k):
+        """
+        Prefilter the query samples for each reference sample using a
+        sketch of the fingerprints: the discordance is first estimated on
+        a sample of SKETCH_WORDS evenly spaced 64-site words. For each
+        reference, the candidates are the SKETCH_CANDIDATE_FACTOR * k
+        queries with the lowest estimate, plus all queries whose estimate
+        is within SKETCH_MARGIN of the discordance threshold or that can
+        not be estimated. Returns a list of candidate indices per
+        reference.
+        """
 
-                if len(current_batch) >= parallel_batch_size:
-                    jobs.append(current_batch)
-                    current_batch = []
+        n_words = ref['called'].shape[1]
+        n_query = query['called'].shape[0]
 
-        # add any remaining jobs
+        if n_words <= 2 * SKETCH_WORDS or n_query <= SKETCH_CANDIDATE_FACTOR * k:
+            return [np.arange(n_query)] * ref['called'].shape[0]
 
-        if len(current_batch) > 0:
-            jobs.append(current_batch)
+        words = np.unique(np.linspace(0, n_words - 1, SKETCH_WORDS).astype(int))
 
-        # analyze, collect results, and flatten the lists
+        ref_sketch = {plane: bits[:, words] for plane, bits in ref.items()}
+        query_sketch = {plane: bits[:, words] for plane, bits in query.items()}
 
-        results = thread_pool.map(self._compute_discordance_batch_job, jobs)
-        results = [item for sublist in results for item in sublist]
+        discordance = self._get_discordance(
+            compare_fingerprints(ref_sketch, query_sketch))
 
-        return results
+        candidates = []
 
+        for estimate in discordance:
+            ranked = np.argsort(np.where(np.isnan(estimate), np.inf, estimate), kind='stable')
+            keep = np.zeros(n_query, dtype=bool)
+            keep[ranked[:SKETCH_CANDIDATE_FACTOR * k]] = True
+            keep |= np.isnan(estimate) | (estimate < self.discordance_threshold + SKETCH_MARGIN)
 
-    def compare_samples(self, samples):
+            candidates.append(np.flatnonzero(keep))
+
+        return candidates
+
+    def _query_index(self, index, fingerprints1, sample_names2):
+        """
+        Get the candidate database samples of each reference sample from
+        a fingerprint index, and the database samples that the index can
+        not be trusted with because of their uncalled sites (see
+        FingerprintIndex.get_uncertain). Returns two lists of indices per
+        reference.
+        """
+
+        positions = {name: j for j, name in enumerate(sample_names2)}
+
+        n_missing = len(set(positions) - set(index.sample_names))
+        if n_missing > 0:
+            logger.warning(
+                '{} database samples are not in the fingerprint index and will not be searched. '
+                'Run \'biometrics index\' to update it.'.format(n_missing))
+
+        def get_positions(names):
+            return np.array(sorted(positions[name] for name in names if name in positions), dtype=int)
+
+        candidates = [get_positions(index.query(fingerprint)) for fingerprint in fingerprints1]
+        uncertain = [
+            get_positions(index.get_uncertain(fingerprint, self.discordance_threshold))
+            for fingerprint in fingerprints1]
+
+        return candidates, uncertain
+
+    def _add_uncertain_candidates(self, ref, query, loaded, candidates, uncertain, k):
+        """
+        Add the candidates among the database samples that the index can
+        not be trusted with, which are prefiltered with the sketch instead
+        (see _find_candidates). The query rows are the fingerprints of the
+        database samples in loaded. Returns a list of candidate indices per
+        reference.
+        """
+
+        merged = []
+
+        for i, (candidate_idx, uncertain_idx) in enumerate(zip(candidates, uncertain)):
+
+            if len(uncertain_idx) > 0:
+                rows = np.searchsorted(loaded, uncertain_idx)
+                sketched = self._find_candidates(
+                    {plane: bits[i:i + 1] for plane, bits in ref.items()},
+                    {plane: bits[rows] for plane, bits in query.items()}, k)[0]
+                candidate_idx = np.union1d(candidate_idx, uncertain_idx[sketched])
+
+            merged.append(candidate_idx)
+
+        return merged
+
+    def find_top_matches(self, samples, k, index=None):
+        """
+        For each input sample, find the k database samples with the lowest
+        discordance rate, plus any database sample with a discordance rate
+        below the threshold. The database samples are first prefiltered
+        with a sketch of the fingerprints (see _find_candidates), or with
+        the candidates from a FingerprintIndex if one is given (and the
+        sketch for the samples that the index can not be trusted with),
+        and only the candidates are compared on all the sites.
+        """
 
-        comparisons = []
         samples_db = dict(filter(lambda x: x[1].query_group, samples.items()))
         samples_input = dict(filter(
             lambda x: not x[1].query_group, samples.items()))
 
-        # get the number of each type of sample and compute a ratio
-        # this is used to plot the heatmap when comparing with database
-        # samples
+        sample_names1 = list(samples_input)
+        sample_names2 = list(samples_db)
 
-        sample_n_db = len(samples_db)
-        sample_n_input = len(samples_input)
+        fingerprints1 = [samples[name].get_fingerprint() for name in sample_names1]
 
-        if sample_n_db > 0 and sample_n_input > 0 and sample_n_db > sample_n_input:
-            self.sample_type_ratio = sample_n_db / sample_n_input
+        if len(sample_names1) == 0 or len(sample_names2) == 0:
+            logger.warning('You need input and database samples to search for the top matches.')
 
-        # check to see if there are appropriate number of samples to
-        # do the analysis
+        # with an index, only the fingerprints of the candidates (and of the
+        # samples that the index can not be trusted with) are loaded, so the
+        # search does not scale with the size of the database
 
-        if self.no_db_compare:
-            if len(samples_input) <= 1:
-                logger.warning("You should specify 2 or more samples in order to compare genotypes.")
+        uncertain = None
+
+        if len(sample_names2) == 0:
+            candidates = [np.arange(0)] * len(sample_names1)
+            loaded = np.arange(0)
+        elif index is not None:
+            candidates, uncertain = self._query_index(index, fingerprints1, sample_names2)
+            loaded = np.unique(np.concatenate(candidates + uncertain + [np.zeros(0, dtype=int)]))
         else:
-            if len(samples_input) <= 1 and len(samples_db) < 1:
-                logger.warning("You should specify 2 or more samples in order to compare genotypes.")
+            candidates = None
+            loaded = np.arange(len(sample_names2))
 
-        # compare all the input samples to each other
+        fingerprints2 = [samples[sample_names2[j]].get_fingerprint() for j in loaded]
 
-        results = self._compare_sample_lists(
-            samples_input, samples_input, samples)
+        assert len(set(fp.panel_hash for fp in fingerprints1 + fingerprints2)) <= 1, \
+            'Samples must be extracted with the same set of sites to be compared.'
 
-        for i in range(len(results)):
-            results[i]['IsInputToDatabaseComparison'] = False
-        comparisons += results
+        ref = stack_fingerprints(fingerprints1)
+        query = stack_fingerprints(fingerprints2)
 
-        # for each input sample, compare with all the samples in the db
+        if candidates is None:
+            candidates = self._find_candidates(ref, query, k)
+        elif uncertain is not None:
+            candidates = self._add_uncertain_candidates(ref, query, loaded, candidates, uncertain, k)
 
-        if not self.no_db_compare and sample_n_db > 0:
-            results = self._compare_sample_lists(
-                samples_input, samples_db, samples)
+        logger.info('Comparing {} of {} input/database sample pairs after prefiltering.'.format(
+            sum(len(c) for c in candidates), len(sample_names1) * len(sample_names2)))
+
+        ref_idx = []
+        query_idx = []
+        counts = {col: [] for col in COMPARISON_COUNTS}
+
+        for i, candidate_idx in enumerate(candidates):
+
+            if len(candidate_idx) == 0:
+                continue
 
-            for i in range(len(results)):
-                results[i]['IsInputToDatabaseComparison'] = True
-            comparisons += results
+            pair_counts = compare_fingerprints(
+                {plane: bits[i:i + 1] for plane, bits in ref.items()},
+                {plane: bits[np.searchsorted(loaded, candidate_idx)] for plane, bits in query.items()})
+            pair_counts = {col: val[0] for col, val in pair_counts.items()}
 
-        comparisons = pd.DataFrame(comparisons)
+            # keep the top k and any below the discordance threshold
+
+            discordance = self._get_discordance(pair_counts)
+            ranked = np.argsort(np.where(np.isnan(discordance), np.inf, discordance), kind='stable')
+            keep = np.zeros(len(candidate_idx), dtype=bool)
+            keep[ranked[:k]] = True
+            keep &= ~np.isnan(discordance)
+            keep |= discordance < self.discordance_threshold
+            keep = ranked[keep[ranked]]
+
+            ref_idx.append(np.full(len(keep), i))
+            query_idx.append(candidate_idx[keep])
+            for col in COMPARISON_COUNTS:
+                counts[col].append(pair_counts[col][keep])
+
+        comparisons = self._build_comparisons(
+            sample_names1, sample_names2,
+            np.concatenate(ref_idx + [np.zeros(0, dtype=int)]).astype(int),
+            np.concatenate(query_idx + [np.zeros(0, dtype=int)]).astype(int),
+            {col: np.concatenate(val + [np.zeros(0, dtype=np.int64)]) for col, val in counts.items()},
+            samples)
+        comparisons['IsInputToDatabaseComparison'] = True
+
+        self.comparisons = self._add_discordance(comparisons)
+
+        logger.info('Total top matches: {}'.format(len(self.comparisons)))
+
+        return self.comparisons
+
+    def _add_discordance(self, comparisons):
+        """
+        Compute the discordance rate of each comparison, and whether the
+        match/mismatch is expected or not.
+        """
 
         # compute discordance rate
         if self.het:
@@ -267,10 +524,8 @@ class Genotyper:
 
         comparisons.loc[comparisons['ReferenceSample']==comparisons['QuerySample'], 'DiscordanceRate'] = 0
         comparisons['Matched'] = comparisons['DiscordanceRate'] < self.discordance_threshold
-        comparisons['ExpectedMatch'] = comparisons.apply(
-            lambda x: self.are_samples_same_group(
-                samples[x['ReferenceSample']],
-                samples[x['QuerySample']]), axis=1)
+        comparisons['ExpectedMatch'] = self._are_groups_same(
+            comparisons['ReferenceSampleGroup'], comparisons['QuerySampleGroup'])
 
         comparisons['Status'] = ''
         comparisons.loc[comparisons['Matched'] & comparisons['ExpectedMatch'], 'Status'] = "Expected Match"
@@ -281,12 +536,171 @@ class Genotyper:
             ~comparisons['Matched'] & ~comparisons['ExpectedMatch'], 'Status'] = "Expected Mismatch"
         comparisons.loc[pd.isna(comparisons['DiscordanceRate']), 'Status'] = ''
 
-
-        self.comparisons = comparisons[[
+        return comparisons[[
             'ReferenceSample', 'ReferenceSampleGroup', 'QuerySample', 'QuerySampleGroup', 'IsInputToDatabaseComparison', 'CountOfCommonSites', 'HomozygousInRef', 'TotalMatch', 'HomozygousMatch', 'HeterozygousMatch', 'HomozygousMismatch',
             'HeterozygousMismatch', 'DiscordanceRate', 'Matched',
             'ExpectedMatch', 'Status']]
 
+    def _get_block_shape(self, n_query, fingerprint_size, max_memory):
+        """
+        Number of reference and query samples in each block of
+        comparisons. Without a memory budget, each block has all the query
+        samples and up to COMPARISON_BLOCK_PAIRS pairs. Otherwise, the
+        blocks are about square and sized so that each thread's block (the
+        fingerprints and the comparison table) fits in max_memory / threads
+        bytes.
+        """
+
+        if max_memory is None:
+            return max(1, COMPARISON_BLOCK_PAIRS // max(n_query, 1)), max(n_query, 1)
+
+        budget = max_memory / self.threads
+        n_query_block = int(min(n_query, max(1, np.sqrt(budget / COMPARISON_PAIR_BYTES))))
+        n_ref_block = int(max(1, (budget - n_query_block * fingerprint_size) // (
+            n_query_block * COMPARISON_PAIR_BYTES + fingerprint_size)))
+
+        return n_ref_block, max(n_query_block, 1)
+
+    def _compare_block(self, samples, writer, block):
+        """
+        Compare one block of reference and query samples and write it. The
+        fingerprints of the samples must already be loaded.
+        """
+
+        i, sample_names1, sample_names2, is_input_to_database = block
+
+        comparisons = self._compare_sample_lists(sample_names1, sample_names2, samples)
+        comparisons['IsInputToDatabaseComparison'] = is_input_to_database
+
+        writer.write(self._add_discordance(comparisons), i)
+
+    def write_comparisons(self, samples, writer, max_memory=None):
+        """
+        Compare the samples in the same way as compare_samples, but one
+        block of samples at a time, and write each block with the given
+        ComparisonWriter instead of keeping all the comparisons in memory.
+        If max_memory (in bytes) is given, the blocks are sized to fit in
+        it, and database samples that were loaded lazily only have their
+        fingerprints loaded for the blocks that are being compared. Blocks
+        are compared in parallel with the genotyper's threads.
+        """
+
+        samples_db = dict(filter(lambda x: x[1].query_group, samples.items()))
+        samples_input = dict(filter(
+            lambda x: not x[1].query_group, samples.items()))
+
+        sample_names1 = list(samples_input)
+        query_sets = [(list(samples_input), False)]
+
+        if not self.no_db_compare and len(samples_db) > 0:
+            query_sets.append((list(samples_db), True))
+
+        fingerprint_size = 0
+        if len(sample_names1) > 0:
+            # the packed planes of the fingerprint, and its 4 stacked planes
+            fingerprint_size = 7 * len(samples[sample_names1[0]].get_fingerprint().called)
+
+        def get_blocks():
+            i = 0
+            for sample_names2, is_input_to_database in query_sets:
+
+                n_ref_block, n_query_block = self._get_block_shape(
+                    len(sample_names2), fingerprint_size, max_memory)
+
+                for ref_start in range(0, len(sample_names1), n_ref_block):
+                    for query_start in range(0, len(sample_names2), n_query_block):
+                        yield (
+                            i,
+                            sample_names1[ref_start:ref_start + n_ref_block],
+                            sample_names2[query_start:query_start + n_query_block],
+                            is_input_to_database)
+                        i += 1
+
+        def get_batch_samples(batch):
+            return set(
+                sample_name for block in batch for sample_name in block[1] + block[2])
+
+        compare_block = partial(self._compare_block, samples, writer)
+        blocks = get_blocks()
+
+        # the comparisons and the compression of the output are mostly
+        # numpy and zlib calls that release the GIL, so blocks are compared
+        # and written in threads, one batch of blocks at a time. The blocks
+        # of a batch share samples, so their fingerprints are loaded before
+        # the batch is compared, and only unloaded once no block of the
+        # next batch uses them.
+
+        with ThreadPool(self.threads) as pool:
+            batch = list(islice(blocks, self.threads))
+
+            while len(batch) > 0:
+                batch_samples = get_batch_samples(batch)
+                pool.map(lambda sample_name: samples[sample_name].get_fingerprint(), sorted(batch_samples))
+                pool.map(compare_block, batch)
+
+                batch = list(islice(blocks, self.threads))
+
+                if max_memory is not None:
+                    for sample_name in batch_samples - get_batch_samples(batch):
+                        samples[sample_name].unload_fingerprint()
+
+        if self.comparison_cache is not None:
+            self.comparison_cache.save()
+
+        writer.close()
+
+    def compare_samples(self, samples):
+
+        comparisons = []
+        samples_db = dict(filter(lambda x: x[1].query_group, samples.items()))
+        samples_input = dict(filter(
+            lambda x: not x[1].query_group, samples.items()))
+
+        # get the number of each type of sample and compute a ratio
+        # this is used to plot the heatmap when comparing with database
+        # samples
+
+        sample_n_db = len(samples_db)
+        sample_n_input = len(samples_input)
+
+        if sample_n_db > 0 and sample_n_input > 0 and sample_n_db > sample_n_input:
+            self.sample_type_ratio = sample_n_db / sample_n_input
+
+        # check to see if there are appropriate number of samples to
+        # do the analysis
+
+        if self.no_db_compare:
+            if len(samples_input) <= 1:
+                logger.warning("You should specify 2 or more samples in order to compare genotypes.")
+        else:
+            if len(samples_input) <= 1 and len(samples_db) < 1:
+                logger.warning("You should specify 2 or more samples in order to compare genotypes.")
+
+        # compare all the input samples to each other
+
+        results = self._compare_sample_lists(
+            samples_input, samples_input, samples)
+
+        results['IsInputToDatabaseComparison'] = False
+        comparisons.append(results)
+
+        # for each input sample, compare with all the samples in the db
+
+        if not self.no_db_compare and sample_n_db > 0:
+            results = self._compare_sample_lists(
+                samples_input, samples_db, samples)
+
+            results['IsInputToDatabaseComparison'] = True
+            comparisons.append(results)
+
+        comparisons = pd.concat(comparisons, ignore_index=True)
+
+        if self.comparison_cache is not None:
+            self.comparison_cache.save()
+
+        self.comparisons = self._add_discordance(comparisons)
+        comparisons = self.comparisons
+
         logger.info('Total comparisons: {}'.format(len(comparisons)))
         logger.info('Count of expected matches: {}'.format(
             len(comparisons[comparisons['Status']=="Expected Match"])))
@@ -0,0 +1,272 @@
+import os
+
+import numpy as np
+
+from biometrics.fingerprint import stack_fingerprints, compare_fingerprints
+from biometrics.utils import atomic_write, get_logger
+
+logger = get_logger()
+
+INDEX_FILE = 'fingerprint_index.npz'
+
+# MinHash signature size, and number of signature values per LSH band.
+# Two samples become candidates if all the values of any band agree, so
+# with a Jaccard similarity J the probability is
+# 1 - (1 - J^BAND_SIZE)^(NUM_HASHES / BAND_SIZE).
+NUM_HASHES = 126
+BAND_SIZE = 6
+
+# signature of a fingerprint without any homozygous call
+EMPTY_SIGNATURE = np.iinfo(np.uint32).max
+
+# smallest probability that a matching database sample is returned by the
+# LSH buckets for the index to be trusted with it (see get_uncertain)
+MIN_INDEX_RECALL = 0.99
+
+
+def get_index_file(database):
+    return os.path.join(database, INDEX_FILE)
+
+
+def get_homozygous_tokens(fingerprint):
+    """
+    Tokens for the homozygous calls of a fingerprint: one token per
+    homozygous site, which is different for ref and alt calls.
+    """
+
+    called = np.unpackbits(fingerprint.called)[:fingerprint.n_sites].astype(bool)
+    het = np.unpackbits(fingerprint.het)[:fingerprint.n_sites].astype(bool)
+    alt = np.unpackbits(fingerprint.alt)[:fingerprint.n_sites].astype(np.uint64)
+
+    sites = np.flatnonzero(called & ~het).astype(np.uint64)
+
+    return sites * 2 + alt[sites]
+
+
+def get_call_rate(fingerprint):
+    """
+    Fraction of the sites of a fingerprint that have a genotype call.
+    """
+
+    if fingerprint.n_sites == 0:
+        return 0.0
+
+    return np.unpackbits(fingerprint.called)[:fingerprint.n_sites].sum() / fingerprint.n_sites
+
+
+class FingerprintIndex:
+    """
+    MinHash/LSH index over the homozygous-site genotype tokens of the
+    database fingerprints. Samples with the same genotypes share most of
+    their tokens, so they are very likely to collide in at least one LSH
+    band, while unrelated samples rarely do. Querying only looks at the
+    buckets of the query's bands, so it does not scale with the size of
+    the database. The candidates it returns still need to be compared
+    exactly.
+
+    Only the sites called in both samples can be shared, so the token
+    similarity of two matching samples drops with their call rates, and
+    a matching sample with many uncalled sites (or a query with many
+    uncalled sites) is easily missed. The call rate of each sample is
+    kept, so the samples that the index can not be trusted with can be
+    checked in another way (see get_uncertain).
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.panel_hash = None
+        self.sample_names = []
+        self.signatures = np.zeros((0, NUM_HASHES), dtype=np.uint32)
+        self.call_rates = np.zeros(0)
+
+        # multiply-shift hash functions: the top 32 bits of a * x + b
+        # (mod 2^64), with random odd a
+
+        rng = np.random.default_rng(0)
+        self.hash_a = rng.integers(0, 1 << 63, NUM_HASHES, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.hash_b = rng.integers(0, 1 << 63, NUM_HASHES, dtype=np.uint64)
+
+        if os.path.exists(index_file):
+            with np.load(index_file, allow_pickle=False) as data:
+                self.panel_hash = str(data['panel_hash'])
+                self.sample_names = list(data['sample_names'].astype(str))
+                self.signatures = data['signatures']
+
+                if 'call_rates' in data:
+                    self.call_rates = data['call_rates']
+                else:
+                    logger.warning(
+                        'The fingerprint index {} does not have the call rates of the samples, so it is '
+                        'not used to exclude any sample. Run \'biometrics index\' to rebuild it.'.format(
+                            index_file))
+                    self.call_rates = np.full(len(self.sample_names), np.nan)
+
+        self._build_buckets()
+
+    def exists(self):
+        return os.path.exists(self.index_file)
+
+    def _get_signature(self, fingerprint):
+
+        tokens = get_homozygous_tokens(fingerprint)
+
+        if len(tokens) == 0:
+            return np.full(NUM_HASHES, EMPTY_SIGNATURE, dtype=np.uint32)
+
+        hashes = (self.hash_a[:, None] * tokens[None, :] + self.hash_b[:, None]) >> np.uint64(32)
+
+        return hashes.min(axis=1).astype(np.uint32)
+
+    def _get_band_keys(self, signature):
+
+        if (signature == EMPTY_SIGNATURE).all():
+            return []
+
+        return [
+            (band, signature[band * BAND_SIZE:(band + 1) * BAND_SIZE].tobytes())
+            for band in range(NUM_HASHES // BAND_SIZE)]
+
+    def _build_buckets(self):
+
+        self.buckets = {}
+        self.rows = {}
+
+        for row, sample_name in enumerate(self.sample_names):
+            self.rows[sample_name] = row
+            for key in self._get_band_keys(self.signatures[row]):
+                self.buckets.setdefault(key, set()).add(sample_name)
+
+    def add(self, fingerprints):
+        """
+        Add fingerprints to the index. A sample that is already in the
+        index is replaced.
+        """
+
+        new_signatures = []
+        new_call_rates = []
+
+        for fingerprint in fingerprints:
+
+            if self.panel_hash is None:
+                self.panel_hash = fingerprint.panel_hash
+
+            assert fingerprint.panel_hash == self.panel_hash, \
+                'Sample {} was extracted with a different set of sites than the index.'.format(
+                    fingerprint.sample_name)
+
+            signature = self._get_signature(fingerprint)
+            call_rate = get_call_rate(fingerprint)
+            row = self.rows.get(fingerprint.sample_name)
+
+            if row is None:
+                self.rows[fingerprint.sample_name] = len(self.sample_names)
+                self.sample_names.append(fingerprint.sample_name)
+                new_signatures.append(signature)
+                new_call_rates.append(call_rate)
+            else:
+                old_signature = self.signatures[row] if row < len(self.signatures) else \
+                    new_signatures[row - len(self.signatures)]
+                for key in self._get_band_keys(old_signature):
+                    self.buckets[key].discard(fingerprint.sample_name)
+                if row < len(self.signatures):
+                    self.signatures[row] = signature
+                    self.call_rates[row] = call_rate
+                else:
+                    new_signatures[row - len(self.signatures)] = signature
+                    new_call_rates[row - len(self.signatures)] = call_rate
+
+            for key in self._get_band_keys(signature):
+                self.buckets.setdefault(key, set()).add(fingerprint.sample_name)
+
+        if new_signatures:
+            self.signatures = np.vstack([self.signatures] + new_signatures)
+            self.call_rates = np.concatenate([self.call_rates, new_call_rates])
+
+    def query(self, fingerprint):
+        """
+        Get the names of the candidate matches of a fingerprint.
+        """
+
+        candidates = set()
+
+        for key in self._get_band_keys(self._get_signature(fingerprint)):
+            candidates.update(self.buckets.get(key, ()))
+
+        return candidates
+
+    def get_uncertain(self, fingerprint, discordance_threshold):
+        """
+        Get the names of the database samples that the index can not be
+        trusted with for the given fingerprint: if they match it, they
+        would be returned as candidates with a probability below
+        MIN_INDEX_RECALL.
+
+        For two samples with call rates c1 and c2 (and independently
+        uncalled sites), the sites called in both are a fraction
+        c1 * c2 / (c1 + c2 - c1 * c2) of the sites called in either. A
+        match may also disagree on up to discordance_threshold of the
+        shared sites, which gives the lowest token similarity of a match,
+        and so its probability to collide in an LSH band.
+        """
+
+        c1 = get_call_rate(fingerprint)
+        c2 = self.call_rates
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shared = c1 * c2 * (1 - discordance_threshold)
+            similarity = shared / (c1 + c2 - c1 * c2 + c1 * c2 * discordance_threshold)
+
+        recall = 1 - (1 - similarity ** BAND_SIZE) ** (NUM_HASHES // BAND_SIZE)
+
+        return set(self.sample_names[i] for i in np.flatnonzero(~(recall >= MIN_INDEX_RECALL)))
+
+    def save(self):
+
+        with atomic_write(self.index_file) as fh:
+            np.savez(
+                fh,
+                panel_hash=np.array(self.panel_hash or ''),
+                sample_names=np.array(self.sample_names, dtype=str),
+                signatures=self.signatures,
+                call_rates=self.call_rates)
+
+        logger.info('Saved {} samples to the fingerprint index.'.format(
+            len(self.sample_names)))
+
+
+def benchmark_index_recall(index, genotyper, query_fingerprints, database_fingerprints, k=1):
+    """
+    Measure the recall of a top k search with the index against the exact
+    all-pairs comparison: the fraction of query/database pairs with a
+    discordance rate below the genotyper's threshold that are returned as
+    candidates, either by the index or by the sketch prefilter for the
+    database samples that the index can not be trusted with. Also returns
+    the mean number of candidates per query, and the mean number of
+    database samples per query that were prefiltered with the sketch.
+    """
+
+    ref = stack_fingerprints(query_fingerprints)
+    query = stack_fingerprints(database_fingerprints)
+    discordance = genotyper._get_discordance(compare_fingerprints(ref, query))
+
+    database_names = [fp.sample_name for fp in database_fingerprints]
+    candidates, uncertain = genotyper._query_index(index, query_fingerprints, database_names)
+    candidates = genotyper._add_uncertain_candidates(
+        ref, query, np.arange(len(database_names)), candidates, uncertain, k)
+
+    n_matches = 0
+    n_found = 0
+
+    for i, candidate_idx in enumerate(candidates):
+        matches = np.flatnonzero(discordance[i] < genotyper.discordance_threshold)
+
+        n_matches += len(matches)
+        n_found += np.isin(matches, candidate_idx).sum()
+
+    n_query = max(len(query_fingerprints), 1)
+
+    return {
+        'matches': n_matches,
+        'recall': n_found / n_matches if n_matches > 0 else np.nan,
+        'candidates_per_query': sum(len(c) for c in candidates) / n_query,
+        'uncertain_per_query': sum(len(u) for u in uncertain) / n_query}
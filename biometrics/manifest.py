@@ -0,0 +1,227 @@
+import os
+import sqlite3
+from contextlib import closing
+
+import pandas as pd
+
+from biometrics.utils import get_logger
+
+logger = get_logger()
+
+MANIFEST_FILE = 'biometrics_manifest.sqlite'
+
+MANIFEST_COLUMNS = {
+    'sample_name': 'TEXT PRIMARY KEY',
+    'extraction_file': 'TEXT',
+    'sample_group': 'TEXT',
+    'sample_sex': 'TEXT',
+    'sample_type': 'TEXT',
+    'sample_bam': 'TEXT',
+    'bam_size': 'INTEGER',
+    'bam_mtime': 'REAL',
+    'bam_index_mtime': 'REAL',
+    'panel_hash': 'TEXT',
+    'regions_hash': 'TEXT',
+    'min_mapping_quality': 'INTEGER',
+    'min_base_quality': 'INTEGER',
+    'min_coverage': 'INTEGER',
+    'min_homozygous_thresh': 'REAL',
+    'default_genotype': 'TEXT',
+    'extraction_file_size': 'INTEGER',
+    'extraction_file_mtime': 'REAL',
+}
+
+
+class DatabaseManifest:
+    """
+    Catalogue of the samples in a database directory (an SQLite table),
+    so that the samples can be listed and filtered without scanning the
+    directory or opening their extraction files. For each sample it has:
+
+    * the sample information, and the path to the extraction file
+      (relative to the database directory)
+    * the size and mtime of the BAM file when it was extracted, and of
+      the extraction file when it was saved, to detect stale entries
+    * the hashes of the site panel and BED file, and the extraction
+      parameters (the extraction information of the sample)
+
+    Each update is a single transaction, so the manifest is never left
+    partially updated.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.manifest_file = os.path.join(database, MANIFEST_FILE)
+        self._entries = None
+
+    def exists(self):
+        return os.path.exists(self.manifest_file)
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.manifest_file, timeout=60))
+
+    @property
+    def entries(self):
+        """
+        The entries of the manifest, indexed by sample name. They are read
+        on first access, and again after the manifest is updated.
+        """
+
+        if self._entries is None and self.exists():
+            with self._connect() as conn:
+                entries = pd.read_sql('SELECT * FROM samples', conn)
+
+            self._entries = entries.set_index('sample_name', drop=False)
+
+        return self._entries
+
+    def _get_entry(self, sample):
+
+        extraction_file_stat = os.stat(sample.extraction_file)
+
+        entry = {
+            'sample_name': sample.sample_name,
+            'extraction_file': os.path.relpath(sample.extraction_file, self.database),
+            'sample_group': sample.sample_group,
+            'sample_sex': sample.sample_sex,
+            'sample_type': sample.sample_type,
+            'sample_bam': sample.sample_bam,
+            'panel_hash': sample.get_fingerprint().panel_hash,
+            'extraction_file_size': extraction_file_stat.st_size,
+            'extraction_file_mtime': extraction_file_stat.st_mtime}
+
+        if sample.extraction_info is not None:
+            entry.update(sample.extraction_info)
+
+        return entry
+
+    def _create_table(self, conn):
+        """
+        Create the samples table, or add the columns that are missing
+        from a manifest created by an older version.
+        """
+
+        conn.execute('CREATE TABLE IF NOT EXISTS samples ({})'.format(
+            ', '.join('{} {}'.format(col, col_type) for col, col_type in MANIFEST_COLUMNS.items())))
+
+        existing = set(row[1] for row in conn.execute('PRAGMA table_info(samples)'))
+
+        for col, col_type in MANIFEST_COLUMNS.items():
+            if col not in existing:
+                conn.execute('ALTER TABLE samples ADD COLUMN {} {}'.format(col, col_type))
+
+    def _upsert(self, conn, samples):
+        """
+        Insert or update the entries of the given samples. Only the given
+        fields of existing entries are updated, so the recorded extraction
+        information is kept for samples that do not have it.
+        """
+
+        self._create_table(conn)
+
+        entries = {}
+        for sample in samples:
+            entry = self._get_entry(sample)
+            entries.setdefault(tuple(entry), []).append(entry)
+
+        for columns, column_entries in entries.items():
+            conn.executemany(
+                'INSERT INTO samples ({}) VALUES ({}) ON CONFLICT(sample_name) DO UPDATE SET {}'.format(
+                    ', '.join(columns), ', '.join('?' * len(columns)),
+                    ', '.join('{0} = excluded.{0}'.format(col) for col in columns[1:])),
+                [tuple(entry[col] for col in columns) for entry in column_entries])
+
+    def add(self, samples):
+        """
+        Add or update the entries of the given samples, e.g. after they
+        were extracted or re-genotyped.
+        """
+
+        if type(samples) == dict:
+            samples = list(samples.values())
+
+        with self._connect() as conn:
+            with conn:
+                self._upsert(conn, samples)
+
+        self._entries = None
+
+    def build(self, samples):
+        """
+        Update the manifest to have exactly the given samples. The
+        recorded extraction information of the samples that are already
+        in the manifest is kept if their extraction files do not have it.
+        """
+
+        if type(samples) == dict:
+            samples = list(samples.values())
+
+        sample_names = set(sample.sample_name for sample in samples)
+
+        with self._connect() as conn:
+            with conn:
+                self._upsert(conn, samples)
+
+                removed = [
+                    (sample_name,) for sample_name in
+                    conn.execute('SELECT sample_name FROM samples').fetchall()
+                    if sample_name[0] not in sample_names]
+                conn.executemany('DELETE FROM samples WHERE sample_name = ?', removed)
+
+        self._entries = None
+
+        logger.info('Saved {} samples to the database manifest.'.format(len(self.entries)))
+
+    def list_extraction_files(self, sample_types=None):
+        """
+        Paths to the extraction files of the samples in the manifest,
+        sorted by sample name. Optionally only the samples of the given
+        sample types.
+        """
+
+        entries = self.entries.sort_index()
+
+        if sample_types is not None:
+            entries = entries[entries['sample_type'].isin(sample_types)]
+
+        return [
+            os.path.join(self.database, extraction_file)
+            for extraction_file in entries['extraction_file']]
+
+    def get_stale_entries(self):
+        """
+        Find the entries that are out of date: the extraction file is
+        missing or was changed since it was recorded, or the BAM file was
+        changed since the sample was extracted. Only the files are
+        checked, they are not opened.
+        """
+
+        def get_stat(path):
+            if path is None or not os.path.exists(path):
+                return None
+
+            stat = os.stat(path)
+
+            return stat.st_size, stat.st_mtime
+
+        stale = []
+
+        for entry in self.entries.sort_index().to_dict('records'):
+
+            extraction_file_stat = get_stat(
+                os.path.join(self.database, entry['extraction_file']))
+            bam_stat = get_stat(entry['sample_bam'])
+            reason = None
+
+            if extraction_file_stat is None:
+                reason = 'Extraction file is missing'
+            elif extraction_file_stat != (entry['extraction_file_size'], entry['extraction_file_mtime']):
+                reason = 'Extraction file was changed'
+            elif pd.notna(entry['bam_size']) and bam_stat is not None and \
+                    bam_stat != (entry['bam_size'], entry['bam_mtime']):
+                reason = 'BAM file was changed'
+
+            if reason is not None:
+                stale.append({'sample_name': entry['sample_name'], 'reason': reason})
+
+        return pd.DataFrame(stale, columns=['sample_name', 'reason'])
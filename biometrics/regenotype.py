@@ -0,0 +1,65 @@
+from multiprocessing import Pool
+
+from biometrics.sample import Sample, consolidate_fp_summary
+from biometrics.extract import call_genotypes
+from biometrics.utils import get_logger
+
+logger = get_logger()
+
+
+class Regenotyper:
+    """
+    Class for re-genotyping extracted samples from the allele counts
+    stored in the database, without going back to the BAM files.
+    """
+
+    def __init__(self, min_coverage, min_homozygous_thresh,
+                 default_genotype=None, threads=1):
+        self.min_coverage = min_coverage
+        self.min_homozygous_thresh = min_homozygous_thresh
+        self.default_genotype = default_genotype
+        self.threads = threads
+        self.summary_file = None
+
+    def _regenotype_job(self, extraction_file):
+        """
+        Re-genotype a single sample and overwrite its extraction file
+        and FP summary shard.
+        """
+
+        sample = Sample()
+        sample.load_from_file(extraction_file)
+
+        sample.pileup = call_genotypes(
+            sample.pileup, self.min_coverage, self.min_homozygous_thresh,
+            self.default_genotype)
+
+        if sample.extraction_info is not None:
+            sample.extraction_info.update(
+                min_coverage=self.min_coverage,
+                min_homozygous_thresh=self.min_homozygous_thresh,
+                default_genotype=self.default_genotype)
+
+        sample.summary_file = self.summary_file
+        sample.save_to_file()
+
+    def regenotype(self, extraction_files, summary_file):
+        """
+        Re-genotype the given extraction files in parallel, then merge
+        their FP summaries into the summary file once.
+        """
+
+        if len(extraction_files) == 0:
+            logger.warning('There are no samples to re-genotype.')
+            return
+
+        self.summary_file = summary_file
+
+        with Pool(self.threads) as thread_pool:
+            thread_pool.map(self._regenotype_job, extraction_files)
+            thread_pool.close()
+            thread_pool.join()
+
+        consolidate_fp_summary(summary_file)
+
+        logger.info('Re-genotyped {} samples.'.format(len(extraction_files)))
@@ -1,13 +1,150 @@
 import pickle
 import os
+import json
+import fcntl
+import glob
+import weakref
+from collections import OrderedDict
 
+import numpy as np
 import pandas as pd
 import pdb
 
+from biometrics.fingerprint import Fingerprint, get_site_keys
+from biometrics.utils import atomic_write, get_file_hash
+
+
+def get_fp_summary_shard_dir(summary_file):
+    """
+    Directory of the per-sample FP summary shards that are waiting to be
+    merged into the summary file.
+    """
+
+    return os.path.join(
+        os.path.dirname(summary_file),
+        os.path.splitext(os.path.basename(summary_file))[0] + '_shards')
+
+
+def consolidate_fp_summary(summary_file):
+    """
+    Merge all the per-sample FP summary shards into the summary file in
+    a single pass, then remove the shards. Any columns already in the
+    file for the same samples are replaced.
+
+    The rows are matched on the site (chrom:pos:ref:alt), since several
+    sites can share a locus, and are kept in the order of the summary
+    file (or of the first shard), with new sites added at the end.
+
+    Several runs can extract into the same database at the same time, so
+    the merge holds a lock on the summary file, and only the shards that
+    were read are removed.
+    """
+
+    if len(glob.glob(os.path.join(get_fp_summary_shard_dir(summary_file), '*.csv'))) == 0:
+        return
+
+    with open(summary_file + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _consolidate_fp_summary(summary_file)
+
+
+def _consolidate_fp_summary(summary_file):
+
+    key_dtypes = {'Locus': str, 'Site': str}
+    shard_files = []
+    shards = []
+
+    # a shard that is gone was merged by another run, which writes the
+    # summary file before it removes the shards
+
+    for shard_file in sorted(glob.glob(
+            os.path.join(get_fp_summary_shard_dir(summary_file), '*.csv'))):
+        try:
+            shards.append(pd.read_csv(shard_file, dtype=key_dtypes))
+            shard_files.append(shard_file)
+        except FileNotFoundError:
+            pass
+
+    if len(shard_files) == 0:
+        return
+
+    new_columns = set(col for shard in shards for col in shard.columns) - set(key_dtypes)
+
+    if os.path.exists(summary_file):
+        fp_summary = pd.read_csv(summary_file, dtype=key_dtypes)
+
+        if 'Site' not in fp_summary.columns:
+            # summary files written by older versions only have the
+            # locus, which identifies the site if it has a single site
+            loci = pd.concat([shard[['Locus', 'Site']] for shard in shards]).drop_duplicates()
+            sites = loci.drop_duplicates('Locus', keep=False).set_index('Locus')['Site']
+            fp_summary.insert(
+                1, 'Site', fp_summary['Locus'].map(sites).fillna(fp_summary['Locus']))
+
+        fp_summary = fp_summary.drop(columns=[
+            col for col in fp_summary.columns if col in new_columns])
+        shards = [fp_summary] + shards
+
+    shards = [shard.drop_duplicates('Site').set_index('Site') for shard in shards]
+    loci = pd.concat([shard['Locus'] for shard in shards])
+    loci = loci[~loci.index.duplicated()]
+
+    fp_summary = pd.concat(
+        [shard.drop(columns='Locus') for shard in shards], axis=1, join='outer', sort=False)
+    fp_summary.insert(0, 'Locus', loci.reindex(fp_summary.index))
+    fp_summary.index.name = 'Site'
+    fp_summary = fp_summary.reset_index()[
+        ['Locus', 'Site'] + [col for col in fp_summary.columns if col not in ['Locus', 'Site']]]
+
+    with atomic_write(summary_file, 'w') as fh:
+        fp_summary.to_csv(fh, index=False)
+
+    for shard_file in shard_files:
+        try:
+            os.remove(shard_file)
+        except FileNotFoundError:
+            pass
+
+
+# marks a lazy attribute that has not been loaded yet
+NOT_LOADED = object()
+
+
+class PileupCache:
+    """
+    Least recently used set of the samples whose lazily loaded pileup
+    is in memory. When there are more than max_size of them, the pileup
+    of the least recently used sample is dropped; it is loaded again
+    the next time it is accessed.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.samples = OrderedDict()
+
+    def touch(self, sample):
+        self.samples[id(sample)] = weakref.ref(sample)
+        self.samples.move_to_end(id(sample))
+
+        while len(self.samples) > self.max_size:
+            _, sample_ref = self.samples.popitem(last=False)
+            evicted = sample_ref()
+            if evicted is not None:
+                evicted._pileup = NOT_LOADED
+
+    def discard(self, sample):
+        self.samples.pop(id(sample), None)
+
+
+pileup_cache = PileupCache()
+
 
 class Sample:
     """
     Class to hold information related to a single sample.
+
+    The pileup and region counts can be loaded lazily: if a loader is
+    set, it is called with the attribute name on first access.
     """
 
     def __init__(self, sample_name=None, sample_bam=None, sample_group=None,
@@ -22,9 +159,12 @@ class Sample:
         else:
             self.sample_group = sample_group
 
-        self.pileup = None
-        self.region_counts = None
+        self._pileup = None
+        self._region_counts = None
+        self.loader = None
+        self.fingerprint = None
         self.extraction_file = None
+        self.extraction_info = None
         self.query_group = query_group
         self.metrics = {}
 
@@ -36,7 +176,62 @@ class Sample:
                 self.extraction_file = self.sample_name + '.pickle'
                 self.summary_file = "ALL_FPsummary.txt"
 
-    def save_to_file(self):
+    @property
+    def pileup(self):
+
+        if self._pileup is NOT_LOADED:
+            self._pileup = self.loader('pileup')
+            pileup_cache.touch(self)
+        elif id(self) in pileup_cache.samples:
+            pileup_cache.touch(self)
+
+        return self._pileup
+
+    @pileup.setter
+    def pileup(self, pileup):
+        self._pileup = pileup
+        pileup_cache.discard(self)
+
+    @property
+    def region_counts(self):
+
+        if self._region_counts is NOT_LOADED:
+            self._region_counts = self.loader('region_counts')
+
+        return self._region_counts
+
+    @region_counts.setter
+    def region_counts(self, region_counts):
+        self._region_counts = region_counts
+
+    def set_loader(self, loader):
+        """
+        Load the pileup and region counts lazily with the given function.
+        """
+
+        self.loader = loader
+        self._pileup = NOT_LOADED
+        self._region_counts = NOT_LOADED
+        self.fingerprint = None
+
+    def unload_fingerprint(self):
+        """
+        Drop the fingerprint from memory if it can be loaded again
+        without the pileup.
+        """
+
+        if self._pileup is NOT_LOADED:
+            self.fingerprint = None
+
+    def unload(self):
+        """
+        Drop the pileup and region counts from memory. They are read
+        again from the extraction file if they are accessed.
+        """
+
+        self.set_loader(self._load_extraction_file_attribute)
+
+    def save_to_file(self, update_summary=True):
 
         pileup_data = self.pileup.to_dict("records")
 
@@ -52,56 +247,233 @@ class Sample:
             'sample_group': self.sample_group,
             'sample_type': self.sample_type,
             'pileup_data': pileup_data,
-            'region_counts': region_counts
+            'region_counts': region_counts,
+            'extraction_info': self.extraction_info
         }
-        pickle.dump(sample_data, open(self.extraction_file, "wb"))
-
-        #################################################
-        #converting pileup data to FP summary like csv file
-        #get the alt count based on the alt on the genotype
-        def match_gt_letters(row):
-            matched_values = []
-            for letter in row['genotype']:  # Iterate through each character in 'genotype'
-                for col in row.index:
-                    if letter in col:  # Check if character is in column name
-                        matched_values.append(f"{letter}:{row[col]}")
-            return ",".join(matched_values) if matched_values else None
-
-        def match_ref_letters(row):
-            matched_values = []
-            for letter in row['genotype']:  # Iterate through each character in 'genotype'
-                for col in row.index:
-                    if letter in col:  # Check if character is in column name
-                        matched_values.append(f"{letter}:{row[col]}")
-            return ",".join(matched_values) if matched_values else None
-
-
-        #make sure to remove older txt file. But this is neccessary to add the samples to existing df
-        if os.path.exists(self.summary_file):
-            fp_summary = pd.read_csv(self.summary_file)
-        else:
-            fp_summary = pd.DataFrame()
+        with atomic_write(self.extraction_file) as fh:
+            pickle.dump(sample_data, fh)
+
+        self.fingerprint = None
+        self.get_fingerprint().save(self.get_fingerprint_file())
+
+        self.save_completion_marker()
+
+        if update_summary:
+            self.save_fp_summary_shard()
+
+    def get_completion_marker_file(self):
+        """
+        Path to the completion marker, which is written once the
+        extraction file and fingerprint are saved.
+        """
+
+        return os.path.splitext(self.extraction_file)[0] + '.done'
 
-        #convert existing pileup data as dataframe
-        pileup_df =pd.DataFrame.from_dict(self.pileup)
-        pileup_df = pileup_df[pileup_df['genotype_class'].notna()]
-        sample_name= self.sample_name
+    def save_completion_marker(self):
+        """
+        Record the size, mtime and hash of the saved extraction file (and
+        the size of the fingerprint file) in the completion marker, along
+        with the sample information and the extraction information, so
+        that they can be read without opening the extraction file.
+        """
+
+        extraction_file_stat = os.stat(self.extraction_file)
+
+        marker = {
+            'extraction_file_size': extraction_file_stat.st_size,
+            'extraction_file_mtime': extraction_file_stat.st_mtime,
+            'extraction_file_sha1': get_file_hash(self.extraction_file),
+            'fingerprint_file_size': os.path.getsize(self.get_fingerprint_file()),
+            'sample_info': {
+                'sample_bam': self.sample_bam,
+                'sample_name': self.sample_name,
+                'sample_sex': self.sample_sex,
+                'sample_group': self.sample_group,
+                'sample_type': self.sample_type},
+            'extraction_info': self.extraction_info}
+
+        with atomic_write(self.get_completion_marker_file(), 'w') as fh:
+            json.dump(marker, fh)
+
+    def is_extraction_complete(self):
+        """
+        Check that the extraction file and fingerprint of the sample were
+        completely saved and have not changed since, using the completion
+        marker.
+        """
+
+        marker = self._load_completion_marker()
+
+        if marker is None:
+            return False
+
+        for path, key in [
+                (self.extraction_file, 'extraction_file_size'),
+                (self.get_fingerprint_file(), 'fingerprint_file_size')]:
+            if not os.path.exists(path) or os.path.getsize(path) != marker.get(key):
+                return False
+
+        return get_file_hash(self.extraction_file) == marker.get('extraction_file_sha1')
+
+    def _load_completion_marker(self):
+
+        marker_file = self.get_completion_marker_file()
+
+        if not os.path.exists(marker_file):
+            return None
+
+        try:
+            with open(marker_file) as fh:
+                return json.load(fh)
+        except ValueError:
+            return None
+
+    def get_saved_extraction_info(self):
+        """
+        The extraction information recorded in the completion marker, or
+        None if it was not recorded.
+        """
+
+        marker = self._load_completion_marker()
+
+        if marker is None:
+            return None
+
+        return marker.get('extraction_info')
+
+    def _get_saved_sample_info(self):
+        """
+        The sample information recorded in the completion marker, or None
+        if it was not recorded or the extraction file changed since (its
+        size or mtime differ).
+        """
+
+        marker = self._load_completion_marker()
+
+        if marker is None or 'sample_info' not in marker:
+            return None
+
+        extraction_file_stat = os.stat(self.extraction_file)
+
+        if (extraction_file_stat.st_size, extraction_file_stat.st_mtime) != \
+                (marker.get('extraction_file_size'), marker.get('extraction_file_mtime')):
+            return None
+
+        return dict(marker['sample_info'], extraction_info=marker.get('extraction_info'))
+
+    def save_fp_summary_shard(self):
+        """
+        Write the sample's FP summary columns to its own shard file. The
+        shards are merged into the summary file by consolidate_fp_summary.
+        """
+
+        shard_dir = get_fp_summary_shard_dir(self.summary_file)
+        os.makedirs(shard_dir, exist_ok=True)
+
+        with atomic_write(os.path.join(shard_dir, self.sample_name + '.csv'), 'w') as fh:
+            self.get_fp_summary().to_csv(fh, index=False)
+
+    def get_fingerprint_file(self):
+        """
+        Path to the packed genotype fingerprint, which is stored next to
+        the extraction file.
+        """
+
+        return os.path.splitext(self.extraction_file)[0] + '.fingerprint.npz'
+
+    def get_fingerprint(self):
+        """
+        Get the packed genotype fingerprint of the sample. It is encoded
+        from the pileup if that is in memory, otherwise it is loaded with
+        the sample's loader (e.g. from the fingerprint file) if possible.
+        """
+
+        fingerprint = self.fingerprint
+
+        if fingerprint is None and self._pileup is NOT_LOADED:
+            fingerprint = self.loader('fingerprint')
+
+        if fingerprint is None:
+            if self.pileup is not None:
+                fingerprint = Fingerprint.from_pileup(
+                    self.pileup, self.sample_name, self.sample_group)
+            else:
+                fingerprint = Fingerprint().load(self.get_fingerprint_file())
+
+        self.fingerprint = fingerprint
+
+        return fingerprint
+
+    def get_fp_summary(self):
+        """
+        Convert the pileup data to the FP summary format: one row per
+        called site with this sample's allele counts, genotype and minor
+        allele frequency.
+        """
+
+        pileup = self.pileup[self.pileup['genotype_class'].notna()]
+        sample_name = self.sample_name
+
+        # build the "<allele>:<count>" list of each allele in the genotype
+
+        alleles = ['A', 'C', 'G', 'T', 'N']
+        allele_counts = pileup[alleles].to_numpy()
+        genotypes = pileup['genotype'].astype(str)
+        gt_counts = pd.Series(None, index=pileup.index, dtype=object)
+
+        for i in range(genotypes.str.len().max() if len(genotypes) > 0 else 0):
+            letters = genotypes.str[i]
+            is_allele = letters.isin(alleles).to_numpy()
+            allele_idx = letters.map({allele: j for j, allele in enumerate(alleles)})
+
+            counts = np.full(len(pileup), '', dtype=object)
+            counts[is_allele] = allele_counts[
+                np.flatnonzero(is_allele), allele_idx[is_allele].astype(int)].astype(str)
+            allele_count = letters + ':' + counts
+
+            gt_counts = gt_counts.where(
+                ~is_allele,
+                allele_count.where(gt_counts.isna(), gt_counts + ',' + allele_count))
 
         new_sample_data = pd.DataFrame()
-        new_sample_data['Locus'] = pileup_df['chrom'].astype(str) + ":" + pileup_df['pos'].astype(str)
-        new_sample_data[sample_name + '_ref_Counts'] = pileup_df.apply(match_ref_letters, axis=1)
-        new_sample_data[sample_name + '_gt_Counts'] = pileup_df.apply(match_gt_letters, axis=1)
-        new_sample_data[sample_name + '_Genotypes'] = pileup_df['genotype']
-        new_sample_data[sample_name + '_MinorAlleleFreq'] = pileup_df['minor_allele_freq']
-
-        #merge the dataframe with the empty frame to create a single df with all the samples
-        if not fp_summary.empty:
-            fp_summary = pd.merge(fp_summary, new_sample_data, on='Locus', how='outer')
-        else:
-            fp_summary = new_sample_data
-        fp_summary.to_csv(self.summary_file, index=False)
+        new_sample_data['Locus'] = pileup['chrom'].astype(str) + ":" + pileup['pos'].astype(str)
+        new_sample_data['Site'] = get_site_keys(pileup)
+        new_sample_data[sample_name + '_ref_Counts'] = gt_counts
+        new_sample_data[sample_name + '_gt_Counts'] = gt_counts
+        new_sample_data[sample_name + '_Genotypes'] = pileup['genotype']
+        new_sample_data[sample_name + '_MinorAlleleFreq'] = pileup['minor_allele_freq']
+
+        return new_sample_data
+
+    def _load_extraction_file_attribute(self, attribute):
+        """
+        Loader for a lazily loaded sample, which reads the pileup or
+        region counts back from the extraction file, or the fingerprint
+        from the fingerprint file.
+        """
+
+        if attribute == 'fingerprint':
+            if os.path.exists(self.get_fingerprint_file()):
+                return Fingerprint().load(self.get_fingerprint_file())
+
+            return None
 
-    def load_from_file(self, extraction_file=None):
+        with open(self.extraction_file, 'rb') as fh:
+            sample_data = pickle.load(fh)
+
+        if attribute == 'pileup':
+            return pd.DataFrame(sample_data['pileup_data'])
+        elif sample_data.get('region_counts') is not None:
+            return pd.DataFrame(sample_data['region_counts'], dtype=object)
+
+    def load_from_file(self, extraction_file=None, lazy=False):
+        """
+        Load the sample from its extraction file. If lazy, only the
+        sample information is kept and the pileup and region counts are
+        read when they are first accessed. The sample information is then
+        taken from the completion marker if it is up to date, so the
+        extraction file is not read until it is needed.
+        """
 
         if extraction_file is not None:
             self.extraction_file = extraction_file
@@ -110,17 +482,28 @@ class Sample:
         assert os.path.exists(self.extraction_file), 'Extraction file does not exist: {}'.format(
             self.extraction_file)
 
-        sample_data = pickle.load(open(self.extraction_file, "rb"))
+        sample_data = self._get_saved_sample_info() if lazy else None
 
-        region_counts = None
-        if sample_data.get('region_counts') is not None:
-            region_counts = pd.DataFrame(
-                sample_data['region_counts'], dtype=object)
+        if sample_data is None:
+            with open(self.extraction_file, 'rb') as fh:
+                sample_data = pickle.load(fh)
 
-        self.pileup = pd.DataFrame(sample_data['pileup_data'])
+        self.fingerprint = None
         self.sample_bam = sample_data['sample_bam']
         self.sample_name = sample_data['sample_name']
         self.sample_sex = sample_data['sample_sex']
         self.sample_group = sample_data['sample_group'] if sample_data['sample_group'] is not None else sample_data['sample_name']
         self.sample_type = sample_data['sample_type']
+        self.extraction_info = sample_data.get('extraction_info')
+
+        if lazy:
+            self.set_loader(self._load_extraction_file_attribute)
+            return
+
+        region_counts = None
+        if sample_data.get('region_counts') is not None:
+            region_counts = pd.DataFrame(
+                sample_data['region_counts'], dtype=object)
+
+        self.pileup = pd.DataFrame(sample_data['pileup_data'])
         self.region_counts = region_counts
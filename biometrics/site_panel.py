@@ -0,0 +1,141 @@
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from biometrics.fingerprint import get_panel_hash
+from biometrics.utils import atomic_write, get_file_hash, get_logger
+
+logger = get_logger()
+
+
+def get_site_cache_file(vcf_file):
+    return vcf_file + '.sites.npz'
+
+
+class SitePanel:
+    """
+    The sites of a VCF file as typed arrays: contig codes (into the list
+    of contigs), int32 1-based positions, and the ref and first alt
+    allele as bytes. Indexing the panel gives the dict of a single site
+    (chrom, 0-based start, end, ref_allele and alt_allele).
+
+    The arrays and the panel hash are cached next to the VCF file, along
+    with the hash of the VCF file, so the VCF file is only parsed again
+    when it changes.
+    """
+
+    def __init__(self, contigs=(), chrom_codes=None, positions=None, ref=None, alt=None,
+                 panel_hash=None):
+        self.contigs = list(contigs)
+        self.chrom_codes = np.zeros(0, dtype=np.int32) if chrom_codes is None else chrom_codes
+        self.positions = np.zeros(0, dtype=np.int32) if positions is None else positions
+        self.ref = np.zeros(0, dtype='S1') if ref is None else ref
+        self.alt = np.zeros(0, dtype='S1') if alt is None else alt
+        self.panel_hash = panel_hash
+
+        if panel_hash is None:
+            self.panel_hash = get_panel_hash(self.get_site_table())
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        return {
+            'chrom': self.contigs[self.chrom_codes[i]],
+            'start': int(self.positions[i]) - 1,
+            'end': int(self.positions[i]),
+            'ref_allele': self.ref[i].decode(),
+            'alt_allele': self.alt[i].decode()}
+
+    def get_site_table(self):
+        """
+        Table of the chrom, pos, ref and alt of every site, in order.
+        """
+
+        return pd.DataFrame({
+            'chrom': np.array(self.contigs, dtype=object)[self.chrom_codes],
+            'pos': self.positions.astype(np.int64),
+            'ref': np.char.decode(self.ref).astype(object),
+            'alt': np.char.decode(self.alt).astype(object)})
+
+    @classmethod
+    def parse_vcf(cls, vcf_file):
+        """
+        Parse the sites of a VCF file. Only the CHROM, POS, REF and ALT
+        columns are read, with the C parser of pandas. Only the header
+        lines at the start of the file are skipped, since '#' can appear
+        in the records (e.g. in the ID column).
+
+        A missing ALT allele ('.') is given as 'None', as PyVCF did, so
+        that the sites (and the panel hash) are the same as before.
+        """
+
+        n_header_lines = 0
+        with open(vcf_file) as fh:
+            for line in fh:
+                if not line.startswith('#'):
+                    break
+                n_header_lines += 1
+
+        try:
+            records = pd.read_csv(
+                vcf_file, sep='\t', skiprows=n_header_lines, header=None, usecols=[0, 1, 3, 4],
+                dtype={0: str, 1: np.int64, 3: str, 4: str}, keep_default_na=False)
+        except pd.errors.EmptyDataError:
+            return cls()
+
+        records[4] = records[4].str.split(',').str[0].replace('.', 'None')
+        chrom_codes, contigs = pd.factorize(records[0])
+
+        return cls(
+            contigs=contigs,
+            chrom_codes=chrom_codes.astype(np.int32),
+            positions=records[1].to_numpy(dtype=np.int32),
+            ref=records[3].to_numpy(dtype=str).astype(bytes),
+            alt=records[4].to_numpy(dtype=str).astype(bytes))
+
+    @classmethod
+    def load(cls, vcf_file):
+        """
+        Load the sites of a VCF file from its cache, or parse the VCF file
+        and cache them if there is no cache or the VCF file changed. A
+        cache that cannot be read is parsed again and replaced.
+        """
+
+        cache_file = get_site_cache_file(vcf_file)
+        vcf_sha1 = get_file_hash(vcf_file)
+
+        if os.path.exists(cache_file):
+            try:
+                with np.load(cache_file, allow_pickle=False) as data:
+                    if str(data['vcf_sha1']) == vcf_sha1:
+                        return cls(
+                            contigs=data['contigs'].astype(str),
+                            chrom_codes=data['chrom_codes'],
+                            positions=data['positions'],
+                            ref=data['ref'],
+                            alt=data['alt'],
+                            panel_hash=str(data['panel_hash']))
+            except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile) as e:
+                logger.warning('Could not read the VCF sites cache {}, parsing the VCF file again: {}'.format(
+                    cache_file, e))
+
+        panel = cls.parse_vcf(vcf_file)
+
+        try:
+            with atomic_write(cache_file) as fh:
+                np.savez(
+                    fh,
+                    vcf_sha1=np.array(vcf_sha1),
+                    contigs=np.array(panel.contigs, dtype=str),
+                    chrom_codes=panel.chrom_codes,
+                    positions=panel.positions,
+                    ref=panel.ref,
+                    alt=panel.alt,
+                    panel_hash=np.array(panel.panel_hash))
+        except OSError as e:
+            logger.warning('Could not cache the VCF sites to {}: {}'.format(cache_file, e))
+
+        return panel
@@ -0,0 +1,429 @@
+import os
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from biometrics.sample import Sample
+from biometrics.extract import PILEUP_COLUMNS, COUNT_COLUMNS
+from biometrics.fingerprint import Fingerprint, get_panel_hash
+from biometrics.utils import atomic_write, get_logger
+
+logger = get_logger()
+
+STORE_DIR = 'biometrics_store'
+
+METADATA_COLUMNS = [
+    'sample_name', 'sample_bam', 'sample_group', 'sample_sex', 'sample_type',
+    'row', 'has_regions']
+
+SITE_COLUMNS = ['chrom', 'pos', 'ref', 'alt']
+
+FIELDS = ['counts', 'minor_allele_freq', 'genotype', 'region_counts']
+
+# number of samples that are appended to the store at a time when
+# importing or extracting samples
+APPEND_CHUNK_SIZE = 64
+
+# genotype codes: 0 is not called, 1 is Hom ref, 2 is Hom alt, 3 is Het
+GENOTYPE_CODES = {'uncalled': 0, 'ref': 1, 'alt': 2, 'het': 3}
+
+
+class SampleStore:
+    """
+    Consolidated store of all the extracted samples in a database
+    directory. Each field is a flat binary file of fixed-size rows (one
+    row per sample) that is read with a memory map, so tools only read
+    the fields they need:
+
+    * counts: int32 (samples x sites x COUNT_COLUMNS)
+    * minor_allele_freq: float64 (samples x sites)
+    * genotype: int8 genotype codes (samples x sites)
+    * region_counts: int64 (samples x regions)
+
+    The site panel, the regions and the sample metadata are kept in CSV
+    tables next to them. New samples are appended, and a sample that is
+    appended again (e.g. when it is re-genotyped) is written over its
+    existing row, so the store does not grow.
+    """
+
+    def __init__(self, database):
+        self.path = os.path.join(database, STORE_DIR)
+        self.sites = None
+        self.regions = None
+        self.metadata = None
+        self.panel_hash = None
+
+        if self.exists():
+            self._load_tables()
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, 'samples.csv'))
+
+    def _load_tables(self):
+
+        self.sites = pd.read_csv(
+            os.path.join(self.path, 'sites.csv'), dtype={'chrom': str, 'ref': str, 'alt': str},
+            keep_default_na=False)
+        self.panel_hash = get_panel_hash(self.sites)
+
+        regions_file = os.path.join(self.path, 'regions.csv')
+        if os.path.exists(regions_file):
+            self.regions = pd.read_csv(regions_file, dtype={'chrom': str})
+
+        metadata = pd.read_csv(
+            os.path.join(self.path, 'samples.csv'), dtype=str,
+            keep_default_na=False)
+        metadata = metadata.replace('', None)
+        metadata['row'] = metadata['row'].astype(int)
+        metadata['has_regions'] = metadata['has_regions'] == 'True'
+
+        # only keep the latest row for each sample
+
+        self.metadata = metadata.drop_duplicates(
+            'sample_name', keep='last').set_index('sample_name', drop=False)
+
+    def _field_shape(self, field):
+        """
+        Shape of a single row of the given field.
+        """
+
+        n_sites = len(self.sites)
+
+        if field == 'counts':
+            return (n_sites, len(COUNT_COLUMNS))
+        elif field == 'minor_allele_freq':
+            return (n_sites,)
+        elif field == 'genotype':
+            return (n_sites,)
+        elif field == 'region_counts':
+            return (len(self.regions) if self.regions is not None else 0,)
+
+    def _field_dtype(self, field):
+        return {
+            'counts': np.int32,
+            'minor_allele_freq': np.float64,
+            'genotype': np.int8,
+            'region_counts': np.int64}[field]
+
+    def _field_file(self, field):
+        return os.path.join(self.path, field + '.bin')
+
+    def _row_size(self, field):
+        """
+        Size in bytes of a single row of the given field.
+        """
+
+        return int(np.prod(self._field_shape(field))) * np.dtype(self._field_dtype(field)).itemsize
+
+    def _n_rows(self):
+        """
+        Number of complete rows in the store: the smallest number of rows
+        in any of the field files, so that a row that was only partially
+        written (to some of the files) is ignored.
+        """
+
+        n_rows = None
+
+        for field in FIELDS:
+            row_size = self._row_size(field)
+
+            if row_size == 0:
+                continue
+
+            if not os.path.exists(self._field_file(field)):
+                return 0
+
+            field_rows = os.path.getsize(self._field_file(field)) // row_size
+            n_rows = field_rows if n_rows is None else min(n_rows, field_rows)
+
+        return n_rows or 0
+
+    def _encode_genotypes(self, pileup):
+
+        called = pileup['genotype_class'].notna().to_numpy()
+        het = called & (pileup['genotype_class'] == 'Het').to_numpy()
+        alt = called & ~het & (pileup['genotype'] == pileup['alt']).to_numpy()
+
+        codes = np.full(len(pileup), GENOTYPE_CODES['uncalled'], dtype=np.int8)
+        codes[called] = GENOTYPE_CODES['ref']
+        codes[alt] = GENOTYPE_CODES['alt']
+        codes[het] = GENOTYPE_CODES['het']
+
+        return codes
+
+    def _init_tables(self, sample):
+        """
+        Create the store using the site panel and regions of the first
+        sample that is appended.
+        """
+
+        os.makedirs(self.path, exist_ok=True)
+
+        self.sites = sample.pileup[SITE_COLUMNS].reset_index(drop=True)
+        self.sites.to_csv(os.path.join(self.path, 'sites.csv'), index=False)
+        self.panel_hash = get_panel_hash(self.sites)
+
+        if sample.region_counts is not None:
+            self.regions = sample.region_counts[['chrom', 'start', 'end']].reset_index(drop=True)
+            self.regions.to_csv(os.path.join(self.path, 'regions.csv'), index=False)
+
+        self.metadata = pd.DataFrame(columns=METADATA_COLUMNS).set_index(
+            'sample_name', drop=False)
+
+    def append(self, samples):
+        """
+        Append the given samples to the store, or rewrite the rows of the
+        samples that are already in it. Each call opens every field file
+        and writes the metadata table once, so samples should be appended
+        in chunks rather than one at a time.
+        """
+
+        if type(samples) == dict:
+            samples = list(samples.values())
+
+        if len(samples) == 0:
+            return
+
+        if self.sites is None:
+            self._init_tables(samples[0])
+
+        # drop the partially written rows of an interrupted append, so the
+        # new rows start at the same row in every field file
+
+        metadata = []
+        row = self._n_rows()
+
+        for field in FIELDS:
+            if os.path.exists(self._field_file(field)):
+                os.truncate(self._field_file(field), row * self._row_size(field))
+
+        field_files = {}
+        for field in FIELDS:
+            if not os.path.exists(self._field_file(field)):
+                open(self._field_file(field), 'wb').close()
+            field_files[field] = open(self._field_file(field), 'r+b')
+
+        rows = {}
+
+        for sample in samples:
+
+            assert get_panel_hash(sample.pileup) == self.panel_hash, \
+                'Sample {} was extracted with a different set of sites than the store.'.format(
+                    sample.sample_name)
+
+            has_regions = sample.region_counts is not None and self.regions is not None
+
+            if has_regions:
+                assert len(sample.region_counts) == len(self.regions), \
+                    'Sample {} was extracted with a different set of regions than the store.'.format(
+                        sample.sample_name)
+                region_counts = sample.region_counts['count'].to_numpy()
+            else:
+                region_counts = np.full(self._field_shape('region_counts'), -1)
+
+            fields = {
+                'counts': sample.pileup[COUNT_COLUMNS].to_numpy(),
+                'minor_allele_freq': sample.pileup['minor_allele_freq'].to_numpy(dtype=float),
+                'genotype': self._encode_genotypes(sample.pileup),
+                'region_counts': region_counts}
+
+            # a sample that is already in the store is written over its
+            # existing row, and new samples get a row at the end
+
+            if sample.sample_name in rows:
+                sample_row = rows[sample.sample_name]
+            elif sample.sample_name in self.metadata.index:
+                sample_row = int(self.metadata.at[sample.sample_name, 'row'])
+            else:
+                sample_row = row
+                row += 1
+            rows[sample.sample_name] = sample_row
+
+            for field, data in fields.items():
+                field_files[field].seek(sample_row * self._row_size(field))
+                field_files[field].write(np.ascontiguousarray(
+                    data, dtype=self._field_dtype(field)).tobytes())
+
+            metadata.append({
+                'sample_name': sample.sample_name,
+                'sample_bam': sample.sample_bam,
+                'sample_group': sample.sample_group,
+                'sample_sex': sample.sample_sex,
+                'sample_type': sample.sample_type,
+                'row': sample_row,
+                'has_regions': has_regions})
+
+        for fh in field_files.values():
+            fh.close()
+
+        # the metadata is written last, so rows from an interrupted append
+        # are never referenced. It is only rewritten when samples replaced
+        # their existing rows, so it does not grow either.
+
+        metadata = pd.DataFrame(metadata, columns=METADATA_COLUMNS)
+        metadata_file = os.path.join(self.path, 'samples.csv')
+        n_replaced = self.metadata.index.isin(metadata['sample_name']).sum()
+
+        if len(self.metadata) > 0:
+            all_metadata = pd.concat([self.metadata, metadata])
+        else:
+            all_metadata = metadata
+
+        all_metadata = all_metadata.drop_duplicates(
+            'sample_name', keep='last').set_index('sample_name', drop=False)
+
+        if n_replaced > 0:
+            with atomic_write(metadata_file, 'w') as fh:
+                all_metadata.to_csv(fh, index=False)
+        else:
+            metadata.to_csv(
+                metadata_file, mode='a', index=False,
+                header=not os.path.exists(metadata_file))
+
+        self.metadata = all_metadata
+
+    def import_pickles(self, extraction_files):
+        """
+        Import extraction files (pickles) into the store.
+        """
+
+        for i in range(0, len(extraction_files), APPEND_CHUNK_SIZE):
+            samples = []
+
+            for extraction_file in extraction_files[i:i + APPEND_CHUNK_SIZE]:
+                sample = Sample()
+                sample.load_from_file(extraction_file)
+                samples.append(sample)
+
+            self.append(samples)
+
+        logger.info('Imported {} samples into the sample store.'.format(
+            len(extraction_files)))
+
+    def read(self, field, sample_names=None):
+        """
+        Read a field for the given samples (default all samples), in the
+        same order as sample_names. Returns an array with one row per
+        sample.
+        """
+
+        metadata = self.metadata if sample_names is None else self.metadata.loc[sample_names]
+        shape = self._field_shape(field)
+
+        if np.prod(shape) == 0:
+            return np.empty((len(metadata),) + shape, dtype=self._field_dtype(field))
+
+        data = np.memmap(
+            self._field_file(field), dtype=self._field_dtype(field), mode='r',
+            shape=(self._n_rows(),) + shape)
+
+        return np.asarray(data[metadata['row'].to_numpy()])
+
+    def _decode_pileup(self, fields, i, data):
+        """
+        Rebuild the pileup table of a sample from the requested fields.
+        """
+
+        pileup = {col: self.sites[col].to_numpy() for col in SITE_COLUMNS}
+
+        if 'counts' in fields:
+            for j, col in enumerate(COUNT_COLUMNS):
+                pileup[col] = data['counts'][i, :, j].astype(np.int64)
+
+        if 'minor_allele_freq' in fields:
+            pileup['minor_allele_freq'] = data['minor_allele_freq'][i]
+
+        if 'genotype' in fields:
+            codes = data['genotype'][i]
+            ref = self.sites['ref'].to_numpy(dtype=object)
+            alt = self.sites['alt'].to_numpy(dtype=object)
+
+            genotype_class = np.full(len(codes), np.nan, dtype=object)
+            genotype_class[codes != GENOTYPE_CODES['uncalled']] = 'Hom'
+            genotype_class[codes == GENOTYPE_CODES['het']] = 'Het'
+
+            genotype = np.full(len(codes), np.nan, dtype=object)
+            genotype[codes == GENOTYPE_CODES['ref']] = ref[codes == GENOTYPE_CODES['ref']]
+            genotype[codes == GENOTYPE_CODES['alt']] = alt[codes == GENOTYPE_CODES['alt']]
+            genotype[codes == GENOTYPE_CODES['het']] = \
+                ref[codes == GENOTYPE_CODES['het']] + alt[codes == GENOTYPE_CODES['het']]
+
+            pileup['genotype_class'] = genotype_class
+            pileup['genotype'] = genotype
+
+        return pd.DataFrame(pileup)[[col for col in PILEUP_COLUMNS if col in pileup]]
+
+    def read_fingerprints(self, sample_names):
+        """
+        Build the packed genotype fingerprints of the given samples from
+        their stored genotype codes.
+        """
+
+        codes = self.read('genotype', sample_names)
+        panel_hash = get_panel_hash(self.sites)
+
+        return [
+            Fingerprint(
+                sample_name=sample_name,
+                sample_group=self.metadata.at[sample_name, 'sample_group'],
+                panel_hash=panel_hash,
+                n_sites=codes.shape[1],
+                called=np.packbits(codes[i] != GENOTYPE_CODES['uncalled']),
+                het=np.packbits(codes[i] == GENOTYPE_CODES['het']),
+                alt=np.packbits(codes[i] == GENOTYPE_CODES['alt']))
+            for i, sample_name in enumerate(sample_names)]
+
+    def _load_attribute(self, sample_name, fields, attribute):
+        """
+        Loader for lazily loaded samples, which reads the pileup, region
+        counts or fingerprint of a single sample.
+        """
+
+        if attribute == 'fingerprint':
+            if 'genotype' in fields:
+                return self.read_fingerprints([sample_name])[0]
+
+            return None
+
+        if attribute == 'pileup':
+            data = {
+                field: self.read(field, [sample_name])
+                for field in fields if field != 'region_counts'}
+
+            return self._decode_pileup(fields, 0, data)
+
+        if 'region_counts' in fields and self.metadata.at[sample_name, 'has_regions']:
+            region_counts = self.regions.copy()
+            region_counts['count'] = self.read('region_counts', [sample_name])[0]
+
+            return region_counts
+
+    def load_samples(self, fields=None, sample_names=None, query_group=True):
+        """
+        Load samples from the store as Sample objects. Only the requested
+        fields are read: any of 'counts', 'minor_allele_freq', 'genotype'
+        and 'region_counts' (default all). The pileup, region counts and
+        fingerprint are loaded lazily, on first access.
+        """
+
+        if fields is None:
+            fields = list(FIELDS)
+
+        metadata = self.metadata if sample_names is None else self.metadata.loc[sample_names]
+
+        samples = {}
+
+        for row in metadata.to_dict('records'):
+
+            sample = Sample(
+                sample_name=row['sample_name'], sample_bam=row['sample_bam'],
+                sample_group=row['sample_group'], sample_sex=row['sample_sex'],
+                sample_type=row['sample_type'], query_group=query_group)
+
+            sample.set_loader(
+                partial(self._load_attribute, sample.sample_name, fields))
+
+            samples[sample.sample_name] = sample
+
+        return samples
@@ -1,4 +1,7 @@
+import os
+import hashlib
 import logging
+from contextlib import contextmanager
 
 
 def get_logger(debug=False):
@@ -29,3 +32,37 @@ def standardize_sex_nomenclature(val):
         return 'M'
 
     return None
+
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    """
+    Open a temporary file next to the given path for writing. It is
+    renamed to the path only once it has been written completely, so the
+    path is never left with a partially written file.
+    """
+
+    tmp_path = '{}.tmp.{}'.format(path, os.getpid())
+
+    try:
+        with open(tmp_path, mode) as fh:
+            yield fh
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def get_file_hash(path):
+    """
+    SHA1 hash of the contents of a file.
+    """
+
+    sha1 = hashlib.sha1()
+
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
@@ -4,15 +4,29 @@
 
 
 import os
+import pickle
+import shutil
+import multiprocessing
+import tempfile
 import argparse
 from unittest import TestCase
 from unittest import mock
 
+import numpy as np
 import pandas as pd
-from biometrics.biometrics import get_samples, run_minor_contamination, run_major_contamination
+from biometrics.biometrics import get_samples, run_extract, run_minor_contamination, run_major_contamination, run_biometrics, \
+    load_database_samples, list_database_files, run_manifest
 from biometrics.cli import get_args
-from biometrics.extract import Extract
+from biometrics.extract import Extract, call_genotypes, COUNT_COLUMNS
 from biometrics.genotype import Genotyper
+from biometrics.comparison_writer import ComparisonWriter, read_comparisons
+from biometrics.sample import Sample, pileup_cache, NOT_LOADED, get_fp_summary_shard_dir, consolidate_fp_summary
+from biometrics.site_panel import SitePanel, get_site_cache_file
+from biometrics.utils import get_file_hash
+from biometrics.store import SampleStore
+from biometrics.manifest import DatabaseManifest
+from biometrics.fingerprint import Fingerprint, stack_fingerprints, compare_fingerprints, get_panel_hash
+from biometrics.index import FingerprintIndex, get_index_file, benchmark_index_recall
 from biometrics.sex_mismatch import SexMismatch
 from biometrics.minor_contamination import MinorContamination
 from biometrics.major_contamination import MajorContamination
@@ -55,6 +69,8 @@ class TestExtract(TestCase):
             plot=True,
             default_genotype=None,
             overwrite=True,
+            resume=False,
+            database_sample_type=None,
             no_db_compare=False,
             prefix='test',
             version=False,
@@ -98,6 +114,320 @@ class TestExtract(TestCase):
             samples['test_sample1'].region_counts,
             msg='Sample bed file was not loaded correctly.')
 
+    def test_extract_streaming(self):
+        """Test that the extract tool saves the samples and drops them from memory."""
+
+        args = argparse.Namespace(**vars(self.args))
+        args.database = tempfile.mkdtemp()
+        args.threads = 2
+
+        samples = get_samples(args, extraction_mode=True)
+        samples = run_extract(args, samples)
+
+        manifest = DatabaseManifest(args.database)
+        self.assertTrue(manifest.exists(), msg='The manifest was not created in the new database.')
+        self.assertEqual(
+            list(manifest.entries['bam_size']),
+            [os.path.getsize(samples[sample_name].sample_bam) for sample_name in manifest.entries.index],
+            msg='BAM files were not recorded in the manifest.')
+        self.assertTrue(
+            (manifest.entries['min_coverage'] == 10).all(),
+            msg='Extraction parameters were not recorded in the manifest.')
+
+        for sample_name, sample in samples.items():
+            self.assertTrue(
+                os.path.exists(os.path.join(args.database, sample_name + '.pickle')),
+                msg='Sample was not saved.')
+            self.assertIs(sample._pileup, NOT_LOADED, msg='Sample was kept in memory.')
+            self.assertEqual(sample.pileup.shape[0], 15, msg='Sample could not be reloaded.')
+
+        # lazily loading a sample takes its information from the
+        # completion marker, and only reads the extraction file once
+
+        with mock.patch('biometrics.sample.pickle.load', wraps=pickle.load) as pickle_load:
+            sample = Sample()
+            sample.load_from_file(samples['test_sample1'].extraction_file, lazy=True)
+            self.assertEqual(pickle_load.call_count, 0, msg='Extraction file was read for the sample information.')
+            self.assertEqual(sample.sample_name, 'test_sample1')
+            self.assertEqual(sample.extraction_info, samples['test_sample1'].extraction_info)
+            self.assertEqual(sample.pileup.shape[0], 15)
+            self.assertEqual(pickle_load.call_count, 1)
+
+            # the marker is not used once the extraction file changed
+
+            os.utime(sample.extraction_file, (0, 0))
+            Sample().load_from_file(sample.extraction_file, lazy=True)
+            self.assertEqual(pickle_load.call_count, 2, msg='Outdated completion marker was used.')
+
+        # a database that has samples is not given a manifest with only
+        # the samples that are extracted
+
+        os.remove(manifest.manifest_file)
+        run_extract(args, get_samples(args, extraction_mode=True))
+        self.assertFalse(manifest.exists(), msg='A partial manifest was created.')
+
+        shutil.rmtree(args.database)
+
+    def test_extract_resume(self):
+        """Test that resuming only re-extracts incomplete samples."""
+
+        args = argparse.Namespace(**vars(self.args))
+        args.database = tempfile.mkdtemp()
+
+        run_extract(args, get_samples(args, extraction_mode=True))
+
+        samples = get_samples(args, extraction_mode=True)
+        self.assertTrue(
+            all(sample.is_extraction_complete() for sample in samples.values()),
+            msg='Completion markers were not saved.')
+
+        # truncate one of the extraction files
+
+        extraction_file = samples['test_sample2'].extraction_file
+        with open(extraction_file, 'r+b') as fh:
+            fh.truncate(100)
+        self.assertFalse(
+            samples['test_sample2'].is_extraction_complete(),
+            msg='Truncated extraction file was not detected.')
+
+        args.overwrite = False
+        args.resume = True
+        extracted = [sample.sample_name for sample in Extract(args).extract_iter(samples)]
+
+        self.assertEqual(extracted, ['test_sample2'], msg='Wrong samples were re-extracted.')
+        self.assertTrue(
+            samples['test_sample2'].is_extraction_complete(),
+            msg='Sample was not re-extracted.')
+
+        shutil.rmtree(args.database)
+
+    def test_extract_unchanged(self):
+        """Test that samples are only re-extracted if their inputs changed."""
+
+        args = argparse.Namespace(**vars(self.args))
+        args.database = tempfile.mkdtemp()
+        args.overwrite = False
+
+        run_extract(args, get_samples(args, extraction_mode=True))
+
+        samples = get_samples(args, extraction_mode=True)
+        extracted = [sample.sample_name for sample in Extract(args).extract_iter(samples)]
+        self.assertEqual(extracted, [], msg='Unchanged samples were re-extracted.')
+
+        with mock.patch.object(
+                Extract, '_needs_extraction', autospec=True,
+                side_effect=Extract._needs_extraction) as needs_extraction:
+            Extract(args).extract(get_samples(args, extraction_mode=True))
+        self.assertEqual(needs_extraction.call_count, 2, msg='Samples were checked more than once.')
+
+        # legacy samples without the extraction information are kept
+
+        sample = samples['test_sample1']
+        sample.load_from_file()
+        sample.extraction_info = None
+        sample.save_to_file(update_summary=False)
+
+        args.min_coverage = 5
+        extracted = [sample.sample_name for sample in Extract(args).extract_iter(samples)]
+        self.assertEqual(
+            extracted, ['test_sample2'], msg='Samples with changed parameters were not re-extracted.')
+        self.assertEqual(
+            samples['test_sample2'].get_saved_extraction_info()['min_coverage'], 5,
+            msg='Extraction information was not updated.')
+
+        shutil.rmtree(args.database)
+
+    def test_extract_partial(self):
+        """Test that only the new sites and regions are extracted when the panel grows."""
+
+        args = argparse.Namespace(**vars(self.args))
+        args.database = tempfile.mkdtemp()
+        args.overwrite = False
+
+        # extract a smaller panel without the regions first
+
+        with open(args.vcf) as fh:
+            lines = fh.readlines()
+        header = [line for line in lines if line.startswith('#')]
+        records = [line for line in lines if not line.startswith('#')]
+
+        small_args = argparse.Namespace(**vars(args))
+        small_args.vcf = os.path.join(args.database, 'small.vcf')
+        small_args.bed = None
+        with open(small_args.vcf, 'w') as fh:
+            fh.writelines(header + records[5:])
+
+        run_extract(small_args, get_samples(small_args, extraction_mode=True))
+
+        samples = get_samples(args, extraction_mode=True)
+        extractor = Extract(args)
+        partial = extractor._get_partial_extraction(samples['test_sample1'])
+        self.assertEqual(partial['sites'], list(range(5)), msg='Wrong sites to extract.')
+        self.assertEqual(partial['regions'], list(extractor.regions.index), msg='Wrong regions to extract.')
+
+        # the extraction file is only hashed when the parameters match
+
+        changed_args = argparse.Namespace(**vars(args))
+        changed_args.min_coverage = args.min_coverage + 1
+        with mock.patch.object(Sample, 'is_extraction_complete') as is_extraction_complete:
+            self.assertIsNone(
+                Extract(changed_args)._get_partial_extraction(samples['test_sample1']),
+                msg='Sample with changed parameters can be extracted partially.')
+        is_extraction_complete.assert_not_called()
+
+        self.assertEqual(
+            set(partial), {'sites', 'regions'}, msg='Partial extraction keeps more than the missing indices.')
+
+        extracted = [sample.sample_name for sample in extractor.extract_iter(samples)]
+        self.assertEqual(sorted(extracted), ['test_sample1', 'test_sample2'], msg='Samples were not extracted.')
+
+        full_args = argparse.Namespace(**vars(self.args))
+        full_args.database = tempfile.mkdtemp()
+        full_samples = Extract(full_args).extract(get_samples(full_args, extraction_mode=True))
+
+        for sample_name, sample in samples.items():
+            sample.load_from_file()
+            full_samples[sample_name].load_from_file()
+            pd.testing.assert_frame_equal(sample.pileup, full_samples[sample_name].pileup)
+            pd.testing.assert_frame_equal(sample.region_counts, full_samples[sample_name].region_counts)
+
+        shutil.rmtree(args.database)
+        shutil.rmtree(full_args.database)
+
+    def test_extract_partial_with_store(self):
+        """Test that a changed panel is refused before extracting when the database has a store."""
+
+        args = argparse.Namespace(**vars(self.args))
+        args.database = tempfile.mkdtemp()
+        args.overwrite = False
+
+        with open(args.vcf) as fh:
+            lines = fh.readlines()
+
+        small_args = argparse.Namespace(**vars(args))
+        small_args.vcf = os.path.join(args.database, 'small.vcf')
+        small_args.bed = None
+        with open(small_args.vcf, 'w') as fh:
+            fh.writelines(lines[:-1])
+
+        run_extract(small_args, get_samples(small_args, extraction_mode=True))
+        SampleStore(args.database).import_pickles(list_database_files(args.database))
+
+        samples = get_samples(args, extraction_mode=True)
+        mtimes = {
+            sample_name: os.path.getmtime(sample.extraction_file)
+            for sample_name, sample in samples.items()}
+
+        with mock.patch.object(Extract, '_extract_samples') as extract_samples:
+            with self.assertRaisesRegex(AssertionError, 'different set of sites'):
+                run_extract(args, samples)
+
+        extract_samples.assert_not_called()
+        for sample_name, sample in samples.items():
+            self.assertEqual(
+                os.path.getmtime(sample.extraction_file), mtimes[sample_name],
+                msg='Sample was extracted although the store does not match.')
+
+        # the new panel is extracted once the store is removed
+
+        shutil.rmtree(SampleStore(args.database).path)
+        extracted = [sample.sample_name for sample in Extract(args).extract_iter(samples)]
+        self.assertEqual(sorted(extracted), ['test_sample1', 'test_sample2'], msg='Samples were not extracted.')
+
+        shutil.rmtree(args.database)
+
+    def test_extract_iter_cleanup(self):
+        """Test that the pool is stopped and the FP summary merged when extraction stops early."""
+
+        args = argparse.Namespace(**vars(self.args))
+        args.database = tempfile.mkdtemp()
+        args.threads = 2
+
+        with mock.patch('biometrics.extract.consolidate_fp_summary') as consolidate:
+            extracted = Extract(args).extract_iter(get_samples(args, extraction_mode=True))
+            next(extracted)
+            extracted.close()
+
+            self.assertEqual(consolidate.call_count, 1, msg='FP summary was not merged.')
+            self.assertEqual(multiprocessing.active_children(), [], msg='Workers were left running.')
+
+            args.overwrite = True
+            with mock.patch.object(Sample, 'save_to_file', side_effect=OSError('disk full')):
+                with self.assertRaises(OSError):
+                    list(Extract(args).extract_iter(get_samples(args, extraction_mode=True)))
+
+            self.assertEqual(consolidate.call_count, 2, msg='FP summary was not merged.')
+            self.assertEqual(multiprocessing.active_children(), [], msg='Workers were left running.')
+
+        shutil.rmtree(args.database)
+
+    @mock.patch('biometrics.extract.SITE_WINDOW_GAP', 0)
+    def test_extract_sample_sharded(self):
+        """Test that splitting a sample into shards gives the same result."""
+
+        pileups = []
+
+        for threads in [1, 4]:
+            args = argparse.Namespace(**vars(self.args))
+            args.database = tempfile.mkdtemp()
+            args.threads = threads
+
+            extractor = Extract(args)
+            sample = Sample(
+                sample_name='test_sample1',
+                sample_bam=os.path.join(CUR_DIR, 'test_data/test_sample1_golden.bam'),
+                db=args.database)
+
+            if threads > 1:
+                jobs = extractor._shard_sample(sample, threads)
+                self.assertEqual(len(jobs), threads, msg='Sample was not split into shards.')
+                self.assertTrue(
+                    all(job['sites'] is None and 'windows' not in job for job in jobs),
+                    msg='The jobs of a full extraction carry the sites.')
+
+            samples = extractor.extract({sample.sample_name: sample})
+            pileups.append(samples['test_sample1'].pileup)
+
+            shutil.rmtree(args.database)
+
+        pd.testing.assert_frame_equal(pileups[0], pileups[1])
+
+
+class TestCallGenotypes(TestCase):
+    """Tests for calling genotypes from the allele counts."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+        self.pileup = pd.DataFrame({
+            'chrom': ['1', '1', '1', '1'],
+            'pos': [10, 20, 30, 40],
+            'ref': ['A', 'C', 'G', 'T'],
+            'alt': ['G', 'T', 'A', 'C'],
+            'A': [20, 0, 1, 0],
+            'C': [0, 15, 0, 2],
+            'G': [1, 0, 19, 0],
+            'T': [0, 5, 0, 1],
+            'N': [0, 0, 0, 0]})
+
+    def test_call_genotypes(self):
+        pileup = call_genotypes(
+            self.pileup, min_coverage=10, min_homozygous_thresh=0.1)
+
+        self.assertAlmostEqual(pileup.at[0, 'minor_allele_freq'], 1 / 21)
+        self.assertEqual(list(pileup['genotype_class'][:3]), ['Hom', 'Het', 'Hom'])
+        self.assertEqual(list(pileup['genotype'][:3]), ['A', 'CT', 'G'])
+        self.assertTrue(pd.isna(pileup.at[3, 'genotype_class']), msg='Low coverage site should not be called.')
+        self.assertTrue(pd.isna(pileup.at[3, 'genotype']), msg='Low coverage site should not be called.')
+
+    def test_call_genotypes_default(self):
+        pileup = call_genotypes(
+            self.pileup, min_coverage=10, min_homozygous_thresh=0.3,
+            default_genotype='Hom')
+
+        self.assertEqual(list(pileup['genotype_class']), ['Hom', 'Hom', 'Hom', 'Hom'])
+        self.assertEqual(list(pileup['genotype']), ['A', 'C', 'G', 'C'])
+
 
 class TestLoadData(TestCase):
     """Tests load data by sample name in `biometrics` package."""
@@ -131,6 +461,8 @@ class TestLoadData(TestCase):
             plot=True,
             default_genotype=None,
             overwrite=True,
+            resume=False,
+            database_sample_type=None,
             no_db_compare=False,
             prefix='test',
             version=False,
@@ -180,6 +512,8 @@ class TestLoadDataPickle(TestCase):
             plot=True,
             default_genotype=None,
             overwrite=True,
+            resume=False,
+            database_sample_type=None,
             no_db_compare=False,
             prefix='test',
             version=False,
@@ -227,6 +561,8 @@ class TestDownstreamTools(TestCase):
             plot=True,
             default_genotype=None,
             overwrite=True,
+            resume=False,
+            database_sample_type=None,
             no_db_compare=False,
             prefix='test',
             version=False,
@@ -282,6 +618,86 @@ class TestDownstreamTools(TestCase):
         self.assertEqual(len(data), 4, msg='There were not four comparisons done.')
         self.assertEqual(set(data['Status']), set(['Expected Match']), msg='All sample comparisons were expected to match.')
 
+    def test_genotyper_comparison_cache(self):
+        samples = get_samples(self.args, extraction_mode=False)
+        cache_dir = tempfile.mkdtemp()
+        cache_file = os.path.join(cache_dir, 'comparison_cache.npz')
+
+        expected = Genotyper(no_db_compare=self.args.no_db_compare).compare_samples(samples)
+
+        for i in range(2):
+            genotyper = Genotyper(
+                no_db_compare=self.args.no_db_compare,
+                comparison_cache=cache_file)
+            data = genotyper.compare_samples(samples)
+
+            pd.testing.assert_frame_equal(data, expected)
+
+        digests = set(sample.get_fingerprint().digest for sample in samples.values())
+        self.assertEqual(
+            len(genotyper.comparison_cache.keys), len(digests) ** 2,
+            msg='Comparisons were not cached.')
+        self.assertEqual(
+            len(genotyper.comparison_cache.new_keys), 0,
+            msg='Cached comparisons were computed again.')
+        self.assertEqual(
+            len(genotyper.comparison_cache.digests), len(digests),
+            msg='Each fingerprint should be stored once in the cache.')
+
+        shutil.rmtree(cache_dir)
+
+    def test_genotyper_old_comparison_cache(self):
+        samples = get_samples(self.args, extraction_mode=False)
+        cache_dir = tempfile.mkdtemp()
+        cache_file = os.path.join(cache_dir, 'comparison_cache.npz')
+
+        np.savez(cache_file, keys=np.array(['a' * 80]), counts=np.zeros((1, 4), dtype=np.int64))
+
+        expected = Genotyper(no_db_compare=self.args.no_db_compare).compare_samples(samples)
+        genotyper = Genotyper(
+            no_db_compare=self.args.no_db_compare,
+            comparison_cache=cache_file)
+        data = genotyper.compare_samples(samples)
+
+        pd.testing.assert_frame_equal(data, expected)
+        with np.load(cache_file) as cache:
+            self.assertIn('digests', cache, msg='The old comparison cache was not replaced.')
+
+        shutil.rmtree(cache_dir)
+
+    def test_genotyper_top_matches(self):
+        samples = get_samples(self.args, extraction_mode=False)
+        samples['test_sample2'].query_group = True
+
+        genotyper = Genotyper(
+            no_db_compare=self.args.no_db_compare,
+            discordance_threshold=self.args.discordance_threshold)
+        data = genotyper.find_top_matches(samples, 1)
+
+        self.assertEqual(len(data), 1, msg='Expected one top match.')
+        self.assertEqual(data.at[0, 'QuerySample'], 'test_sample2', msg='Wrong top match.')
+        self.assertEqual(data.at[0, 'Status'], 'Expected Match', msg='Top match was expected to match.')
+
+    @mock.patch('biometrics.genotype.COMPARISON_BLOCK_PAIRS', 2)
+    def test_genotyper_write_comparisons(self):
+        samples = get_samples(self.args, extraction_mode=False)
+        genotyper = Genotyper(no_db_compare=self.args.no_db_compare)
+        expected = genotyper.compare_samples(samples)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer = ComparisonWriter(tmpdir, samples)
+            genotyper.write_comparisons(samples, writer)
+            data = read_comparisons(tmpdir)
+
+            self.assertEqual(writer.n_parts, 2, msg='Comparisons were not written in blocks.')
+            pd.testing.assert_frame_equal(data, expected, check_dtype=False)
+
+            genotyper.write_comparisons(samples, ComparisonWriter(tmpdir, samples, unexpected_only=True))
+            self.assertEqual(len(read_comparisons(tmpdir)), 0, msg='Expected matches were not filtered out.')
+
+            genotyper.write_comparisons(samples, ComparisonWriter(tmpdir, samples, max_discordance=0.01))
+            self.assertEqual(len(read_comparisons(tmpdir)), 4, msg='Matches were filtered out.')
+
     def test_genotyper_plot(self):
         samples = get_samples(self.args, extraction_mode=False)
 
@@ -338,6 +754,8 @@ class TestNASexMismatch(TestCase):
             plot=False,
             default_genotype=None,
             overwrite=True,
+            resume=False,
+            database_sample_type=None,
             no_db_compare=False,
             prefix='test',
             version=False,
@@ -358,3 +776,615 @@ class TestNASexMismatch(TestCase):
 
         self.assertTrue(
             pd.isna(results.at[0, 'predicted_sex']), msg='Predicted sample sex should have been nan.')
+
+
+class TestRegenotype(TestCase):
+    """Tests for re-genotyping samples in the database."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+        self.database = tempfile.mkdtemp()
+        for sample_name in ['test_sample1', 'test_sample2']:
+            shutil.copy(
+                os.path.join(CUR_DIR, 'test_data', sample_name + '.pickle'),
+                self.database)
+
+    def tearDown(self):
+        shutil.rmtree(self.database)
+
+    def test_regenotype(self):
+        args = argparse.Namespace(
+            subparser_name='regenotype',
+            input=None,
+            database=self.database,
+            min_coverage=1000,
+            min_homozygous_thresh=0.1,
+            default_genotype=None,
+            threads=2)
+        run_biometrics(args)
+
+        sample = Sample()
+        sample.load_from_file(os.path.join(self.database, 'test_sample1.pickle'))
+
+        self.assertEqual(sample.pileup.shape[0], 15, msg='Pileup was not kept.')
+        self.assertTrue(
+            sample.pileup['genotype_class'].isna().all(),
+            msg='No site should be called with a minimum coverage of 1000.')
+        self.assertTrue(
+            os.path.exists(os.path.join(self.database, 'ALL_FPsummary.txt')),
+            msg='FP summary was not written.')
+
+    def test_regenotype_summary(self):
+        args = argparse.Namespace(
+            subparser_name='regenotype',
+            input=None,
+            database=self.database,
+            min_coverage=10,
+            min_homozygous_thresh=0.1,
+            default_genotype=None,
+            threads=2)
+        run_biometrics(args)
+        run_biometrics(args)
+
+        fp_summary = pd.read_csv(os.path.join(self.database, 'ALL_FPsummary.txt'))
+
+        self.assertEqual(
+            sorted(fp_summary.columns),
+            sorted(['Locus', 'Site'] + [
+                sample_name + suffix
+                for sample_name in ['test_sample1', 'test_sample2']
+                for suffix in ['_ref_Counts', '_gt_Counts', '_Genotypes', '_MinorAlleleFreq']]),
+            msg='FP summary columns were not replaced.')
+        self.assertEqual(
+            os.listdir(get_fp_summary_shard_dir(os.path.join(self.database, 'ALL_FPsummary.txt'))),
+            [], msg='FP summary shards were not consolidated.')
+
+    def test_consolidate_fp_summary(self):
+        """Test that sites sharing a locus are kept apart and in panel order."""
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            summary_file = os.path.join(tmpdir, 'ALL_FPsummary.txt')
+            shard_dir = get_fp_summary_shard_dir(summary_file)
+            os.makedirs(shard_dir)
+
+            def write_shard(sample_name, sites, genotypes):
+                pd.DataFrame({
+                    'Locus': [site.rsplit(':', 2)[0] for site in sites],
+                    'Site': sites,
+                    sample_name + '_Genotypes': genotypes,
+                }).to_csv(os.path.join(shard_dir, sample_name + '.csv'), index=False)
+
+            write_shard('s1', ['2:7:A:C', '1:100:A:G', '1:100:A:T', '10:5:C:T'], ['A', 'AG', 'T', 'C'])
+            write_shard('s2', ['2:7:A:C', '1:100:A:T', '10:5:C:T'], ['C', 'AT', 'T'])
+            consolidate_fp_summary(summary_file)
+
+            # a shard that another run merged and removed in the meantime
+            # is skipped
+
+            write_shard('s2', ['2:7:A:C', '1:100:A:G', '3:1:G:T'], ['A', 'G', 'G'])
+            shard_files = [os.path.join(shard_dir, 's0.csv'), os.path.join(shard_dir, 's2.csv')]
+            with mock.patch('biometrics.sample.glob.glob', return_value=shard_files):
+                consolidate_fp_summary(summary_file)
+
+            self.assertEqual(os.listdir(shard_dir), [], msg='Merged shards were not removed.')
+            fp_summary = pd.read_csv(summary_file, dtype=str)
+
+        self.assertEqual(
+            list(fp_summary['Site']),
+            ['2:7:A:C', '1:100:A:G', '1:100:A:T', '10:5:C:T', '3:1:G:T'],
+            msg='Sites were not kept in order.')
+        self.assertEqual(list(fp_summary['Locus']), ['2:7', '1:100', '1:100', '10:5', '3:1'])
+        self.assertEqual(list(fp_summary['s1_Genotypes'].fillna('')), ['A', 'AG', 'T', 'C', ''])
+        self.assertEqual(
+            list(fp_summary['s2_Genotypes'].fillna('')), ['A', 'G', '', '', 'G'],
+            msg='Columns of the re-genotyped sample were not replaced.')
+
+
+class TestLazySample(TestCase):
+    """Tests for lazily loading samples."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+        self.max_size = pileup_cache.max_size
+        pileup_cache.max_size = 1
+
+        self.samples = []
+        for sample_name in ['test_sample1', 'test_sample2']:
+            sample = Sample(query_group=True)
+            sample.load_from_file(
+                os.path.join(CUR_DIR, 'test_data', sample_name + '.pickle'),
+                lazy=True)
+            self.samples.append(sample)
+
+    def tearDown(self):
+        pileup_cache.max_size = self.max_size
+
+    def test_lazy_loading(self):
+        sample1, sample2 = self.samples
+
+        self.assertIs(sample1._pileup, NOT_LOADED, msg='Pileup was loaded eagerly.')
+        self.assertEqual(sample1.pileup.shape[0], 15, msg='Pileup was not loaded.')
+
+        self.assertEqual(sample2.pileup.shape[0], 15, msg='Pileup was not loaded.')
+        self.assertIs(
+            sample1._pileup, NOT_LOADED,
+            msg='Least recently used pileup was not dropped.')
+
+        self.assertEqual(sample1.pileup.shape[0], 15, msg='Pileup was not reloaded.')
+        self.assertIsNone(sample1.region_counts, msg='Region counts were not loaded.')
+
+
+class TestSampleStore(TestCase):
+    """Tests for the consolidated sample store."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+        self.database = tempfile.mkdtemp()
+        for sample_name in ['test_sample1', 'test_sample2']:
+            shutil.copy(
+                os.path.join(CUR_DIR, 'test_data', sample_name + '.pickle'),
+                self.database)
+
+    def tearDown(self):
+        shutil.rmtree(self.database)
+
+    def test_import_and_load(self):
+        args = argparse.Namespace(
+            subparser_name='store',
+            database=self.database,
+            overwrite=False)
+        run_biometrics(args)
+
+        store = SampleStore(self.database)
+        samples = store.load_samples()
+
+        self.assertEqual(
+            sorted(samples.keys()), ['test_sample1', 'test_sample2'],
+            msg='Samples were not imported into the store.')
+
+        for sample_name, sample in samples.items():
+            expected = Sample()
+            expected.load_from_file(
+                os.path.join(self.database, sample_name + '.pickle'))
+
+            self.assertEqual(
+                sample.get_fingerprint().digest,
+                expected.get_fingerprint().digest,
+                msg='Genotypes do not match the extraction file.')
+            self.assertTrue(
+                (sample.pileup['reads_all'].to_numpy() == expected.pileup['reads_all'].to_numpy()).all(),
+                msg='Counts do not match the extraction file.')
+            self.assertIsNone(
+                sample.region_counts,
+                msg='Samples were extracted without regions.')
+
+        # appending a sample again should rewrite its row
+
+        sizes = [os.path.getsize(store._field_file(field)) for field in ['counts', 'genotype']]
+        row = store.metadata.loc['test_sample1', 'row']
+        store.append([samples['test_sample1']])
+        metadata = store.metadata
+        store = SampleStore(self.database)
+        pd.testing.assert_frame_equal(metadata, store.metadata, check_dtype=False)
+        self.assertEqual(len(store.metadata), 2, msg='Sample was duplicated.')
+        self.assertEqual(
+            store.metadata.loc['test_sample1', 'row'], row,
+            msg='The existing row was not rewritten.')
+        self.assertEqual(
+            [os.path.getsize(store._field_file(field)) for field in ['counts', 'genotype']], sizes,
+            msg='The store grew when a sample was appended again.')
+        with open(os.path.join(store.path, 'samples.csv')) as fh:
+            self.assertEqual(len(fh.readlines()), 3, msg='The metadata table grew.')
+
+        samples = store.load_samples(fields=['region_counts'])
+        self.assertNotIn(
+            'genotype', samples['test_sample1'].pileup.columns,
+            msg='Fields that were not requested were loaded.')
+
+    def test_missing_alt_allele(self):
+        sample = Sample()
+        sample.load_from_file(os.path.join(self.database, 'test_sample1.pickle'))
+        sample.pileup.loc[0, 'alt'] = 'None'
+
+        SampleStore(self.database).append([sample])
+        store = SampleStore(self.database)
+
+        self.assertEqual(store.sites.loc[0, 'alt'], 'None', msg='Missing ALT allele was not kept.')
+        self.assertEqual(store.panel_hash, get_panel_hash(sample.pileup), msg='Panel hash changed.')
+
+    def test_append_after_interrupted_append(self):
+        samples = {}
+        for sample_name in ['test_sample1', 'test_sample2']:
+            samples[sample_name] = Sample()
+            samples[sample_name].load_from_file(os.path.join(self.database, sample_name + '.pickle'))
+
+        store = SampleStore(self.database)
+        store.append([samples['test_sample1']])
+
+        # an interrupted append leaves part of a row in some of the files
+
+        with open(store._field_file('counts'), 'ab') as fh:
+            fh.write(b'\0' * 17)
+        with open(store._field_file('genotype'), 'ab') as fh:
+            fh.write(b'\0' * store._row_size('genotype'))
+
+        store.append([samples['test_sample2']])
+        store = SampleStore(self.database)
+
+        self.assertEqual(store._n_rows(), 2, msg='Partial rows were kept.')
+        for sample_name, sample in samples.items():
+            self.assertTrue(
+                (store.read('counts', [sample_name])[0] ==
+                 sample.pileup[COUNT_COLUMNS].to_numpy()).all(),
+                msg='Counts of {} are wrong.'.format(sample_name))
+
+    def test_write_comparisons_max_memory(self):
+        store = SampleStore(self.database)
+        store.import_pickles([
+            os.path.join(self.database, sample_name + '.pickle')
+            for sample_name in ['test_sample1', 'test_sample2']])
+
+        samples = store.load_samples(fields=['genotype'])
+        samples['test_sample1'].query_group = False
+
+        expected = Genotyper(no_db_compare=False).compare_samples(samples)
+
+        # a tiny budget, so that each block has a single pair
+        genotyper = Genotyper(no_db_compare=False, threads=2)
+        self.assertEqual(genotyper._get_block_shape(1, 10, max_memory=1), (1, 1))
+
+        for sample in samples.values():
+            sample.fingerprint = None
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer = ComparisonWriter(tmpdir, samples)
+            genotyper.write_comparisons(samples, writer, max_memory=1)
+            data = read_comparisons(tmpdir)
+
+        self.assertEqual(writer.n_parts, 2, msg='Comparisons were not written in blocks.')
+        pd.testing.assert_frame_equal(data, expected, check_dtype=False)
+        self.assertIsNone(
+            samples['test_sample2'].fingerprint,
+            msg='Fingerprints of the database samples were kept in memory.')
+
+    def test_write_comparisons_max_memory_threads(self):
+        """Test comparing blocks that share samples in several threads."""
+
+        extraction_files = []
+        for i in range(6):
+            sample = Sample()
+            sample.load_from_file(os.path.join(self.database, 'test_sample{}.pickle'.format(i % 2 + 1)))
+            sample.sample_name = 'sample{}'.format(i)
+            sample.extraction_file = os.path.join(self.database, sample.sample_name + '.pickle')
+            sample.save_to_file(update_summary=False)
+            extraction_files.append(sample.extraction_file)
+
+        store = SampleStore(self.database)
+        store.import_pickles(extraction_files)
+
+        samples = store.load_samples(
+            fields=['genotype'], sample_names=['sample{}'.format(i) for i in range(6)])
+        for i in range(3):
+            samples['sample{}'.format(i)].query_group = False
+
+        expected = Genotyper(no_db_compare=False).compare_samples(samples)
+
+        for sample in samples.values():
+            sample.fingerprint = None
+
+        # each block has a single pair, so the blocks compared at the same
+        # time share their reference or query samples. No fingerprint may
+        # be unloaded while a block is being compared.
+        genotyper = Genotyper(no_db_compare=False, threads=3)
+
+        active_blocks = []
+        unloaded_during_block = []
+        compare_block = Genotyper._compare_block
+        unload_fingerprint = Sample.unload_fingerprint
+
+        def counting_compare_block(self, *args):
+            active_blocks.append(None)
+            try:
+                return compare_block(self, *args)
+            finally:
+                active_blocks.pop()
+
+        def checking_unload_fingerprint(sample):
+            unloaded_during_block.append(len(active_blocks) > 0)
+            unload_fingerprint(sample)
+
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(Genotyper, '_compare_block', counting_compare_block), \
+                mock.patch.object(Sample, 'unload_fingerprint', checking_unload_fingerprint):
+            writer = ComparisonWriter(tmpdir, samples)
+            genotyper.write_comparisons(samples, writer, max_memory=1)
+            data = read_comparisons(tmpdir)
+
+        self.assertEqual(writer.n_parts, 18, msg='Comparisons were not written in blocks.')
+        self.assertGreater(len(unloaded_during_block), 0, msg='Fingerprints were not unloaded.')
+        self.assertFalse(
+            any(unloaded_during_block), msg='Fingerprints were unloaded while blocks were compared.')
+        pd.testing.assert_frame_equal(data, expected, check_dtype=False)
+        self.assertTrue(
+            all(samples['sample{}'.format(i)].fingerprint is None for i in range(3, 6)),
+            msg='Fingerprints of the database samples were kept in memory.')
+
+
+class TestDatabaseManifest(TestCase):
+    """Tests for the database manifest and loading the database."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+        self.database = tempfile.mkdtemp()
+        for sample_name in ['test_sample1', 'test_sample2']:
+            shutil.copy(
+                os.path.join(CUR_DIR, 'test_data', sample_name + '.pickle'),
+                self.database)
+
+    def tearDown(self):
+        shutil.rmtree(self.database)
+
+    def test_manifest(self):
+        samples = load_database_samples(self.database, set(), threads=2)
+        self.assertEqual(
+            list(samples.keys()), ['test_sample1', 'test_sample2'],
+            msg='Samples were not loaded in order.')
+        self.assertIs(samples['test_sample1']._pileup, NOT_LOADED)
+
+        args = argparse.Namespace(
+            subparser_name='manifest',
+            database=self.database,
+            threads=2,
+            check=False)
+        run_biometrics(args)
+
+        manifest = DatabaseManifest(self.database)
+        self.assertEqual(manifest.entries.at['test_sample1', 'sample_type'], 'tumor')
+        self.assertEqual(len(manifest.get_stale_entries()), 0, msg='Found stale entries.')
+
+        # updating entries does not read the manifest back
+
+        samples['test_sample1'].sample_type = 'Normal'
+        with mock.patch('biometrics.manifest.pd.read_sql', wraps=pd.read_sql) as read_sql:
+            manifest.add([samples['test_sample1']])
+            read_sql.assert_not_called()
+            self.assertEqual(manifest.entries.at['test_sample1', 'sample_type'], 'Normal')
+
+        samples['test_sample1'].sample_type = 'tumor'
+        manifest.add([samples['test_sample1']])
+        self.assertEqual(
+            list(load_database_samples(self.database, set(['test_sample2']), sample_types=['tumor'])),
+            ['test_sample1'])
+        self.assertEqual(
+            len(load_database_samples(self.database, set(), sample_types=['Normal'])), 0,
+            msg='Samples were not filtered by sample type.')
+
+        # the manifest is used instead of scanning the directory
+
+        os.rename(
+            os.path.join(self.database, 'test_sample2.pickle'),
+            os.path.join(self.database, 'test_sample3.pickle'))
+        self.assertEqual(
+            list_database_files(self.database),
+            [os.path.join(self.database, 'test_sample1.pickle'),
+             os.path.join(self.database, 'test_sample2.pickle')])
+        self.assertEqual(
+            len(list_database_files(self.database, use_manifest=False)), 2)
+
+        args.check = True
+        stale = run_manifest(args)
+        self.assertEqual(
+            stale.to_dict('records'),
+            [{'sample_name': 'test_sample2', 'reason': 'Extraction file is missing'}])
+
+
+class TestFingerprint(TestCase):
+    """Tests for the packed genotype fingerprints."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+        self.samples = {}
+        for sample_name in ['test_sample1', 'test_sample2']:
+            sample = Sample()
+            sample.load_from_file(
+                os.path.join(CUR_DIR, 'test_data', sample_name + '.pickle'))
+            self.samples[sample_name] = sample
+
+    def test_save_and_load(self):
+        fingerprint = self.samples['test_sample1'].get_fingerprint()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fingerprint_file = os.path.join(tmpdir, 'test_sample1.fingerprint.npz')
+            fingerprint.save(fingerprint_file)
+            loaded = Fingerprint().load(fingerprint_file)
+
+        self.assertEqual(loaded.sample_name, 'test_sample1')
+        self.assertEqual(loaded.n_sites, 15)
+        self.assertEqual(loaded.digest, fingerprint.digest, msg='Fingerprint changed after loading.')
+
+    def test_compare(self):
+        sample1 = self.samples['test_sample1']
+        sample2 = self.samples['test_sample2']
+
+        counts = compare_fingerprints(
+            stack_fingerprints([sample1.get_fingerprint()]),
+            stack_fingerprints([sample2.get_fingerprint()]))
+        expected = Genotyper(no_db_compare=False)._compute_discordance(sample1, sample2)
+
+        for col, val in counts.items():
+            self.assertEqual(val[0, 0], expected[col], msg='{} is wrong.'.format(col))
+
+
+class TestFingerprintIndex(TestCase):
+    """Tests for the fingerprint index."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+        self.samples = {}
+        for sample_name in ['test_sample1', 'test_sample2']:
+            sample = Sample(query_group=sample_name == 'test_sample2')
+            sample.load_from_file(
+                os.path.join(CUR_DIR, 'test_data', sample_name + '.pickle'))
+            self.samples[sample_name] = sample
+
+        self.fingerprints = [sample.get_fingerprint() for sample in self.samples.values()]
+
+    def test_query(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index = FingerprintIndex(get_index_file(tmpdir))
+            index.add(self.fingerprints)
+            index.add(self.fingerprints[:1])
+            index.save()
+
+            loaded = FingerprintIndex(get_index_file(tmpdir))
+
+        self.assertEqual(loaded.sample_names, ['test_sample1', 'test_sample2'])
+        self.assertEqual(
+            loaded.query(self.fingerprints[0]), set(['test_sample1', 'test_sample2']),
+            msg='Matching samples were not returned as candidates.')
+
+        result = benchmark_index_recall(
+            loaded, Genotyper(no_db_compare=False), self.fingerprints, self.fingerprints)
+        self.assertEqual(result['recall'], 1.0, msg='Index recall is wrong.')
+
+    def test_recall_uncalled_sites(self):
+        """Test that matches with many uncalled sites are still found."""
+
+        rng = np.random.default_rng(0)
+        n_samples = 40
+        n_sites = 2000
+        genotypes = rng.binomial(2, rng.uniform(0.1, 0.5, n_sites), size=(n_samples, n_sites))
+
+        def get_fingerprints(call_rate, prefix):
+            fingerprints = []
+            for i in range(n_samples):
+                calls = np.where(rng.random(n_sites) < 0.01, rng.integers(0, 3, n_sites), genotypes[i])
+                called = rng.random(n_sites) < call_rate
+                fingerprints.append(Fingerprint(
+                    sample_name=prefix + str(i), panel_hash='panel', n_sites=n_sites,
+                    called=np.packbits(called), het=np.packbits(called & (calls == 1)),
+                    alt=np.packbits(called & (calls == 2))))
+            return fingerprints
+
+        database = get_fingerprints(0.95, 'db')
+        genotyper = Genotyper(no_db_compare=False)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index = FingerprintIndex(get_index_file(tmpdir))
+            index.add(database)
+            index.save()
+            index = FingerprintIndex(get_index_file(tmpdir))
+
+        result = benchmark_index_recall(index, genotyper, get_fingerprints(0.95, 'query'), database)
+        self.assertEqual(result['recall'], 1.0, msg='Index recall is wrong.')
+        self.assertEqual(result['uncertain_per_query'], 0, msg='Index was not trusted with high call rates.')
+        self.assertLess(result['candidates_per_query'], n_samples / 4, msg='Index does not exclude samples.')
+
+        # queries with many uncalled sites fall back to the sketch
+
+        for call_rate in [0.6, 0.4]:
+            result = benchmark_index_recall(index, genotyper, get_fingerprints(call_rate, 'query'), database)
+            self.assertEqual(result['recall'], 1.0, msg='Matches with uncalled sites were missed.')
+            self.assertEqual(result['uncertain_per_query'], n_samples)
+
+    def test_genotyper_top_matches(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index = FingerprintIndex(get_index_file(tmpdir))
+            index.add(self.fingerprints[1:])
+
+            genotyper = Genotyper(no_db_compare=False)
+            expected = genotyper.find_top_matches(self.samples, 1)
+            data = genotyper.find_top_matches(self.samples, 1, index=index)
+
+            pd.testing.assert_frame_equal(data, expected)
+
+            # the fingerprints of database samples that are not candidates
+            # are not loaded
+
+            index = FingerprintIndex(get_index_file(tmpdir))
+            index.add(self.fingerprints[:1])
+            with mock.patch.object(
+                    self.samples['test_sample2'], 'get_fingerprint',
+                    wraps=self.samples['test_sample2'].get_fingerprint) as get_fingerprint:
+                data = genotyper.find_top_matches(self.samples, 1, index=index)
+
+            get_fingerprint.assert_not_called()
+            self.assertEqual(len(data), 0, msg='Samples that are not candidates were compared.')
+
+
+class TestSitePanel(TestCase):
+    """Tests for parsing and caching the VCF sites."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.vcf = os.path.join(self.tmpdir, 'test.vcf')
+        shutil.copy(os.path.join(CUR_DIR, 'test_data/test.vcf'), self.vcf)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_load(self):
+        sites = SitePanel.load(self.vcf)
+
+        self.assertEqual(len(sites), 15, msg='Did not parse right number of sites.')
+        self.assertEqual(
+            set(sites[0]), {'chrom', 'start', 'end', 'ref_allele', 'alt_allele'})
+        self.assertEqual(sites[0]['end'], sites[0]['start'] + 1)
+        self.assertTrue(os.path.exists(get_site_cache_file(self.vcf)), msg='Sites were not cached.')
+
+        with mock.patch.object(SitePanel, 'parse_vcf') as parse_vcf:
+            cached = SitePanel.load(self.vcf)
+
+        parse_vcf.assert_not_called()
+        self.assertEqual([cached[i] for i in range(15)], [sites[i] for i in range(15)])
+        self.assertEqual(cached.panel_hash, sites.panel_hash)
+
+        # the cache is not used once the VCF file changes
+
+        with open(self.vcf) as fh:
+            lines = fh.readlines()
+        with open(self.vcf, 'w') as fh:
+            fh.writelines(lines[:-1])
+
+        self.assertEqual(len(SitePanel.load(self.vcf)), 14, msg='Changed VCF file was not parsed again.')
+
+    def test_parse_vcf_records(self):
+        with open(self.vcf) as fh:
+            lines = fh.readlines()
+        records = [line.split('\t') for line in lines if not line.startswith('#')]
+        records[0][2] = 'rs#1'
+        records[1][4] = '.'
+        with open(self.vcf, 'w') as fh:
+            fh.writelines([line for line in lines if line.startswith('#')] + ['\t'.join(r) for r in records])
+
+        sites = SitePanel.parse_vcf(self.vcf)
+
+        self.assertEqual(len(sites), 15, msg='Records with a # in the ID were not parsed.')
+        self.assertEqual(sites[0]['alt_allele'], 'G')
+        self.assertEqual(sites[1]['alt_allele'], 'None', msg='Missing ALT allele is not None.')
+
+    def test_load_corrupt_cache(self):
+        sites = SitePanel.load(self.vcf)
+        cache_file = get_site_cache_file(self.vcf)
+
+        for content in [b'', b'PK\x03\x04truncated']:
+            with open(cache_file, 'wb') as fh:
+                fh.write(content)
+
+            reparsed = SitePanel.load(self.vcf)
+
+            self.assertEqual(reparsed.panel_hash, sites.panel_hash, msg='Corrupt cache was not parsed again.')
+            self.assertEqual(SitePanel.load(self.vcf).panel_hash, sites.panel_hash)
+
+        # a cache without some of the arrays is parsed again too
+
+        np.savez(cache_file, vcf_sha1=np.array(get_file_hash(self.vcf)))
+        self.assertEqual(SitePanel.load(self.vcf).panel_hash, sites.panel_hash)